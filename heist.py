@@ -85,7 +85,6 @@ some attributes:
 --------------------------------------------------------------
 
 TODO:
-  * implement regexes in ArtFileReader.list_records()
   * make things like 'vector<short>' print data 
     * override __str__ like type(trace).__str__ = my_special_function
   * think about ProductNotFound vs. zero-length collection (currently 
@@ -101,25 +100,6 @@ TODO:
           if thing in ('gInterpreter','gROOT','gSystem'): continue # skip these
           from ROOT.module.cppyy.libPyROOT import thing
       (though that last line won't work because 'thing' is just a string)
-  * improve magicdump iteration (see https://opensource.com/article/18/3/loop-\
-    better-deeper-look-iteration-python)
-    * ROOT.vector doesn't have __iter__, but it's iterable
-    * use iter()?
-    * `for i_item,item in enumerate(obj[:n_items_to_print])` breaks on 
-      TObjectArrays, but only because of the slicing
-  * fix artreader.ls() so that this doesn't happen when the gallery::Event is
-    at the last event in the file:
-      >>> artreader.ls('gps')
-      Traceback (most recent call last):
-        File "<stdin>", line 1, in <module>
-        File "/media/sf_hosthome/heist/heist.py", line 317, in ls
-          for record in self.list_records(pattern=pattern,regex=regex):
-        File "/media/sf_hosthome/heist/heist.py", line 305, in list_records
-          for b in self.event.gallery_event.getTTree().GetListOfBranches():
-      ReferenceError: attempt to access a null-pointer
-    The problem is fixed by artreader.event.gallery_event.toBegin(), but that is
-    something that the user should be warned about, maybe with a big scary
-    notification message...
   * at least one heist.InputTag MUST be instantiated before heist.event.
     get_record(quicktag) will work but 
       1) it's not clear why, and 
@@ -173,24 +153,73 @@ NOTES:
 '''
 
 import sys
-import ROOT as ROOT
+import re
+import json
+import hashlib
+import importlib
+import itertools
+import collections
+
+################################################################
+# ROOT (and numpy) are imported on first use, so 'import heist' is cheap
+
+class _LazyModule(object):
+  '''Stands in for a module, which is imported on first attribute access.
+  
+  setup() (if given) runs right after the import.
+  '''
+  def __init__(self, name, setup=None):
+    self.__dict__['_name'] = name
+    self.__dict__['_setup'] = setup
+    self.__dict__['_module'] = None
+  
+  def _load(self):
+    if self._module is None:
+      self.__dict__['_module'] = importlib.import_module(self._name)
+      if self._setup!=None: self._setup()
+    return self._module
+  
+  def __getattr__(self, name): return getattr(self._load(),name)
+  def __setattr__(self, name, value): setattr(self._load(),name,value)
+  def __dir__(self): return dir(self._load())
+  def __repr__(self):
+    if self._module is None: return '<module %r (not imported yet)>'%(self._name,)
+    return repr(self._module)
+
+def _setup_ROOT():
+  '''Runs once, when ROOT is first used.'''
+  init_env()
+  install_pretty_printers()
+
+ROOT = _LazyModule('ROOT', setup=_setup_ROOT)
+numpy = _LazyModule('numpy')
 
 ################################################################
 # improve readability of ROOT.std.vectors (& pairs, etc)
 # (see a more general attempt on the stl_repr branch)
 _primitive_types_ = ('int','float','ROOT.double','bool','ROOT.std.string')
-for primitive_type in _primitive_types_:
-  ROOT.std.vector(eval(primitive_type)).__str__ = lambda t: 'std::vector'+tuple(t).__str__()
-  ROOT.std.vector(eval(primitive_type)).__repr__ = lambda t: 'std::vector'+tuple(t).__repr__()
-  for other_primitive_type in _primitive_types_:
-    ROOT.std.pair(
-      eval(primitive_type),
-      eval(other_primitive_type)
-    ).__str__ = lambda t: 'std::pair(%s,%s)'%(str(t[0]),str(t[1]))
-    ROOT.std.pair(
-      eval(primitive_type),
-      eval(other_primitive_type)
-    ).__repr__ = lambda t: 'std::pair(%s,%s)'%(str(t[0]),str(t[1]))
+_pretty_printers_installed = False
+def install_pretty_printers():
+  '''Make std::vectors and std::pairs of primitive types print their data.
+  
+  This is done automatically when ROOT is first used (so any ROOT object 
+    magicdump() gets already prints this way).
+  '''
+  global _pretty_printers_installed
+  if _pretty_printers_installed: return
+  _pretty_printers_installed = True
+  for primitive_type in _primitive_types_:
+    ROOT.std.vector(eval(primitive_type)).__str__ = lambda t: 'std::vector'+tuple(t).__str__()
+    ROOT.std.vector(eval(primitive_type)).__repr__ = lambda t: 'std::vector'+tuple(t).__repr__()
+    for other_primitive_type in _primitive_types_:
+      ROOT.std.pair(
+        eval(primitive_type),
+        eval(other_primitive_type)
+      ).__str__ = lambda t: 'std::pair(%s,%s)'%(str(t[0]),str(t[1]))
+      ROOT.std.pair(
+        eval(primitive_type),
+        eval(other_primitive_type)
+      ).__repr__ = lambda t: 'std::pair(%s,%s)'%(str(t[0]),str(t[1]))
 
 
 ################################################################
@@ -200,12 +229,98 @@ autoload_headers = ['gallery/ValidHandle.h']
 ################################################################
 
 
+_dump_plans = {} # (type,options) -> [(name,is_method),...]
+
+def _public_data_members(cppname):
+  '''Returns names of public, non-static data members (incl. bases), or None.'''
+  klass = ROOT.TClass.GetClass(cppname)
+  if not klass or not klass.GetListOfDataMembers(): return None
+  names = []
+  for base in klass.GetListOfBases():
+    names += _public_data_members(base.GetName()) or []
+  for data_member in klass.GetListOfDataMembers():
+    if data_member.Property() & ROOT.kIsStatic: continue
+    if not data_member.Property() & ROOT.kIsPublic: continue
+    names += [ data_member.GetName() ]
+  return names
+
+def _dump_plan(obj, exclude_hidden, exclude, methods):
+  '''Which attributes magicdump() shows for objects of this type (cached).
+  
+  For C++ classes known to ROOT: the public data members, from TClass (and 
+    public methods only if methods is True).  For anything else: dir() of
+    the first object of the type.
+  '''
+  key = (type(obj),exclude_hidden,tuple(exclude),methods)
+  plan = _dump_plans.get(key)
+  if plan!=None: return plan
+  cppname = getattr(type(obj),'__cppname__',None) \
+    or getattr(type(obj),'__cpp_name__',None)
+  members = _public_data_members(cppname) if cppname else None
+  if members!=None:
+    plan = [ (name,False) for name in members ]
+    names = dir(obj) if methods else []
+  else: plan,names = [],dir(obj)
+  known = set( name for name,method in plan )
+  for name in names:
+    if name in known: continue
+    attribute = getattr(type(obj),name,None)
+    is_method = callable(attribute) and not isinstance(attribute,type)
+    if members!=None and not is_method: continue
+    plan += [ (name,is_method) ]
+  plan = [ (name,method) for name,method in plan
+    if not (exclude_hidden and name[0]=='_') and name not in exclude ]
+  _dump_plans[key] = plan
+  return plan
+
+_plain_types = (bool,int,long,float,type(None))
+
+def _bounded_repr(value, maxlength):
+  '''str(value), but only about maxlength characters of it are ever built.
+  
+  Containers are walked element by element (and only as far as needed), 
+    instead of converting the whole thing.
+  '''
+  if isinstance(value,_plain_types): text = str(value)
+  elif isinstance(value,basestring): text = value[:maxlength+1]
+  elif hasattr(value,'__len__') and hasattr(value,'__getitem__') \
+      and not hasattr(value,'keys'):
+    cppname = getattr(type(value),'__cppname__',None) \
+      or getattr(type(value),'__cpp_name__',None)
+    parts,length = [],0
+    for item in _first_items(value, maxlength):
+      part = _bounded_repr(item, maxlength-length)
+      parts += [ part ]
+      length += len(part)+2
+      if length>maxlength: break
+    text = '%s(%s%s) [%d]'%(cppname or type(value).__name__,
+      ', '.join(parts),', ...' if length>maxlength or len(parts)<len(value) 
+      else '',len(value))
+  else: text = str(value)
+  if '\n' in text: text = text[:text.index('\n')] + '...'
+  if len(text)>maxlength: text = text[:maxlength] + '...'
+  return text
+
+def _first_items(obj, n):
+  '''The first n items of a container (works without slicing, e.g. TObjArray).'''
+  if n==None: n = len(obj)
+  try: return list(itertools.islice(iter(obj), n))
+  except TypeError: # not iterable, but indexable
+    return [ obj[i] for i in xrange(min(n,len(obj))) ]
+
+def _json_value(value, maxlength):
+  if isinstance(value,_plain_types): return value
+  return _bounded_repr(value, maxlength)
+
 def magicdump(obj, 
     maxlength=65, 
     exclude_hidden=True, 
     exclude=(), 
     detect_iterable=True, 
-    show_N_iter=2
+    show_N_iter=2,
+    out=None,
+    format='text',
+    methods=False,
   ):
   '''Print some of an object's attributes (version 2017-05-05).
   
@@ -215,61 +330,666 @@ def magicdump(obj,
   exclude_hidden: exclude _things_ and __stuff__ (default=True)
   exclude: skip attribs with names in this list (default=())
   detect_iterable: descend into iterable objects (default=True)
-  show_N_iter: how many elements of iterable to show (default=2)
-  '''
-  if detect_iterable and '__len__' in dir(obj):
-    print 'object is an iterable type (%s)'%(type(obj),)
-    print 'length =',len(obj)
-    n_items_to_print = min(show_N_iter,len(obj))
-    print 'first %d items: '%(n_items_to_print,)
-    for i_item,item in enumerate(obj[:n_items_to_print]):
-      print '-'*maxlength
-      print 'item %d:'%(i_item,)
-      magicdump(obj[i_item],
-        maxlength=maxlength, exclude_hidden=exclude_hidden, exclude=exclude, 
-        detect_iterable=False)
-    print '-'*maxlength
-    print '...plus %d more elements not shown...'%(len(obj)-n_items_to_print,)
+  show_N_iter: how many elements of iterable to show (default=2, None=all)
+  out: file to write to (default: sys.stdout)
+  format: 'text', or 'jsonl' for one JSON object per item
+  methods: also list methods of C++ objects (default=False: data members)
+  
+  Which attributes to show is worked out once per type (see _dump_plan()),
+    and no attribute is converted to more than about maxlength characters,
+    so dumping big collections costs about the same per item as small ones.
+  '''
+  if out==None: out = sys.stdout
+  options = dict(maxlength=maxlength, exclude_hidden=exclude_hidden, 
+    exclude=exclude, out=out, format=format, methods=methods)
+  if detect_iterable and hasattr(obj,'__len__') and not isinstance(obj,basestring):
+    items = _first_items(obj, show_N_iter)
+    if format=='jsonl':
+      for item in items: magicdump(item, detect_iterable=False, **options)
+      return
+    print >>out, 'object is an iterable type (%s)'%(type(obj),)
+    print >>out, 'length =',len(obj)
+    print >>out, 'first %d items: '%(len(items),)
+    for i_item,item in enumerate(items):
+      print >>out, '-'*maxlength
+      print >>out, 'item %d:'%(i_item,)
+      magicdump(item, detect_iterable=False, **options)
+    print >>out, '-'*maxlength
+    print >>out, '...plus %d more elements not shown...'%(len(obj)-len(items),)
     return
-  print 'object type: %s\nsome attributes:'%(type(obj),)
-  for attname in dir(obj):
-    
-    # don't print __stuff__ (unless exclude_hidden==False)
-    if exclude_hidden==True and attname[0]=='_': continue
-    
-    # don't print excluded stuff
-    if attname in exclude: continue
-    
-    att = obj.__getattribute__(attname) # fetch attribute
-    str_rep = str(att) # make a string representation for attribute
+  plan = _dump_plan(obj, exclude_hidden, exclude, methods)
+  if format=='jsonl':
+    record = {}
+    for attname,is_method in plan:
+      if is_method: continue
+      try: record[attname] = _json_value(getattr(obj,attname), maxlength)
+      except Exception as error: record[attname] = '<%s>'%(error,)
+    print >>out, json.dumps(record)
+    return
+  print >>out, 'object type: %s\nsome attributes:'%(type(obj),)
+  for attname,is_method in plan:
+    try: att = getattr(obj,attname) # fetch attribute
+    except Exception as error:
+      print >>out, '  %s: <%s>'%(attname,error)
+      continue
     
     # if it's a function/method, print its docstring...
-    #if str(type(att)) in ("<type 'instancemethod'>","<type 'builtin_function_or_method'>"):
-    if 'method' in str(type(att)).lower() or 'function' in str(type(att)).lower():
+    if is_method:
       attname = attname+'()'
-      if att.__doc__ != None: str_rep = att.__doc__
+      if att.__doc__ != None: str_rep = _bounded_repr(att.__doc__, maxlength)
       else: str_rep = 'method (with no docstring)' # (...unless it doesn't have a docstring)
+    else: str_rep = _bounded_repr(att, maxlength)
     
-    # truncate at maxlength characters:
-    if len(str_rep)>maxlength: str_rep = str_rep[:maxlength] + '...'
-    
-    # truncate after newline: 
-    if '\n' in str_rep: str_rep = str_rep[:str_rep.index('\n')] + '...'
-    
-    print '  %s: %s'%(attname,str_rep)
+    print >>out, '  %s: %s'%(attname,str_rep)
 ls = magicdump
 
 import os
+import fnmatch
+import bisect
+import time
+import threading
+import Queue
+
+def _is_product_branch(name):
+  '''True for branches holding data products (type_label_instance_process.).'''
+  return name.endswith('.') and name.count('_')>=3
+
+def _no_selection(selection):
+  '''True for None (all events); an empty sequence selects no events.'''
+  return selection is None
+
 def grab_art_files(directory, prefix, suffix='.root'):
-  '''Return list of files matching given conditions.
+  '''Return tuple of files in directory with this prefix and suffix.
+  
+  The files are in natural order (see find_art_files()).
+  '''
+  return tuple(find_art_files(
+    directory, pattern=prefix+'*'+suffix, recursive=False))
+
+def _natural_key(filename):
+  '''Sort key which puts run2 before run10 (digits compare as numbers).'''
+  return [ int(part) if part.isdigit() else part 
+    for part in re.split(r'(\d+)',filename) ]
+
+def find_art_files(top, pattern='*.root', regex=None, recursive=True):
+  '''Return list of files under top matching a glob pattern (and regex).
+  
+  pattern is matched against file names (e.g. 'gm2*_run0123*.root'), regex
+    (if given) is searched for in the full path.  Directories are walked 
+    recursively unless recursive is False.  The files are sorted naturally
+    by file name (run2 before run10), which for the usual art file names is
+    by run and subrun; see Manifest for the runs actually in the files.
+  '''
+  if regex!=None and not hasattr(regex,'search'): regex = re.compile(regex)
+  filenames = []
+  for directory,subdirectories,names in os.walk(top):
+    if not recursive: del subdirectories[:]
+    for name in fnmatch.filter(names,pattern):
+      path = os.path.join(directory,name)
+      if regex==None or regex.search(path): filenames += [ path ]
+  return sorted(filenames, 
+    key=lambda path: (_natural_key(os.path.basename(path)),path))
+
+def _count_entries(filename, treename='Events'):
+  '''Return number of entries in the Events tree of an art file.
+  
+  Only opens the file and reads the tree header (no event data).
+  '''
+  tfile = ROOT.TFile.Open(filename)
+  if not tfile or tfile.IsZombie():
+    raise IOError('Could not open file %s'%(filename,))
+  try:
+    tree = tfile.Get(treename)
+    return tree.GetEntries() if tree else 0
+  finally: tfile.Close()
+
+
+################################################################
+# sidecar files (per-file caches kept next to the file, or in cache_dir)
+
+cache_dir = os.environ.get('HEIST_CACHE_DIR',
+  os.path.join(os.path.expanduser('~'),'.cache','heist'))
+
+def _file_stamp(filename):
+  '''Returns (size,mtime), which is used to notice when a file changes.'''
+  stat = os.stat(filename)
+  return (stat.st_size,stat.st_mtime)
+
+def _sidecar_paths(filename, suffix):
+  '''Returns candidate sidecar paths: next to filename, then in cache_dir.'''
+  key = hashlib.md5(os.path.abspath(filename)).hexdigest()[:12]
+  return (
+    filename+suffix,
+    os.path.join(cache_dir,'%s.%s%s'%(os.path.basename(filename),key,suffix)),
+  )
+
+def _atomic_write(path, write_function):
+  '''Call write_function(fileobj) on a temp file, then rename it to path.
+  
+  Readers never see a partially written file.
+  '''
+  directory = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(directory): os.makedirs(directory)
+  tmp_path = '%s.tmp%d'%(path,os.getpid())
+  try:
+    with open(tmp_path,'wb') as fileobj:
+      write_function(fileobj)
+      fileobj.flush()
+      os.fsync(fileobj.fileno())
+    os.rename(tmp_path,path)
+  except:
+    if os.path.exists(tmp_path): os.remove(tmp_path)
+    raise
+
+def _save_sidecar(filename, suffix, write_function):
+  '''Write a sidecar for filename (first place that works); returns path.'''
+  for path in _sidecar_paths(filename,suffix):
+    try:
+      _atomic_write(path,write_function)
+      return path
+    except (IOError,OSError): continue
+  return None
+
+def _load_sidecar(filename, suffix, load):
+  '''Returns load(path) for the first sidecar of filename that is valid.
+  
+  load(path) returns None for a stale sidecar (and may raise for an 
+    unreadable one), so a stale sidecar next to the file does not hide a 
+    valid one in cache_dir.  Returns None if no sidecar is valid.
+  '''
+  for path in _sidecar_paths(filename,suffix):
+    if not os.path.exists(path): continue
+    try: value = load(path)
+    except Exception: continue # unreadable: try the next one
+    if value is not None: return value
+  return None
+
+
+################################################################
+# product catalog (from branch metadata only)
+
+import cPickle as pickle
+
+def _read_catalog(filename):
+  '''Returns a list of catalog records for the product branches of a file.'''
+  tfile = ROOT.TFile.Open(filename)
+  if not tfile or tfile.IsZombie():
+    raise IOError('Could not open file %s'%(filename,))
+  try:
+    tree = tfile.Get('Events')
+    records = []
+    if not tree: return records
+    for branch in tree.GetListOfBranches():
+      if not _is_product_branch(branch.GetName()): continue
+      class_name = branch.GetClassName()
+      records += [ {
+        'name': branch.GetName().rstrip('.'),
+        'class_name': class_name,
+        'product_type': _unwrap_class_name(class_name),
+        'entries': int(branch.GetEntries()),
+        'total_size': int(branch.GetTotalSize()),
+        'tot_bytes': int(branch.GetTotBytes('*')),
+        'zip_bytes': int(branch.GetZipBytes('*')),
+      } ]
+    return records
+  finally: tfile.Close()
+
+def _unwrap_class_name(class_name):
+  '''Returns T for 'art::Wrapper<T>' (and class_name otherwise).'''
+  name = class_name.strip()
+  if name.startswith('art::Wrapper<') and name.endswith('>'):
+    name = name[len('art::Wrapper<'):-1].strip()
+  return name
+
+_catalog_cache = {} # filename -> (stamp,records)
+def _load_file_catalog(filename, rebuild=False, backend='gallery'):
+  '''Returns catalog records of a file (from memory, sidecar, or the file).'''
+  stamp = _file_stamp(filename)
+  if not rebuild and _catalog_cache.get(filename,(None,))[0]==stamp:
+    return _catalog_cache[filename][1]
+  def load(path):
+    with open(path) as fileobj: sidecar = json.load(fileobj)
+    if tuple(sidecar['stamp'])!=stamp: return None
+    return [ # (json gives unicode strings)
+      dict( (str(k),str(v) if isinstance(v,unicode) else v) 
+        for k,v in record.items() )
+      for record in sidecar['records']
+    ]
+  records = None if rebuild else \
+    _load_sidecar(filename, ProductCatalog.sidecar_suffix, load)
+  if records==None:
+    records = _read_catalog(filename) if backend=='gallery' \
+      else _read_catalog_uproot(filename)
+    _save_sidecar(filename, ProductCatalog.sidecar_suffix,
+      lambda fileobj: json.dump({'stamp':stamp,'records':records},fileobj))
+  _catalog_cache[filename] = (stamp,records)
+  return records
+
+def _format_catalog_record(record):
+  '''One line for ls(): entries, compressed bytes/entry, name.'''
+  per_entry = float(record['zip_bytes'])/record['entries'] \
+    if record['entries']>0 else 0.
+  return '%8d entries %10.1f B/entry  %s'%(
+    record['entries'],per_entry,record['name'])
+
+class ProductCatalog(object):
+  '''The data products in a list of art files, from branch metadata only.
+  
+  Each record is a dict with
+    name: branch ('friendly') name, e.g. 'ns::FooArtRecords_mod_inst_proc'
+    class_name: e.g. 'art::Wrapper<vector<ns::FooArtRecord> >'
+    product_type: e.g. 'vector<ns::FooArtRecord>'
+    entries, total_size, tot_bytes, zip_bytes: summed over files
+  
+  The records of each file are kept in memory and in a sidecar file 
+    (filename+sidecar_suffix, or in heist.cache_dir), and are rebuilt when 
+    the size or mtime of the file changes.
+  '''
+  sidecar_suffix = '.heistcat.json'
+  
+  def __init__(self, filenames, rebuild=False, backend='gallery'):
+    if type(filenames)==str: filenames = [ filenames ]
+    self.filenames = list(filenames)
+    self._records = []
+    by_name = {}
+    for filename in self.filenames:
+      for record in _load_file_catalog(filename,rebuild,backend):
+        if record['name'] not in by_name:
+          by_name[record['name']] = dict(record)
+          self._records += [ by_name[record['name']] ]
+          continue
+        for key in ('entries','total_size','tot_bytes','zip_bytes'):
+          by_name[record['name']][key] += record[key]
+    self._by_name = by_name
+  
+  def __len__(self): return len(self._records)
+  def __contains__(self, name): return name.rstrip('.') in self._by_name
+  def __getitem__(self, name): return self._by_name[name.rstrip('.')]
+  
+  def records(self, pattern=None, regex=None):
+    '''Returns records, optionally filtered.
+    
+    pattern: case-insensitive substring of the name
+    regex: regular expression (re.search) on the name
+    '''
+    if pattern!=None and regex!=None:
+      raise ValueError('Do not specify "pattern" AND "regex"!')
+    if pattern!=None:
+      return [ r for r in self._records if pattern.lower() in r['name'].lower() ]
+    if regex!=None:
+      regex = re.compile(regex)
+      return [ r for r in self._records if regex.search(r['name']) ]
+    return list(self._records)
+  
+  def product_types(self):
+    '''Returns the C++ types of all products (sorted, without duplicates).'''
+    return sorted(set( r['product_type'] for r in self._records ))
+
+
+################################################################
+# (run,subrun,event) index
+
+def _scan_event_ids(filename):
+  '''Return [(run,subrun,event),...] for every entry of an art file.
+  
+  Only the EventAuxiliary is read (no data products).
+  '''
+  filename_vector = ROOT.vector(ROOT.string)()
+  filename_vector.push_back(filename)
+  gallery_event = ROOT.gallery.Event(filename_vector)
+  ids = []
+  while not gallery_event.atEnd():
+    event_id = gallery_event.eventAuxiliary().id()
+    ids += [ (event_id.run(),event_id.subRun(),event_id.event()) ]
+    gallery_event.next()
+  return ids
+
+def _load_file_index(filename, rebuild=False, quiet=True, backend='gallery'):
+  '''Returns (n,3) array of event IDs of a file, using a sidecar if valid.'''
+  stamp = _file_stamp(filename)
+  def load(path):
+    with numpy.load(path) as sidecar:
+      if tuple(sidecar['stamp'])==stamp: return sidecar['ids']
+  ids = None if rebuild else \
+    _load_sidecar(filename, EventIndex.sidecar_suffix, load)
+  if ids is not None: return ids
+  if not quiet: print 'Building event index for %s...'%(filename,)
+  if backend=='gallery':
+    ids = numpy.array(_scan_event_ids(filename),dtype='int64').reshape(-1,3)
+  else:
+    tree = _uproot_tree(filename)
+    ids = _uproot_event_ids(tree,0,_uproot_num_entries(tree))
+  _save_sidecar(filename, EventIndex.sidecar_suffix,
+    lambda fileobj: numpy.savez(fileobj, ids=ids, stamp=numpy.array(stamp)))
+  return ids
+
+_entries_suffix = '.heistn.json'
+def _load_entry_count(filename, backend='gallery'):
+  '''Returns the number of events of a file, using a sidecar if valid.
+  
+  A valid event index sidecar (see EventIndex) has the count too; otherwise
+    the Events tree header is read once and the count is kept in its own 
+    small sidecar, so it is only read again if the file changes.
+  '''
+  stamp = _file_stamp(filename)
+  def load_index(path):
+    with numpy.load(path) as sidecar:
+      if tuple(sidecar['stamp'])==stamp: return len(sidecar['ids'])
+  def load_count(path):
+    with open(path) as fileobj: sidecar = json.load(fileobj)
+    if tuple(sidecar['stamp'])==stamp: return sidecar['entries']
+  entries = _load_sidecar(filename, EventIndex.sidecar_suffix, load_index)
+  if entries==None: 
+    entries = _load_sidecar(filename, _entries_suffix, load_count)
+  if entries!=None: return entries
+  if backend=='gallery': entries = _count_entries(filename)
+  else: entries = _uproot_num_entries(_uproot_tree(filename))
+  _save_sidecar(filename, _entries_suffix, lambda fileobj: 
+    json.dump({'stamp':list(stamp), 'entries':int(entries)}, fileobj))
+  return entries
+
+def _sample_range(rng, size, n):
+  '''n distinct random integers from [0,size) (all of them if n>=size).
+  
+  Memory is O(n) when n is much smaller than size.
+  '''
+  if n>=size: return numpy.arange(size)
+  if n==0: return numpy.zeros(0,dtype='int64')
+  if 4*n>size: return rng.permutation(size)[:n]
+  drawn = numpy.zeros(0,dtype='int64')
+  while True:
+    draws = numpy.concatenate([drawn,rng.randint(0,size,size=n)])
+    unique,first = numpy.unique(draws, return_index=True)
+    drawn = draws[numpy.sort(first)] # distinct, in the order drawn
+    if len(drawn)>=n: return drawn[:n]
+
+def _allocate(n, sizes, allocation='proportional'):
+  '''Split n between strata of these sizes (largest remainders; capped).'''
+  sizes = numpy.asarray(sizes, dtype='int64')
+  counts = numpy.zeros(len(sizes), dtype='int64')
+  remaining = min(n, int(sizes.sum()))
+  while remaining>0:
+    room = sizes-counts
+    open_strata = room>0
+    if allocation=='proportional': weights = numpy.where(open_strata,sizes,0)
+    elif allocation=='equal': weights = open_strata.astype('int64')
+    else: raise ValueError('allocation should be "proportional" or "equal"')
+    share = remaining*weights/float(weights.sum())
+    add = numpy.minimum(numpy.floor(share).astype('int64'), room)
+    left = remaining-add.sum()
+    if left>0: # largest remainders get one more
+      for i in numpy.argsort(-(share-numpy.floor(share)), kind='mergesort'):
+        if left==0: break
+        if add[i]<room[i]: 
+          add[i] += 1
+          left -= 1
+    counts += add
+    remaining -= add.sum()
+  return counts
+
+def _id_geq(ids, start):
+  '''Vectorized (run,subrun,event) >= start for an (n,3) array of IDs.
+  
+  start may be shortened, e.g. (run,) or (run,subrun).
+  '''
+  start = tuple(start)
+  if len(start)==0: return numpy.ones(len(ids),dtype=bool)
+  column = ids[:,0]
+  rest = _id_geq(ids[:,1:],start[1:]) if len(start)>1 \
+    else numpy.ones(len(ids),dtype=bool)
+  return (column>start[0]) | ((column==start[0]) & rest)
+
+class EventIndex(object):
+  '''Maps (run,subrun,event) to file and entry for a list of art files.
+  
+  The IDs of each file are stored in a sidecar file (filename+sidecar_suffix,
+    or in heist.cache_dir if the file's directory is not writable) and are
+    rebuilt when the size or mtime of the file changes.
+  
+  Attributes (one element per entry, in file/entry order):
+    ids: (n,3) array of (run,subrun,event)
+    file_index: index of the file in filenames
+    entry: entry number within that file
+  '''
+  sidecar_suffix = '.heistidx.npz'
+  
+  def __init__(self, filenames, rebuild=False, quiet=True, backend='gallery'):
+    if type(filenames)==str: filenames = [ filenames ]
+    self.filenames = list(filenames)
+    per_file = [ 
+      _load_file_index(f,rebuild,quiet,backend) for f in self.filenames ]
+    self.entries_per_file = [ len(ids) for ids in per_file ]
+    self.ids = numpy.concatenate(
+      per_file+[numpy.zeros((0,3),dtype='int64')] )
+    self.file_index = numpy.repeat(
+      numpy.arange(len(per_file)), self.entries_per_file )
+    self.entry = numpy.concatenate(
+      [numpy.arange(n) for n in self.entries_per_file]+[numpy.zeros(0,'int64')] )
+    self._lookup = None
+  
+  def __len__(self): return len(self.ids)
+  
+  def find(self, run, subrun, event):
+    '''Returns position (from 0, over all files) of an event ID, or None.'''
+    if self._lookup==None:
+      self._lookup = {}
+      for i_entry,event_id in enumerate(map(tuple,self.ids.tolist())):
+        self._lookup.setdefault(event_id,i_entry) # first occurrence wins
+    return self._lookup.get((run,subrun,event))
+  
+  def locate(self, position):
+    '''Returns (file index, entry) for a position from find() or select().'''
+    return int(self.file_index[position]),int(self.entry[position])
+  
+  def select(self, start=(), stop=None):
+    '''Returns positions (sorted) of IDs with start <= ID < stop.
+    
+    start and stop are (run,subrun,event) tuples, which may be shortened, 
+      e.g. select((5,),(6,)) gives all of run 5.
+    '''
+    mask = _id_geq(self.ids,start)
+    if stop!=None: mask &= ~_id_geq(self.ids,stop)
+    return numpy.flatnonzero(mask)
+
+
+################################################################
+# dataset manifest: what is in each file, without opening it again
+
+def _scan_file(filename, backend='gallery', quiet=True):
+  '''Returns the Manifest record of a file (uses the index and catalog).'''
+  size,mtime = _file_stamp(filename)
+  ids = _load_file_index(filename, quiet=quiet, backend=backend)
+  subruns = sorted(set( (int(r),int(s)) for r,s in ids[:,:2].tolist() ))
+  return {
+    'size': size, 'mtime': mtime, 'events': len(ids),
+    'runs': [int(ids[:,0].min()),int(ids[:,0].max())] if len(ids)>0 else [],
+    'first': [ int(i) for i in ids[0] ] if len(ids)>0 else [],
+    'last': [ int(i) for i in ids[-1] ] if len(ids)>0 else [],
+    'subruns': [ list(subrun) for subrun in subruns ],
+    'product_types': sorted(set( str(record['product_type']) 
+      for record in _load_file_catalog(filename, backend=backend) )),
+  }
+
+class Manifest(object):
+  '''Per-file metadata of a dataset, cached in one JSON file.
+  
+  For each file: size, mtime, number of events, run range, first and last
+    (run,subrun,event), (run,subrun)s and product types.  Files are only
+    opened when they are new or changed (size/mtime), so on later job 
+    starts the manifest of tens of thousands of files loads in a moment.
+  
+  path: the JSON file (default: manifest.json in cache_dir).  It can be 
+    shared by several datasets and jobs; entries are keyed by absolute path
+    and saving merges with what other jobs saved in the meantime.
+  
+  Example:
+    manifest = heist.Manifest(heist.find_art_files('/data/run3'))
+    reader = heist.ArtFileReader(manifest.select(runs=(15000,15999)))
+  '''
+  def __init__(self, filenames, path=None, backend='gallery', rebuild=False,
+      quiet=True
+    ):
+    if type(filenames)==str: filenames = [ filenames ]
+    self.path = path if path!=None else os.path.join(cache_dir,'manifest.json')
+    self.filenames = list(filenames)
+    self.records = {}
+    cached = {} if rebuild else self._load()
+    changed = 0
+    for filename in self.filenames:
+      key = os.path.abspath(filename)
+      record = cached.get(key)
+      if record==None or (record['size'],record['mtime'])!=_file_stamp(filename):
+        if not quiet: print 'Manifest: scanning %s'%(filename,)
+        record = _scan_file(filename, backend, quiet)
+        changed += 1
+      self.records[filename] = record
+    if changed>0: self.save()
+  
+  def _load(self):
+    try:
+      with open(self.path) as fileobj: 
+        return json.load(fileobj)['files']
+    except (IOError,OSError,ValueError,KeyError): return {}
+  
+  def save(self):
+    '''Write the records (merged with the current file) to path.'''
+    files = self._load()
+    for filename,record in self.records.items():
+      files[os.path.abspath(filename)] = record
+    try: _atomic_write(self.path, lambda fileobj: 
+      json.dump({'version':1, 'files':files}, fileobj))
+    except (IOError,OSError): pass # read-only: just don't cache
+  
+  def __len__(self): return len(self.filenames)
+  def __getitem__(self, filename): return self.records[filename]
+  
+  def events(self, filename): return self.records[filename]['events']
+  def total_events(self): 
+    return sum( record['events'] for record in self.records.values() )
+  
+  def product_types(self):
+    '''Returns sorted product types found in any of the files.'''
+    types = set()
+    for record in self.records.values(): types.update(record['product_types'])
+    return sorted(types)
+  
+  def select(self, runs=None, subruns=None, product_type=None):
+    '''Returns filenames, sorted by their first (run,subrun,event).
+    
+    runs=(first,last): files with any events in this (inclusive) run range
+    subruns: files with any of these (run,subrun)s
+    product_type: files with this product type (e.g. a C++ type name)
+    Files without events are left out when selecting by runs or subruns.
+    '''
+    if subruns!=None: subruns = set( tuple(subrun) for subrun in subruns )
+    selected = []
+    for filename in self.filenames:
+      record = self.records[filename]
+      if runs!=None and not (record['runs'] and 
+          record['runs'][0]<=runs[1] and record['runs'][1]>=runs[0]):
+        continue
+      if subruns!=None and not any( 
+          tuple(subrun) in subruns for subrun in record['subruns'] ):
+        continue
+      if product_type!=None and product_type not in record['product_types']:
+        continue
+      selected += [ filename ]
+    return sorted(selected, 
+      key=lambda f: (self.records[f]['first'] or [-1],_natural_key(f)))
+
+
+
+
+################################################################
+# product presence: which entries of a file have which products
+
+_read_present_code = '''
+namespace heist_jit {
+void read_present(TBranch* branch, std::vector<int>& out) {
+  TLeaf* leaf = (TLeaf*)branch->GetListOfLeaves()->At(0);
+  Long64_t n = branch->GetEntries();
+  out.reserve(n);
+  for (Long64_t i=0; i<n; ++i) {
+    branch->GetEntry(i);
+    out.push_back(leaf->GetValue()!=0);
+  }
+}
+}
+'''
+
+def _read_presence(filename, branch_names):
+  '''Returns {branch name: bool array of entries with the product}.'''
+  tfile = ROOT.TFile.Open(filename)
+  if not tfile or tfile.IsZombie(): 
+    raise IOError('Could not open %s'%(filename,))
+  try:
+    tree = tfile.Get('Events')
+    n_entries = tree.GetEntries() if tree else 0
+    presence = {}
+    for name in branch_names:
+      branch = tree.GetBranch(name) if tree else None
+      if not branch: 
+        presence[name] = numpy.zeros(n_entries,dtype=bool)
+        continue
+      present = tree.GetBranch(name+'present')
+      if not present: # not a split art::Wrapper: assume always there
+        presence[name] = numpy.ones(n_entries,dtype=bool)
+        continue
+      _jit_declare(_read_present_code)
+      tree.SetBranchStatus('*',0)
+      tree.SetBranchStatus(name+'present',1)
+      out = ROOT.std.vector('int')()
+      ROOT.heist_jit.read_present(present, out)
+      presence[name] = _vector_to_numpy(out,'int32').astype(bool)
+    return presence
+  finally: tfile.Close()
+
+def _read_presence_uproot(filename, branch_names):
+  '''Like _read_presence(), with uproot.'''
+  tree = _uproot_tree(filename)
+  branches = _uproot_branches(tree)
+  n_entries = _uproot_num_entries(tree)
+  presence = {}
+  for name in branch_names:
+    if name not in branches:
+      presence[name] = numpy.zeros(n_entries,dtype=bool)
+    elif name+'present' not in branches:
+      presence[name] = numpy.ones(n_entries,dtype=bool)
+    else: presence[name] = _uproot_jagged(
+      branches[name+'present'],0,n_entries)[1].astype(bool)
+  return presence
+
+_presence_suffix = '.heistpresence.npz'
+
+def _load_file_presence(filename, branch_names, rebuild=False, 
+    backend='gallery'
+  ):
+  '''Returns presence of products (see _read_presence()), using a sidecar.
   
-  TODO: this could be more powerful...
+  The sidecar keeps every branch read so far, so asking for one more 
+    product only reads that product's 'present' flags.
   '''
-  filename_list = []
-  for filename in os.listdir(directory):
-    if filename[:len(prefix)]==prefix and filename[-len(suffix):]==suffix:
-      filename_list += [ os.path.join(directory,filename) ]
-  return tuple(filename_list)
+  stamp = _file_stamp(filename)
+  def load(path):
+    with numpy.load(path) as sidecar:
+      if tuple(sidecar['stamp'])!=stamp: return None
+      names = json.loads(str(sidecar['names']))
+      return dict( (str(name),sidecar['p%d'%i].astype(bool)) 
+        for i,name in enumerate(names) )
+  presence = {} if rebuild else \
+    _load_sidecar(filename, _presence_suffix, load) or {}
+  missing = [ name for name in branch_names if name not in presence ]
+  if len(missing)>0:
+    read = _read_presence if backend=='gallery' else _read_presence_uproot
+    presence.update(read(filename,missing))
+    names = sorted(presence)
+    arrays = dict( ('p%d'%i,presence[name]) for i,name in enumerate(names) )
+    _save_sidecar(filename, _presence_suffix, lambda fileobj: numpy.savez(
+      fileobj, stamp=numpy.array(stamp), names=numpy.array(json.dumps(names)),
+      **arrays))
+  return presence
+
+
 
 
 # useful functions from Marc Paterno
@@ -284,48 +1004,593 @@ def provide_get_valid_handle(klass):
 
 
 # I"m not sure exactly what I really want to do with the next few functions...
-loaded_headers = []
+loaded_headers = set()
 def _do_load_header(filename):
-  global loaded_headers
   if filename in loaded_headers:
     #print 'skipping %s as it is already loaded...'%(filename,)
     return 0
   retval = read_header(filename)
-  if retval==0: loaded_headers += [ filename ]
+  if retval==0: loaded_headers.add(filename)
   else: 
     print 'FAILED to load header %s...?'%(filename,)
     print 'read_header returned',retval
   return retval
 
-loaded_handle_Ttypes = []
+_std_names = ('vector','map','set','pair','string','list','deque','array')
+def _normalize_type(cppname):
+  '''Spell a C++ type one way (e.g. 'vector<A<B> >' and 'vector<A<B>>').
+  
+  Names from the std library get their std:: (ROOT leaves it out), so the
+    result can be used in code compiled outside cling.
+  '''
+  name = re.sub(r'\s*([<>,])\s*', r'\1', cppname.strip())
+  name = re.sub(r'(?<![\w:])(%s)\b'%('|'.join(_std_names),), r'std::\1', name)
+  return re.sub(r'>(?=>)', '> ', name) # (for C++03 compilers)
+
+loaded_handle_Ttypes = set()
 def _do_declare_Ttype(Ttype):
-  global loaded_handle_Ttypes
+  Ttype = _normalize_type(Ttype)
   if Ttype in loaded_handle_Ttypes:
     #print 'skipping %s as it is already declared...'%(Ttype,)
     return 0
   retval = provide_get_valid_handle(Ttype)
-  if retval==0: loaded_handle_Ttypes += [ Ttype ]
+  if retval==0: loaded_handle_Ttypes.add(Ttype)
   else: 
-    print 'FAILED to declare ValidHandle Template type...?'%(Ttype,)
+    print 'FAILED to declare ValidHandle Template type %s...?'%(Ttype,)
     print 'provide_get_valid_handle returned',retval
   return retval
 
+handle_cache = True # keep compiled getValidHandle<T>s in cache_dir
+
+def _product_headers(handle_Ttypes):
+  '''Headers declaring the classes in these types (from their dictionaries).
+  
+  E.g. for 'std::vector<gm2calo::CrystalHitArtRecord>', the header of 
+    CrystalHitArtRecord as well as <vector>.
+  '''
+  headers = []
+  for Ttype in handle_Ttypes:
+    for name in re.findall(r'[A-Za-z_][\w:]*', Ttype):
+      tclass = ROOT.TClass.GetClass(name)
+      header = tclass.GetDeclFileName() if tclass else ''
+      if header and header not in headers: headers += [ header ]
+  return headers
+
+def _handle_code(headers, handle_Ttypes):
+  '''C++ code which includes headers and instantiates getValidHandle<T>s.
+  
+  It stands on its own (it includes gallery/Event.h and the headers of the
+    products), so it also builds outside cling.
+  '''
+  headers = [ h for h in ['gallery/Event.h'] if h not in headers ]+list(headers)
+  lines = [ '#include "%s"'%(header,) for header in headers ]
+  lines += [
+    'template gallery::ValidHandle<%(name)s> '
+    'gallery::Event::getValidHandle<%(name)s>(art::InputTag const&) const;'%{
+      'name':Ttype}
+    for Ttype in handle_Ttypes
+  ]
+  return '\n'.join(lines)+'\n'
+
+def _load_handle_library(headers, handle_Ttypes):
+  '''Compile (or just load, if done before) the code for these types.
+  
+  The code goes to a header in cache_dir named after its hash, and ACLiC 
+    builds a library next to it.  ACLiC only rebuilds when the header is 
+    newer than the library, so later sessions simply load it.  A build 
+    that failed leaves a '.failed' file, so it is not tried again for the
+    same code.
+  '''
+  code = _handle_code(headers, handle_Ttypes)
+  path = os.path.join(cache_dir, _jit_name('heist_handles',code)+'.h')
+  if os.path.exists(path+'.failed'): return False
+  try:
+    if not os.path.exists(path):
+      _atomic_write(path, lambda fileobj: fileobj.write(code))
+  except (IOError,OSError): return False
+  if ROOT.gSystem.CompileMacro(path,'kO','',cache_dir)==1: return True
+  try: _atomic_write(path+'.failed', lambda fileobj: fileobj.write(code))
+  except (IOError,OSError): pass
+  return False
+
+def declare_handle_types(handle_Ttypes, headers=(), persist=None):
+  '''Declare getValidHandle<T> for many types T in one go.
+  
+  All headers and instantiations go to cling together, instead of one 
+    ProcessLine each.  With persist (default: heist.handle_cache) they are
+    compiled into a library in heist.cache_dir, so later sessions over the
+    same types skip the JIT work (see _load_handle_library()).
+  
+  If that all fails, each type is declared on its own (see 
+    _do_declare_Ttype()), so one bad type does not spoil the rest.
+  
+  Returns 0 on success (like ProcessLine).
+  '''
+  if persist==None: persist = handle_cache
+  new_Ttypes = sorted(
+    set(_normalize_type(t) for t in handle_Ttypes)-loaded_handle_Ttypes )
+  headers = list(autoload_headers)+list(headers)+[ h 
+    for h in _product_headers(new_Ttypes) if h not in headers ]
+  new_headers = [ h for h in headers if h not in loaded_headers ]
+  if len(new_headers)==0 and len(new_Ttypes)==0: return 0
+  ok = False
+  if persist and len(new_Ttypes)>0:
+    ok = _load_handle_library(headers, new_Ttypes)
+  if not ok:
+    ok = ROOT.gInterpreter.Declare(_handle_code(new_headers, new_Ttypes))
+  if ok:
+    loaded_headers.update(new_headers)
+    loaded_handle_Ttypes.update(new_Ttypes)
+    return 0
+  retval = 0
+  for header in new_headers: retval = _do_load_header(header) or retval
+  for Ttype in new_Ttypes: retval = _do_declare_Ttype(Ttype) or retval
+  return retval
+
 def init_env(
     handle_Ttypes=[], 
     headers=[]
 ):
-  global autoload_headers
+  '''Load autoload_headers+headers and declare ValidHandle<T> types.'''
+  return declare_handle_types(handle_Ttypes, headers)
+
+
+################################################################
+# columnar (bulk) extraction of art records into numpy arrays
+
+# C++ member type -> (C++ buffer element type, numpy dtype)
+#   (bool and char members go through an int buffer, since the data() of
+#   std::vector<bool> and std::vector<char> do not behave like arrays)
+_column_types = {
+  'bool':('int','bool'), 'Bool_t':('int','bool'),
+  'char':('int','int8'), 'Char_t':('int','int8'),
+  'unsigned char':('int','uint8'), 'UChar_t':('int','uint8'),
+  'short':('short','int16'), 'Short_t':('short','int16'),
+  'unsigned short':('unsigned short','uint16'), 'UShort_t':('unsigned short','uint16'),
+  'int':('int','int32'), 'Int_t':('int','int32'),
+  'unsigned int':('unsigned int','uint32'), 'UInt_t':('unsigned int','uint32'),
+  'long':('long','int64'), 'Long_t':('long','int64'),
+  'unsigned long':('unsigned long','uint64'), 'ULong_t':('unsigned long','uint64'),
+  'long long':('long long','int64'), 'Long64_t':('long long','int64'),
+  'unsigned long long':('unsigned long long','uint64'),
+  'ULong64_t':('unsigned long long','uint64'),
+  'size_t':('unsigned long','uint64'),
+  'float':('float','float32'), 'Float_t':('float','float32'),
+  'double':('double','float64'), 'Double_t':('double','float64'),
+}
+_default_column_type = ('double','float64') # anything else (enums, expressions)
+_buffer_dtypes = {
+  'short':'int16', 'unsigned short':'uint16', 'int':'int32',
+  'unsigned int':'uint32', 'long':'int64', 'unsigned long':'uint64',
+  'long long':'int64', 'unsigned long long':'uint64',
+  'float':'float32', 'double':'float64',
+}
+
+_jit_declared = set()
+def _jit_declare(code):
+  '''Declare C++ code to cling (once per distinct code string).'''
+  if code in _jit_declared: return True
+  if not ROOT.gInterpreter.Declare(code):
+    raise RuntimeError('cling could not compile:\n%s'%(code,))
+  _jit_declared.add(code)
+  return True
+
+def _jit_name(prefix, *keys):
+  '''Make a (stable) C++ identifier from some strings.'''
+  return prefix+'_'+hashlib.md5('|'.join(keys)).hexdigest()[:12]
+
+def _vector_value_type(cppname):
+  '''Returns 'T' for 'vector<T>' or 'std::vector<T>', else None.'''
+  name = cppname.strip()
+  if name.startswith('std::'): name = name[5:]
+  if not name.startswith('vector<') or not name.endswith('>'): return None
+  inner = name[len('vector<'):-1].strip()
+  # drop an explicit allocator, i.e. vector<T,allocator<T> >
+  depth = 0
+  for i_char,char in enumerate(inner):
+    if char=='<': depth += 1
+    elif char=='>': depth -= 1
+    elif char==',' and depth==0: return inner[:i_char].strip()
+  return inner
+
+_data_member_cache = {}
+def _data_members(cppname):
+  '''Returns [(name,typename),...] for data members of a class (and bases).
+
+  Uses TClass reflection, so nothing is read from any file.  Returns an
+    empty list if ROOT does not know the class.
+  '''
+  if cppname in _data_member_cache: return _data_member_cache[cppname]
+  members = []
+  klass = ROOT.TClass.GetClass(cppname)
+  if klass:
+    for base in klass.GetListOfBases():
+      members += _data_members(base.GetName())
+    for data_member in klass.GetListOfDataMembers():
+      if data_member.Property() & ROOT.kIsStatic: continue
+      members += [ (data_member.GetName(),data_member.GetTypeName()) ]
+  _data_member_cache[cppname] = members
+  return members
+
+def _vector_to_numpy(vec, dtype, copy=True):
+  '''Make a numpy array from a std::vector of a primitive type in one step.'''
+  array = _data_view(vec, dtype)
+  if copy: array = array.copy()
+  return array
+
+
+class JaggedColumns(object):
+  '''Flat per-element numpy arrays plus per-event offsets.
+
+  The elements belonging to event i are
+    columns[member][offsets[i]:offsets[i+1]]
+  and ids[i] is the (run,subrun,event) of event i.  Products which are not
+    collections contribute exactly one element per event.
+  '''
+  def __init__(self, columns, offsets, ids):
+    self.columns = columns
+    self.offsets = numpy.asarray(offsets, dtype='int64')
+    self.ids = numpy.asarray(ids, dtype='int64').reshape(-1,3)
+
+  def __len__(self): return len(self.offsets)-1
+  def __getitem__(self, member): return self.columns[member]
+  def __contains__(self, member): return member in self.columns
+  def keys(self): return self.columns.keys()
+
+  def counts(self):
+    '''Returns number of elements in each event.'''
+    return numpy.diff(self.offsets)
+
+  def event_index(self):
+    '''Returns, for each element, the index of the event it belongs to.'''
+    return numpy.repeat(numpy.arange(len(self)), self.counts())
+
+  def event(self, i_event):
+    '''Returns {member:array} for the elements of a single event.'''
+    start,stop = self.offsets[i_event],self.offsets[i_event+1]
+    return dict( (m,c[start:stop]) for m,c in self.columns.items() )
+
+  def take(self, indices):
+    '''Returns JaggedColumns with only the events at these indices.'''
+    indices = numpy.asarray(indices, dtype='int64')
+    counts = self.counts()[indices]
+    offsets = numpy.concatenate([[0],numpy.cumsum(counts)]).astype('int64')
+    elements = numpy.arange(offsets[-1]) + numpy.repeat(
+      self.offsets[indices]-offsets[:-1], counts)
+    columns = dict( (m,c[elements]) for m,c in self.columns.items() )
+    return JaggedColumns(columns, offsets, self.ids[indices])
+  
+  @classmethod
+  def concatenate(cls, parts, members=()):
+    '''Join JaggedColumns (e.g. chunks) into one.'''
+    parts = list(parts)
+    if len(parts)==0:
+      return cls(dict( (m,numpy.zeros(0)) for m in members ), [0], ())
+    columns = dict(
+      (m,numpy.concatenate([p.columns[m] for p in parts]))
+      for m in parts[0].columns
+    )
+    offsets,start = [numpy.zeros(1,dtype='int64')],0
+    for part in parts:
+      offsets += [ part.offsets[1:]+start ]
+      start += part.offsets[-1]
+    ids = numpy.concatenate([p.ids for p in parts])
+    return cls(columns, numpy.concatenate(offsets), ids)
+
+
+class ColumnFiller(object):
+  '''Copies members of art records into C++ buffers, one product per call.
+
+  The per-element loop is JIT-compiled (once per product type and list of
+    members), so Python only does a constant amount of work per event.
+
+  members are names of data members of the record (e.g. 'energy'), or
+    C++ expressions evaluated on each record (e.g. 'island.key()').  Data
+    members keep their C++ type; anything else is stored as double, unless
+    types gives its C++ type (e.g. {'island.key()':'size_t'}).
+  '''
+  def __init__(self, cppname, members, types=None):
+    if len(members)==0: raise ValueError('Specify at least one member!')
+    self.cppname = cppname
+    self.members = list(members)
+    value_type = _vector_value_type(cppname)
+    self.is_collection = value_type!=None
+    self.record_type = value_type if self.is_collection else cppname
+    member_types = dict(_data_members(self.record_type))
+    if types!=None: member_types.update(types)
+    self.column_types = [
+      _column_types.get(member_types.get(m),_default_column_type)
+      for m in self.members
+    ]
+    self.function = self._compile()
+    self.reset()
+
+  def _compile(self):
+    name = _jit_name('fill', self.cppname, 
+      *(self.members+[t for t,dtype in self.column_types]))
+    arguments = ''.join(
+      ', std::vector<%s>& b%d'%(buffer_type,i_member)
+      for i_member,(buffer_type,dtype) in enumerate(self.column_types)
+    )
+    pushes = ''.join(
+      '    b%d.push_back(x.%s);\n'%(i_member,member)
+      for i_member,member in enumerate(self.members)
+    )
+    loop = 'for (auto const& x : product)' if self.is_collection \
+      else 'auto const& x = product;'
+    _jit_declare(
+      'namespace heist_jit {\n'
+      'void %s(%s const& product%s) {\n'
+      '  %s {\n%s  }\n'
+      '}\n}\n'%(name,self.cppname,arguments,loop,pushes)
+    )
+    return getattr(ROOT.heist_jit, name)
+
+  def reset(self):
+    '''Start a new chunk.'''
+    self.buffers = [ ROOT.std.vector(t)() for t,dtype in self.column_types ]
+    self.offsets = [ 0 ]
+    self.ids = []
+
+  def __len__(self): return len(self.offsets)-1
+
+  def fill(self, product, event_id=(0,0,0)):
+    '''Append one event (product=None counts as an event with no elements).'''
+    if product!=None: self.function(product, *self.buffers)
+    self.offsets += [ self.buffers[0].size() ]
+    self.ids += [ event_id ]
+
+  def flush(self):
+    '''Return the current chunk as JaggedColumns and start a new one.'''
+    columns = dict(
+      (m,_vector_to_numpy(b,_buffer_dtypes[t]).astype(dtype,copy=False))
+      for m,b,(t,dtype) in zip(self.members,self.buffers,self.column_types)
+    )
+    retval = JaggedColumns(columns, self.offsets, self.ids)
+    self.reset()
+    return retval
+
+
+_ptr_null_key = 2**64-1 # art::Ptr key of a null Ptr (max size_t)
+
+def _ptr_columns(columns, key, product_id):
+  '''Rename the key/product ID columns of a Ptr; null Ptrs get key -1.'''
+  keys = columns[key]
+  keys = numpy.where(keys==_ptr_null_key, -1, keys.astype('int64'))
+  return JaggedColumns(
+    {'key': keys, 'product_id': columns[product_id].astype('int64')},
+    columns.offsets, columns.ids
+  )
+
+def resolve_ptrs(ptrs, target, product_id=None):
+  '''Returns, for each Ptr, the index of the element it points to in target.
+  
+  ptrs are JaggedColumns from ArtFileReader.get_ptrs(), target are 
+    JaggedColumns of the referenced collection for the same events (e.g.
+    from get_columns() with the same loop arguments).  The result indexes
+    the flat target columns, so e.g. target['energy'][index] is the energy 
+    of the island of each hit.  It is -1 for null Ptrs, Ptrs into other
+    products and keys past the end of the collection.
+  
+  If the Ptrs point into more than one product, pass the ProductID value
+    of the target collection as product_id.
+  '''
+  if len(ptrs)!=len(target) or (ptrs.ids!=target.ids).any():
+    raise ValueError('ptrs and target must be from the same events!')
+  keys = ptrs['key']
+  valid = keys>=0
+  if product_id==None:
+    product_ids = numpy.unique(ptrs['product_id'][valid])
+    if len(product_ids)>1: raise ValueError(
+      'Ptrs point into %d products (%s); which one is target? '
+      '(pass product_id)'%(len(product_ids),list(product_ids)))
+  else: valid &= ptrs['product_id']==product_id
+  event_index = ptrs.event_index()
+  valid &= keys<target.counts()[event_index]
+  return numpy.where(valid, target.offsets[:-1][event_index]+keys, -1)
+
+
+
+
+
+################################################################
+# zero-copy numpy views of std::vector data
+
+import ctypes
+import weakref
+
+# C++ primitive type -> numpy dtype, for views
+#   (not bool or char: vector<bool> has no data(), and char* is a string)
+_view_dtypes = {
+  'short':'int16', 'Short_t':'int16', 'unsigned short':'uint16', 
+  'UShort_t':'uint16', 'int':'int32', 'Int_t':'int32', 
+  'unsigned int':'uint32', 'UInt_t':'uint32', 'long':'int64', 
+  'Long_t':'int64', 'unsigned long':'uint64', 'ULong_t':'uint64', 
+  'long long':'int64', 'Long64_t':'int64', 'unsigned long long':'uint64', 
+  'ULong64_t':'uint64', 'size_t':'uint64', 'float':'float32', 
+  'Float_t':'float32', 'double':'float64', 'Double_t':'float64',
+}
+
+def _cppname(obj):
+  '''C++ type name of a PyROOT object.'''
+  klass = type(obj)
+  return getattr(klass,'__cppname__',None) or getattr(klass,'__cpp_name__')
+
+_data_address_functions = {}
+def _data_address(vec):
+  '''Address of vec.data() as an int (a JIT-compiled helper per type).'''
+  cppname = _cppname(vec)
+  if cppname not in _data_address_functions:
+    name = _jit_name('data_address',cppname)
+    _jit_declare(
+      'namespace heist_jit {\n'
+      'unsigned long long %s(%s const& v) '
+      '{ return reinterpret_cast<unsigned long long>(v.data()); }\n'
+      '}\n'%(name,cppname) )
+    _data_address_functions[cppname] = getattr(ROOT.heist_jit,name)
+  return _data_address_functions[cppname](vec)
+
+def _data_view(vec, dtype, offset=0, stride=None):
+  '''numpy array using the memory of a std::vector (no copy).
+  
+  With offset and stride (bytes), gives one member of each element of a 
+    vector of structs.
+  '''
+  n_items = vec.size()
+  dtype = numpy.dtype(dtype)
+  if stride==None: stride = dtype.itemsize
+  if n_items==0: return numpy.zeros(0, dtype=dtype)
+  nbytes = (n_items-1)*stride+offset+dtype.itemsize
+  memory = (ctypes.c_char*nbytes).from_address(_data_address(vec))
+  return numpy.ndarray(
+    shape=(n_items,), dtype=dtype, buffer=memory, offset=offset, 
+    strides=(stride,) )
+
+def as_array(obj, member=None, copy=False, event=None):
+  '''Returns a numpy array using the memory of a std::vector (no copy).
+  
+  obj is a std::vector of a primitive type (e.g. vector<short>), or a 
+    vector of records if member is the name of a primitive data member of 
+    the record (e.g. as_array(hits,'energy') gives every hit energy, 
+    straight from the records).
+  
+  The array is only valid as long as the vector is: for products, until
+    the event moves on.  If event (a heist.Event) is given, a vector still
+    seen by arrays when the event moves is kept alive for them (its memory 
+    is swapped out of the product, not copied), and with event.strict_views
+    the move fails instead.  Use copy=True for an independent copy.
+  '''
+  cppname = _cppname(obj)
+  value_type = _vector_value_type(cppname)
+  if value_type==None:
+    raise TypeError('as_array() needs a std::vector (got %s)'%(cppname,))
+  if member==None:
+    if value_type not in _view_dtypes: raise TypeError(
+      'No numpy view of %s (try get_columns())'%(cppname,))
+    array = _data_view(obj, _view_dtypes[value_type])
+  else:
+    member_type = dict(_data_members(value_type)).get(member)
+    if member_type not in _view_dtypes: raise TypeError(
+      'No numpy view of %s::%s (try get_columns())'%(value_type,member))
+    klass = ROOT.TClass.GetClass(value_type)
+    array = _data_view(obj, _view_dtypes[member_type],
+      offset=_member_offset(klass,member), stride=klass.Size())
+  if copy: return array.copy()
+  if event!=None: event._register_view(array, obj)
+  return array
+
+_kept_vectors = {} # {id of a weakref to a view's memory: (weakref, vector)}
+
+def _keep_vector(memory, vec):
+  '''Keep vec alive as long as memory (the base of numpy views) is.'''
+  view = weakref.ref(memory, lambda view: _kept_vectors.pop(id(view),None))
+  _kept_vectors[id(view)] = (view,vec)
+
+def _member_offset(klass, member):
+  '''Byte offset of a data member in a class (looking in base classes too).'''
+  data_member = klass.GetDataMember(member)
+  if data_member: return data_member.GetOffset()
+  for base in klass.GetListOfBases():
+    base_class = base.GetClassPointer()
+    if base_class and base_class.GetDataMember(member):
+      return base.GetDelta()+_member_offset(base_class,member)
+  raise AttributeError('%s has no data member %s'%(klass.GetName(),member))
+
+
+
+
+################################################################
+# selection expressions, compiled with cling
+
+_expression_buffers = { # numpy dtype of result -> C++ buffer type
+  'bool':'int', 'int32':'int', 'int64':'long long', 
+  'float32':'float', 'float64':'double',
+}
+_python_operators = [ 
+  (r'\band\b','&&'), (r'\bor\b','||'), (r'\bnot\b','!'),
+  (r'\bTrue\b','true'), (r'\bFalse\b','false'),
+]
+
+def _cpp_expression(expression, members):
+  '''Turn e.g. 'energy > 100 and chi2 < 5' into C++ on a record x.
   
-  # first ensure that the autoload_headers have been loaded
-  for header in autoload_headers+headers:
-    _do_load_header(header)
+  Names of data members get 'x.' in front; 'and', 'or' and 'not' may be 
+    used for '&&', '||' and '!'.
+  '''
+  for pattern,replacement in _python_operators:
+    expression = re.sub(pattern, replacement, expression)
+  return re.sub(r'(?<![\w.])(?<!::)(?<!->)([A-Za-z_]\w*)',
+    lambda match: 'x.'+match.group(1) if match.group(1) in members 
+      else match.group(1),
+    expression)
+
+class Expression(object):
+  '''A cut or derived quantity over the records of a product, in C++.
+  
+  expression is C++ (or Python-like: and/or/not) using the record's data 
+    members by name, e.g. 'energy > 100 and chi2 < 5' or 'x*x + y*y'.  It
+    is JIT-compiled once; calling the Expression on a product (a vector of 
+    records, or one record) evaluates it for every record in one C++ loop 
+    and returns a numpy array (of bools if dtype is 'bool').
+  
+  Use compile_expression() (cached by type and expression) rather than 
+    making these directly.
+  '''
+  def __init__(self, cppname, expression, dtype='float64'):
+    if dtype not in _expression_buffers: raise ValueError(
+      'dtype should be one of %s'%(sorted(_expression_buffers),))
+    self.cppname = cppname
+    self.expression = expression
+    self.dtype = dtype
+    value_type = _vector_value_type(cppname)
+    self.is_collection = value_type!=None
+    self.record_type = value_type if self.is_collection else cppname
+    self.cpp_expression = _cpp_expression(expression,
+      set( name for name,member_type in _data_members(self.record_type) ))
+    self.buffer_type = _expression_buffers[dtype]
+    self.function = self._compile()
+  
+  def _compile(self):
+    name = _jit_name('expr', self.cppname, self.expression, self.dtype)
+    loop = 'for (auto const& x : product)' if self.is_collection \
+      else 'auto const& x = product;'
+    _jit_declare(
+      'namespace heist_jit {\n'
+      'void %s(%s const& product, std::vector<%s>& out) {\n'
+      '  out.clear();\n'
+      '  %s { out.push_back(%s); }\n'
+      '}\n}\n'%(name,self.cppname,self.buffer_type,loop,self.cpp_expression)
+    )
+    return getattr(ROOT.heist_jit, name)
+  
+  def __call__(self, product):
+    '''Returns the expression for each record of product (a numpy array).'''
+    if product is None: return numpy.zeros(0, dtype=self.dtype)
+    out = ROOT.std.vector(self.buffer_type)()
+    self.function(product, out)
+    return _vector_to_numpy(out, _buffer_dtypes[self.buffer_type]).astype(
+      self.dtype, copy=False)
   
-  # ...then declare ValidHandle<T> types
-  if len(handle_Ttypes+handle_Ttypes)>0:
-    for Ttype in handle_Ttypes+handle_Ttypes:
-      _do_declare_Ttype(Ttype)
+  def __repr__(self):
+    return '<heist.Expression %s on %s>'%(self.expression,self.cppname)
+
+_compiled_expressions = {} # (cppname,expression,dtype) -> Expression
+def compile_expression(cppname, expression, dtype='float64'):
+  '''Returns the (cached) Expression for a product type and expression.'''
+  key = (_normalize_type(cppname),expression,dtype)
+  if key not in _compiled_expressions:
+    _compiled_expressions[key] = Expression(key[0], expression, dtype)
+  return _compiled_expressions[key]
+
+def evaluate(product, expression, dtype='float64'):
+  '''Evaluate expression for every record of product (see Expression).
+  
+  Example:
+    mask = heist.evaluate(hits, 'energy > 100 and chi2 < 5', 'bool')
+    r2 = heist.evaluate(hits, 'x*x + y*y')
+  '''
+  return compile_expression(_cppname(product), expression, dtype)(product)
 
-init_env()
 
 
 
@@ -335,17 +1600,41 @@ class ArtFileReader(object):
   
   
   '''
-  def __init__(self, filename=None, skip_initialize=False, quiet=False):
-    '''Set filename(s) (and nothing else?)'''
+  def __init__(self, filename=None, skip_initialize=False, quiet=False,
+      backend='gallery', staging=None
+    ):
+    '''Set filename(s) (and nothing else?)
+    
+    backend: 'gallery' (ROOT+gallery, the default) or 'uproot' (pure Python,
+      see UprootEvent; no ROOT needed)
+    staging: a StagingCache (or True for the default one) to copy the files
+      to local disk, a few files ahead of the event loop, before reading them
+    '''
     if not skip_initialize and not filename: raise RuntimeError(
       'Either provide a filename to ArtFileReader, or set skip_initialize to True'
     )
+    if backend not in ('gallery','uproot'): 
+      raise ValueError('backend should be "gallery" or "uproot"')
+    self.backend = backend
+    self.staging = StagingCache() if staging==True else (staging or None)
     self.quiet = quiet
     self.filename_list = []
     self.evt = None               # heist Event # TODO: deprecate
     self.event = None             # heist Event (new name)
     self.i_event = None             # index (from 0) of this event in full loop
     self.i_loop = None            # loop counter (=i_event if no filtering)
+    self.index = None             # heist EventIndex (see build_index())
+    self._entries_per_file = None
+    self._catalog = None          # heist ProductCatalog (see catalog())
+    self._presence = {}           # filename -> {branch: bool per entry}
+    self._memos = {}              # branch/tag -> ProductMemo (see memoize())
+    self.active_branches = None   # branches to read (None: leave all enabled)
+    self.cache_size = None        # TTreeCache size in bytes (see use_tags())
+    self.learn_events = None      # learn active_branches from this many events
+    self._bytes_read_start = 0
+    self.profiler = None          # heist Profiler (see profile())
+    self.checkpoint_config = None # see checkpoint()
+    self._resume_point = None     # see resume()
     
     self.event_initialized = False
     self.in_loop = False
@@ -353,13 +1642,15 @@ class ArtFileReader(object):
     if filename!=None: self.add_filenames(filename)
     
     if not skip_initialize:
-      _do_declare_Ttype('art::TriggerResults')
+      if backend=='gallery': _do_declare_Ttype('art::TriggerResults')
       self.initialize_event()
       if self.event and not self.quiet:
         print 'Initialized ArtFileReader event at %s'%self.event.get_label()
       
   def add_filenames(self, filename):
     '''Set self.filename_list.'''
+    self._entries_per_file = self.index = self._catalog = None
+    self._presence = {}
     if type(filename)==str:
       self.filename_list += [ filename ]
     elif hasattr(filename, '__iter__'):
@@ -369,80 +1660,847 @@ class ArtFileReader(object):
   
   def initialize_event(self):
     '''Initialize heist.Event (which initializes and stores a gallery::Event).'''
+    if self.backend=='uproot':
+      self.event = self.evt = UprootEvent(self, self.filename_list)
+      self.event_initialized = True
+      return self.event
     filename_vector = ROOT.vector(ROOT.string)()
-    for name in self.filename_list:
+    for name in self._event_filenames():
       filename_vector.push_back(name)
     self.event = Event(self, filename_vector)
     if self.event.gallery_event!=0 and self.event.gallery_event!=None:
       self.event_initialized = True
     self.evt = self.event # TODO: deprecate ArtFileReader.evt (in favor of event)
+    self._bytes_read_start = ROOT.TFile.GetFileBytesRead()
     return self.event
   
-  def event_loop(self, evt_list=(), event_list=(), nmax=None):
-    '''Like generate_event_loop() but filters by event_list.
+  def _event_filenames(self):
+    '''Names of the files as the Event reads them (staged copies, if staging).'''
+    if self.staging==None: return list(self.filename_list)
+    return [ self.staging.local_path(name) for name in self.filename_list ]
+  
+  def _stage(self, i_file):
+    '''Copy file i_file to the staging area (if staging and not there yet).'''
+    if self.staging!=None and 0<=i_file<len(self.filename_list):
+      self.staging.stage(self.filename_list[i_file])
+  
+  def event_loop(self, evt_list=None, event_list=None, nmax=None, select=None,
+      require=()
+    ):
+    '''Yield self.event for every event (or for the selected events).
+    
+    event_list selects events by position in the loop (over all files):
+      * positions, e.g. (0,5,17) or a numpy array of ints (empty: no events)
+      * a slice or xrange, e.g. slice(0,None,10) for every tenth event
+    select(ID) selects events by (run,subrun,event), using the EventIndex
+      (see build_index()), e.g. select=lambda ID: ID[2]%100==0
+    require is a list of tags: only events with all of these products are
+      visited (see presence()).
     
-    ONLY yield when event index is in event_list (yields ALL
-      when event_list is empty (default))
+    Without a selection, events are visited in order with next().  With
+      one, the loop seeks straight to the selected events (in file/entry 
+      order), so nothing is read for the events which are skipped.
     
     NOTE: event_list is ZERO-INDEXED! (e.g. 100 events will have 
       indices 0 through 99)
-    
-    Might work...
+    NOTE: leave event_list out (None) for all events.  An empty event_list 
+      selects NO events (it used to mean all of them), so e.g. an empty 
+      select_IDs() or sample() visits nothing.
     '''
-    if len(evt_list)==0 and len(event_list)>0: evt_list = event_list
-    if len(evt_list)>0 and len(event_list)==0: event_list = evt_list
+    if _no_selection(event_list): event_list = evt_list
     #if not self.product_getters_setup:
     #  print 'event_loop: automatically setting up product getters...'
     #  self.setup_product_getters()
     if not self.event_initialized:
       if not self.quiet: print 'event_loop: automatically initializing heist.Event...'
       self.initialize_event()
-    no_filter = len(event_list)==0
+    positions = self._selected_positions(event_list, select, require)
     self.i_event = self.i_loop = 0
+    start = 0
+    resume,self._resume_point = self._resume_point,None
+    if resume!=None:
+      self.i_event,start = resume['i_event'],resume['position']+1
+      if positions is not None:
+        positions = numpy.asarray(positions)
+        positions = positions[positions>=start]
+    if nmax!=None and self.i_event>=nmax: return
     self.in_loop = True
-    while (not self.event.at_end()):
-      if no_filter or (self.i_loop in event_list): 
+    profiler = self.profiler
+    checkpoint = self.checkpoint_config
+    if checkpoint!=None: checkpoint['last'] = (self.i_event,time.time())
+    if profiler!=None: profiler.start_loop()
+    finished = reached_nmax = False
+    try:
+      for self.i_loop in self._iter_positions(positions, start=start):
+        if profiler!=None: profiler.moved()
         yield self.event
+        if profiler!=None: profiler.consumed()
         self.i_event += 1
-      self.i_loop += 1
-      if nmax!=None and self.i_event >= nmax:
-        if not self.quiet: print 'Reached maximum %d events!'%(nmax,)
-        break
-      self.event.next()
-    self.in_loop = False
+        if checkpoint!=None and self._checkpoint_due(checkpoint):
+          self._write_checkpoint(checkpoint, self.i_loop)
+          if profiler!=None: profiler.checkpointed()
+        if self.learn_events!=None and self.i_event>=self.learn_events:
+          self.use_tags(self.event.used_branches, self.cache_size)
+        if nmax!=None and self.i_event >= nmax:
+          if not self.quiet: print 'Reached maximum %d events!'%(nmax,)
+          reached_nmax = True
+          break
+      finished = True
+    finally:
+      self.in_loop = False
+      if finished and checkpoint!=None:
+        self._write_checkpoint(checkpoint, 
+          self.i_loop if reached_nmax else self.n_entries()-1, 
+          done=not reached_nmax)
+        if profiler!=None: profiler.checkpointed()
+      if profiler!=None: profiler.stop_loop()
   
-  def list_records(self, pattern=None, regex=None):
-    '''Return a list of type_modlabel_instname_procID for TTrees in file.
-    
-    Specify pattern to return only things with pattern as substring (case-
-      insensitive).
+  def _selected_positions(self, event_list, select, require=()):
+    '''Turn event_list, select and require into sorted positions (None: all).'''
+    positions = None
+    if not _no_selection(event_list):
+      if isinstance(event_list,slice):
+        event_list = xrange(*event_list.indices(self.n_entries()))
+      if isinstance(event_list,xrange) and (
+          len(event_list)<2 or event_list[1]>event_list[0]):
+        positions = event_list # already sorted
+      else:
+        positions = numpy.unique(numpy.asarray(list(event_list),dtype='int64'))
+    if select!=None:
+      if self.index==None: self.build_index()
+      selected = numpy.flatnonzero([ 
+        bool(select(event_id)) for event_id in map(tuple,self.index.ids.tolist())
+      ])
+      if positions is not None: selected = numpy.intersect1d(selected,positions)
+      positions = selected
+    if len(require)>0:
+      selected = numpy.flatnonzero(self.presence(require))
+      if positions is not None: 
+        selected = numpy.intersect1d(selected,numpy.asarray(positions))
+      positions = selected
+    return positions
+  
+  def _iter_positions(self, positions, event=None, start=0):
+    '''Move event (default: self.event) to each position, yielding it.
     
-    Specify regex to match by regular expression (UNIMPLEMENTED).
+    Without positions: every position from start on.
     '''
-    if not self.event_initialized:
-      if not self.quiet: print 'list_records: automatically initializing heist.Event...'
-      self.initialize_event()
-    retval = []
-    if pattern==None and regex==None:
-      for b in self.event.gallery_event.getTTree().GetListOfBranches():
-        bname = b.GetName().rstrip('.')
-        if bname=='EventAuxiliary': continue # not an art record
-        retval += [ bname ]
-    elif pattern!=None and regex==None:
-      for b in self.event.gallery_event.getTTree().GetListOfBranches():
-        if pattern.lower() in b.GetName().lower():
-          bname = b.GetName().rstrip('.')
-          if bname=='EventAuxiliary': continue # not an art record
-          retval += [ bname ]
-    elif pattern==None and regex!=None:
-      raise NotImplementedError('DO ALL THE REGEXES!!!1!')
-    else: raise ValueError('Do not specify "pattern" AND "regex"!')
-    return retval
+    if event==None: event = self.event
+    if positions is None:
+      if start>0:
+        if start>=self.n_entries(): return
+        event.seek(*self._locate(start))
+      else: event.to_begin()
+      position = start
+      while not event.at_end():
+        yield position
+        position += 1
+        event.next()
+      return
+    offsets = self._entry_offsets()
+    for position in positions:
+      if position<0 or position>=offsets[-1]: continue
+      i_file = bisect.bisect_right(offsets,position)-1
+      event.seek(i_file,position-offsets[i_file])
+      yield position
   
-  def ls(self, pattern=None, regex=None):
-    '''Prints records from list_records, but more like ls.'''
-    for record in self.list_records(pattern=pattern,regex=regex):
-      print '  '+record
+  def prefetch_loop(self, tags, depth=4, evt_list=None, event_list=None, 
+      nmax=None, select=None, require=()
+    ):
+    '''Like event_loop(), but reads the products of tags in a second thread.
+    
+    A worker thread steps through the same events with its own 
+      gallery::Event, reads the products of tags and copies them (C++ copy
+      constructor), and keeps up to depth events ready in a queue.  So the
+      reading of the next events happens while your code works on this one.
+    
+    Yields PrefetchedEvents, which have get_record() (for these tags only), 
+      get_ID(), get_label() etc. like heist.Event.
+    
+    prefetch_stats has the time spent waiting for the worker (wait_time) 
+      and the total time of the loop (loop_time).  If wait_time is close to
+      loop_time, reading is the bottleneck anyway.
+    
+    NOTE: the worker only runs in parallel while PyROOT releases the GIL, 
+      i.e. inside gallery calls, and only with a PyROOT which supports that
+      (see _release_gil()).
+    '''
+    self._require_gallery('prefetch_loop')
+    if _no_selection(event_list): event_list = evt_list
+    tags = [ intern_tag(tag) for tag in tags ]
+    positions = self._selected_positions(event_list, select, require)
+    if positions is not None: self._entry_offsets() # (not in the worker)
+    ROOT.ROOT.EnableThreadSafety()
+    _release_gil(ROOT.gallery.Event.next, ROOT.gallery.Event.goToEntry)
+    filename_vector = ROOT.vector(ROOT.string)()
+    for name in self._event_filenames(): filename_vector.push_back(name)
+    worker_event = Event(self, filename_vector)
+    active = self.active_branches
+    worker_event.worker_state = {
+      'active_branches': set(active) if active!=None else None,
+      'profiler': Profiler() if self.profiler!=None else None,
+    }
+    
+    queue = Queue.Queue(maxsize=max(1,depth))
+    stop = threading.Event()
+    def put(item):
+      while not stop.is_set():
+        try: return queue.put(item, timeout=0.1)
+        except Queue.Full: continue
+    def work():
+      try:
+        for position in self._iter_positions(positions, worker_event):
+          if stop.is_set(): return
+          put(PrefetchedEvent(position, worker_event, tags))
+        put(None)
+      except Exception:
+        put(_PrefetchError(sys.exc_info()))
+    worker = threading.Thread(target=work, name='heist-prefetch')
+    worker.daemon = True
+    
+    self.prefetch_stats = {'events':0, 'wait_time':0., 'loop_time':0.}
+    self.i_event = self.i_loop = 0
+    if nmax!=None and nmax<=0: return
+    start = time.time()
+    self.in_loop = True
+    profiler = self.profiler
+    if profiler!=None: profiler.start_loop()
+    worker.start()
+    try:
+      while True:
+        wait_start = time.time()
+        item = queue.get()
+        self.prefetch_stats['wait_time'] += time.time()-wait_start
+        if item is None: break
+        if isinstance(item,_PrefetchError): item.reraise()
+        if profiler!=None: profiler.moved()
+        self.i_loop = item.position
+        self.prefetch_stats['events'] += 1
+        yield item
+        if profiler!=None: profiler.consumed()
+        self.i_event += 1
+        if nmax!=None and self.i_event >= nmax:
+          if not self.quiet: print 'Reached maximum %d events!'%(nmax,)
+          break
+    finally:
+      stop.set()
+      worker.join()
+      self.in_loop = False
+      # (the worker is done: its branches and counters can be merged now)
+      worker_active = worker_event.worker_state['active_branches']
+      if self.active_branches!=None and worker_active!=None:
+        self.active_branches.update(worker_active)
+      if profiler!=None: 
+        profiler.merge_tags(worker_event.worker_state['profiler'])
+        profiler.stop_loop()
+      self.prefetch_stats['loop_time'] = time.time()-start
+  
+  def profile(self, enable=True, progress=None):
+    '''Turn on (or off) timing of get_record() and of event loops.
+    
+    progress: print a progress line every this many events
+    
+    See stats() and print_stats() for the results.  When off, this costs
+      one comparison per get_record() and per event.
+    '''
+    self.profiler = Profiler(progress=progress) if enable else None
+    return self.profiler
+  
+  def stats(self):
+    '''Returns the Profiler's results as a dict (see Profiler.as_dict()).
+    
+    With staging, stats()['staging'] has StagingCache.stats().
+    '''
+    if self.profiler==None: 
+      raise RuntimeError('Profiling is off (see ArtFileReader.profile())')
+    stats = self.profiler.as_dict()
+    if self.staging!=None: stats['staging'] = self.staging.stats()
+    if self._memos: stats['memo'] = self.memo_stats()
+    return stats
+  
+  def print_stats(self):
+    '''Prints the Profiler's results as a table.'''
+    if self.profiler==None: 
+      raise RuntimeError('Profiling is off (see ArtFileReader.profile())')
+    self.profiler.print_table()
+    if self.staging!=None: self.staging.print_stats()
+    for name,memo in sorted(self.memo_stats().items()):
+      print '  memo %s: %d hits, %d misses (%.0f%%), %d evictions'%(
+        name,memo['hits'],memo['misses'],100*memo['hit_rate'],
+        memo['evictions'])
+  
+  def memoize(self, tags, key='subrun', convert=None, max_entries=16):
+    '''Reuse products which change rarely (e.g. calibration constants).
+    
+    From now on, event.get_record(tag) for these tags returns a shared copy
+      (or convert(product), e.g. a numpy array) for as long as key stays 
+      the same:
+      * 'subrun' or 'run': the product is only read once per (run,)subrun
+      * 'content': the product is read, but only converted again when its
+        contents (an MD5 of the serialized product) change
+      * a function of the event, returning any hashable key
+    At most max_entries values are kept per tag (least recently used are
+      dropped).  Hits and misses are in memo_stats() (and in stats()).
+    
+    tags=None: turn memoization off for all tags.
+    '''
+    if tags==None: 
+      self._memos = {}
+      return
+    if isinstance(tags,(basestring,InputTag)): tags = [ tags ]
+    for tag in tags:
+      name = intern_tag(tag).branch_name if self.backend=='gallery' \
+        else _tag_key(tag)
+      self._memos[name] = ProductMemo(key, convert, max_entries)
+  
+  def memo_stats(self):
+    '''Returns {tag: {'hits','misses','evictions','entries','hit_rate'}}.'''
+    return dict( (name.rstrip('.'),memo.stats()) 
+      for name,memo in self._memos.items() )
+  
+  def checkpoint(self, path, every=1000, every_seconds=None, state=None):
+    '''Save the progress of event loops to path, to resume() after a crash.
+    
+    A checkpoint is written every this many events and/or seconds (whichever
+      comes first), after your code has finished with the event, and once 
+      more when the loop is done.  It holds the position in the loop, 
+      i_event, and state() (anything picklable, e.g. your histograms) if 
+      state is given.  It is written atomically (see _atomic_write()), so a
+      crash while writing leaves the previous checkpoint.
+    
+    The time spent writing checkpoints is in stats() (see profile()).
+    path=None turns checkpointing off.
+    '''
+    if path==None: 
+      self.checkpoint_config = None
+      return
+    self.checkpoint_config = {
+      'path': path, 'every': every, 'every_seconds': every_seconds,
+      'state': state, 'last': (0,time.time()),
+    }
+  
+  def _checkpoint_due(self, checkpoint):
+    last_event,last_time = checkpoint['last']
+    if checkpoint['every'] and self.i_event-last_event>=checkpoint['every']:
+      return True
+    return checkpoint['every_seconds']!=None \
+      and time.time()-last_time>=checkpoint['every_seconds']
+  
+  def _write_checkpoint(self, checkpoint, position, done=False):
+    state = checkpoint['state']() if checkpoint['state']!=None else None
+    contents = {
+      'version': 1, 'filenames': self.filename_list, 'position': position,
+      'i_event': self.i_event, 'i_loop': self.i_loop, 'done': done,
+      'state': state, 'time': time.time(),
+    }
+    _atomic_write(checkpoint['path'], 
+      lambda fileobj: pickle.dump(contents, fileobj, pickle.HIGHEST_PROTOCOL))
+    checkpoint['last'] = (self.i_event,time.time())
+  
+  def resume(self, path, default=None):
+    '''Continue the next event loop where the checkpoint at path left off.
+    
+    Returns the saved state (see checkpoint()), or default if there is no 
+      checkpoint yet (then the loop starts at the beginning as usual).  The
+      loop seeks straight to the event after the checkpoint, and i_event 
+      continues from its saved value (so nmax still counts all events).
+    
+    Example:
+      histograms = reader.resume('job.ckpt', default=Histograms())
+      reader.checkpoint('job.ckpt', every=10000, state=lambda: histograms)
+      for event in reader.event_loop(): histograms.fill(event)
+    '''
+    if not os.path.exists(path): return default
+    with open(path,'rb') as fileobj: contents = pickle.load(fileobj)
+    if contents['filenames']!=self.filename_list: raise ValueError(
+      'Checkpoint %s is for different files!'%(path,))
+    self._resume_point = contents
+    if not self.quiet:
+      print 'Resuming after event %d (position %d)%s'%(contents['i_event'],
+        contents['position'],' (loop was done)' if contents['done'] else '')
+    return contents['state']
+  
+  def use_tags(self, tags, cache_size=30*1024**2):
+    '''Only read the branches of these tags, through a TTreeCache.
+    
+    tags are InputTags, quicktags or branch names.  All other product 
+      branches are disabled, and a TTreeCache of cache_size bytes (None for
+      no cache) is set up for the ones which are left, so their baskets are
+      read ahead in a few large reads.  If a loop asks for any other tag 
+      later, its branch is simply switched back on.
+    
+    See io_report() for the effect.
+    '''
+    self._require_gallery('use_tags')
+    names = None
+    branches = set()
+    for tag in tags:
+      if not isinstance(tag,InputTag) and tag.endswith('.') and '(' not in tag:
+        branches.add(tag)
+        continue
+      if names==None: 
+        names = set( r['name']+'.' for r in self.catalog().records() )
+      branches.update(_tag_branches(tag, names))
+    self.active_branches = branches
+    self.cache_size = cache_size
+    self.learn_events = None
+    if self.event_initialized: self.event.configure_tree()
+  
+  def learn_tags(self, n_events=10, cache_size=30*1024**2):
+    '''Like use_tags(), with the tags used in the first n_events of a loop.'''
+    self._require_gallery('learn_tags')
+    self.active_branches = None
+    self.cache_size = cache_size
+    self.learn_events = n_events
+  
+  def io_report(self):
+    '''Returns a dict with I/O statistics of the loops so far.
+    
+    events: number of events visited
+    bytes_read: bytes actually read from files (TFile::GetFileBytesRead(),
+      so this includes any other files opened by this process)
+    all_branches_bytes: (estimated) compressed bytes of ALL branches of the 
+      events visited, i.e. what reading everything would have cost
+    branches: {branch name: (events read, estimated compressed bytes)}
+    '''
+    self._require_gallery('io_report')
+    if not self.event_initialized: self.initialize_event()
+    stats = self.event.io_stats
+    return {
+      'events': stats['events'],
+      'bytes_read': ROOT.TFile.GetFileBytesRead()-self._bytes_read_start,
+      'all_branches_bytes': stats['all_branches_bytes'],
+      'branches': dict(stats['branches']),
+    }
+  
+  def print_io_report(self):
+    '''Prints io_report() as a table.'''
+    report = self.io_report()
+    print '%d events, %d bytes read from files'%(
+      report['events'],report['bytes_read'])
+    print '  %12.0f bytes estimated for reading all branches'%(
+      report['all_branches_bytes'],)
+    used = 0.
+    for name,(reads,nbytes) in sorted(report['branches'].items()):
+      print '  %12.0f bytes in %8d reads of %s'%(nbytes,reads,name)
+      used += nbytes
+    print '  %12.0f bytes estimated for the branches used'%(used,)
+  
+  def _product_branches(self, tag, filename):
+    '''Names of the branches of tag in a file (empty if not there).'''
+    names = [ r['name']+'.' 
+      for r in _load_file_catalog(filename,False,self.backend) ]
+    if self.backend=='gallery': return _tag_branches(tag, names)
+    try: return [ _match_product_branch(tag, names) ]
+    except KeyError: return []
+  
+  def presence(self, tags, rebuild=False):
+    '''Returns a bool array: for each event, are all products of tags there?
+    
+    Reads only the small 'present' flags of the products (not the products),
+      and saves them next to each file as <file>.heistpresence.npz (see 
+      _save_sidecar()).  Afterwards, Event.get_record() returns None for
+      these products in events without them, without asking gallery.
+    A tag without process is there when any process' product is.  Raises
+      KeyError for a tag which matches no branch in any file.
+    '''
+    if isinstance(tags,(basestring,InputTag)): tags = [ tags ]
+    masks = []
+    found = [ False ]*len(tags)
+    for filename,n_entries in zip(self.filename_list,self.entries_per_file()):
+      names = [ self._product_branches(tag,filename) for tag in tags ]
+      presence = _load_file_presence(filename, 
+        sorted(set(sum(names,[]))), rebuild, self.backend)
+      self._presence.setdefault(filename,{}).update(presence)
+      mask = numpy.ones(n_entries,dtype=bool)
+      for i,tag_names in enumerate(names):
+        tag_present = numpy.zeros(n_entries,dtype=bool)
+        for name in tag_names: tag_present |= presence[name]
+        mask &= tag_present
+        found[i] |= len(tag_names)>0
+      masks += [ mask ]
+    missing = [ intern_tag(tag).branch_name 
+      for tag,tag_found in zip(tags,found) if not tag_found ]
+    if missing: raise KeyError(
+      'No product branch in any file for %s'%(', '.join(missing),))
+    event = self.event
+    if isinstance(event,Event) and event._tree_file!=None:
+      event._presence = self._presence.get(self.filename_list[event._tree_file])
+    return numpy.concatenate(masks+[numpy.zeros(0,dtype=bool)])
+  
+  def _require_gallery(self, what):
+    if self.backend!='gallery': raise NotImplementedError(
+      '%s() needs the gallery backend (this reader uses %s)'%(what,self.backend))
+  
+  def entries_per_file(self):
+    '''Returns number of events in each file (files are opened only once).'''
+    if self.index!=None: return list(self.index.entries_per_file)
+    if self._entries_per_file==None:
+      count = _count_entries if self.backend=='gallery' \
+        else lambda f: _uproot_num_entries(_uproot_tree(f))
+      self._entries_per_file = [ count(f) for f in self.filename_list ]
+    return list(self._entries_per_file)
+  
+  def n_entries(self):
+    '''Returns number of events in all files.'''
+    return sum(self.entries_per_file())
+  
+  def _entry_offsets(self):
+    '''Returns position of the first event of each file, plus the total.'''
+    return [0]+[ int(n) for n in numpy.cumsum(self.entries_per_file()) ]
+  
+  def _locate(self, position):
+    '''Returns (file index, entry) of a position.'''
+    offsets = self._entry_offsets()
+    if position<0 or position>=offsets[-1]:
+      raise IndexError('No event at position %d (of %d)'%(position,offsets[-1]))
+    i_file = bisect.bisect_right(offsets,position)-1
+    return i_file,position-offsets[i_file]
+  
+  def iter_columns(self, input_tag, members, chunk_size=1000, **loop_kwargs):
+    '''Yield JaggedColumns of members of input_tag for chunks of events.
+    
+    members is a list of record data members, e.g. ('energy','time').
+    
+    Events are taken from event_loop(**loop_kwargs) (so nmax, event_list, 
+      etc. work as usual), and each chunk holds (at most) chunk_size events.
+      Copying the members is done in C++ (see ColumnFiller).
+    '''
+    if self.backend=='uproot':
+      for columns in self._uproot_iter_columns(
+          input_tag, members, chunk_size, **loop_kwargs):
+        yield columns
+      return
+    input_tag = intern_tag(input_tag)
+    filler = ColumnFiller(input_tag.dtype.__cppname__, members)
+    for event in self.event_loop(**loop_kwargs):
+      filler.fill(event.get_product(input_tag), event.get_ID())
+      if len(filler)>=chunk_size: yield filler.flush()
+    if len(filler)>0: yield filler.flush()
+  
+  def _uproot_iter_columns(self, input_tag, members, chunk_size, 
+      evt_list=None, event_list=None, nmax=None, select=None, require=()
+    ):
+    '''iter_columns() for the uproot backend: reads branches in bulk.'''
+    if _no_selection(event_list): event_list = evt_list
+    positions = self._selected_positions(event_list, select, require)
+    offsets = self._entry_offsets()
+    n_events = 0
+    for i_file,filename in enumerate(self.filename_list):
+      tree = _uproot_tree(filename)
+      branches = _uproot_branches(tree)
+      branch_name = _match_product_branch(input_tag, branches)
+      for start in xrange(0, offsets[i_file+1]-offsets[i_file], chunk_size):
+        stop = min(start+chunk_size, offsets[i_file+1]-offsets[i_file])
+        columns = _uproot_columns(
+          tree, branches, branch_name, members, start, stop)
+        if positions is not None:
+          local = numpy.asarray(positions)-offsets[i_file]
+          columns = columns.take(local[(local>=start) & (local<stop)]-start)
+        if nmax!=None and n_events+len(columns)>nmax:
+          columns = columns.take(numpy.arange(nmax-n_events))
+        n_events += len(columns)
+        if len(columns)>0: yield columns
+        if nmax!=None and n_events>=nmax: return
+  
+  def get_columns(self, input_tag, members, **loop_kwargs):
+    '''Return JaggedColumns of members of input_tag for all events in loop.
+    
+    Example:
+      hits = artreader.get_columns(
+        'gm2calo::CrystalHitArtRecords_islandFitterSim_fitter_caloSimChain',
+        ('energy','time','xtalNum'), nmax=1000)
+      hits['energy'] # flat numpy array of all hit energies
+      hits.offsets   # hits of event i are at [offsets[i]:offsets[i+1]]
+    '''
+    return JaggedColumns.concatenate(
+      self.iter_columns(input_tag, members, **loop_kwargs), members)
+  
+  def iter_ptrs(self, input_tag, ptr_member, chunk_size=1000, **loop_kwargs):
+    '''Yield JaggedColumns of the art::Ptr member of input_tag's records.
+    
+    Each chunk has two columns: 'product_id' (ProductID value of the 
+      collection pointed to) and 'key' (index in that collection, -1 for 
+      null Ptrs), one element per record, as for iter_columns().
+    '''
+    if self.backend=='uproot':
+      key,product_id = ptr_member+'.key_',ptr_member+'.core_.id_.value_'
+      for columns in self.iter_columns(
+          input_tag, (key,product_id), chunk_size, **loop_kwargs):
+        yield _ptr_columns(columns, key, product_id)
+      return
+    input_tag = intern_tag(input_tag)
+    key,product_id = ptr_member+'.key()',ptr_member+'.id().value()'
+    filler = ColumnFiller(input_tag.dtype.__cppname__, (key,product_id),
+      types={key:'size_t', product_id:'unsigned int'})
+    for event in self.event_loop(**loop_kwargs):
+      filler.fill(event.get_product(input_tag), event.get_ID())
+      if len(filler)>=chunk_size: 
+        yield _ptr_columns(filler.flush(), key, product_id)
+    if len(filler)>0: yield _ptr_columns(filler.flush(), key, product_id)
+  
+  def get_ptrs(self, input_tag, ptr_member, **loop_kwargs):
+    '''Return iter_ptrs() for all events in loop, as one JaggedColumns.
+    
+    Example (island of every hit, without following Ptrs in Python):
+      ptrs = artreader.get_ptrs(hit_tag, 'island')
+      islands = artreader.get_columns(island_tag, ('energy',))
+      index = heist.resolve_ptrs(ptrs, islands)
+    '''
+    return JaggedColumns.concatenate(
+      self.iter_ptrs(input_tag, ptr_member, **loop_kwargs), 
+      ('key','product_id'))
+  
+  def join_ptrs(self, input_tag, ptr_member, target_tag, target_members,
+      product_id=None, chunk_size=1000, **loop_kwargs
+    ):
+    '''Follow the Ptr member of input_tag into target_tag, vectorized.
+    
+    Returns (ptrs,target): ptrs as from get_ptrs() plus a 'target_index'
+      column (see resolve_ptrs()), and JaggedColumns of target_members of 
+      target_tag.  E.g. target['energy'][ptrs['target_index']] is the 
+      energy of the island of every hit (where target_index>=0).
+    
+    With the gallery backend both collections are read in one event loop,
+      and copied out chunk_size events at a time (as in iter_columns()).
+    '''
+    if self.backend=='uproot':
+      ptrs = self.get_ptrs(input_tag, ptr_member, chunk_size=chunk_size, 
+        **loop_kwargs)
+      target = self.get_columns(target_tag, target_members, 
+        chunk_size=chunk_size, **loop_kwargs)
+    else:
+      input_tag,target_tag = intern_tag(input_tag),intern_tag(target_tag)
+      key,id_expr = ptr_member+'.key()',ptr_member+'.id().value()'
+      ptr_filler = ColumnFiller(input_tag.dtype.__cppname__, (key,id_expr),
+        types={key:'size_t', id_expr:'unsigned int'})
+      target_filler = ColumnFiller(target_tag.dtype.__cppname__, target_members)
+      ptr_parts,target_parts = [],[]
+      for event in self.event_loop(**loop_kwargs):
+        event_id = event.get_ID()
+        ptr_filler.fill(event.get_product(input_tag), event_id)
+        target_filler.fill(event.get_product(target_tag), event_id)
+        if len(ptr_filler)>=chunk_size:
+          ptr_parts += [ _ptr_columns(ptr_filler.flush(), key, id_expr) ]
+          target_parts += [ target_filler.flush() ]
+      if len(ptr_filler)>0:
+        ptr_parts += [ _ptr_columns(ptr_filler.flush(), key, id_expr) ]
+        target_parts += [ target_filler.flush() ]
+      ptrs = JaggedColumns.concatenate(ptr_parts, ('key','product_id'))
+      target = JaggedColumns.concatenate(target_parts, target_members)
+    ptrs.columns['target_index'] = resolve_ptrs(ptrs, target, product_id)
+    return ptrs,target
+  
+  def skim(self, filename, fields, keep=None, **loop_kwargs):
+    '''Write members of products of selected events to a skim file (npz).
+    
+    fields is {tag: members}, e.g. {'gm2calo::ClusterArtRecords_...': 
+      ('energy','time')}.  keep(event), if given, decides which events are
+      kept.  Events are taken from event_loop(**loop_kwargs), so nmax,
+      event_list and select(ID) work as usual (and are cheaper than keep,
+      since they skip events before their products are read).
+    
+    Read the skim back with SkimReader(filename); it returns the same
+      records and columns, much faster than going through the art files.
+    Returns the number of events written.
+    '''
+    fields = [ (tag,list(members)) for tag,members in fields.items() ]
+    fillers = [ self._skim_filler(tag,members) for tag,members in fields ]
+    presence = [ [] for tag,members in fields ]
+    ids = []
+    for event in self.event_loop(**loop_kwargs):
+      if keep!=None and not keep(event): continue
+      event_id = event.get_ID()
+      for (tag,members),filler,present in zip(fields,fillers,presence):
+        product = event.get_product(intern_tag(tag) 
+          if self.backend=='gallery' else tag)
+        filler.fill(product, event_id)
+        present += [ product is not None ]
+      ids += [ event_id ]
+    _write_skim(filename, ids, [ 
+      (_tag_key(tag),filler.flush()) for (tag,members),filler in zip(fields,fillers)
+    ], self.filename_list, presence)
+    if not self.quiet: print 'Wrote %d events to %s'%(len(ids),filename)
+    return len(ids)
+  
+  def _skim_filler(self, tag, members):
+    if self.backend=='gallery':
+      return ColumnFiller(intern_tag(tag).dtype.__cppname__, members)
+    return _RecordFiller(members)
+  
+  def build_index(self, rebuild=False):
+    '''Build (or load from sidecar files) an EventIndex for all files.'''
+    self.index = EventIndex(self.filename_list, rebuild=rebuild, 
+      quiet=self.quiet, backend=self.backend)
+    return self.index
+  
+  def seek(self, position):
+    '''Move self.event to position (from 0, counting over all files).'''
+    if not self.event_initialized: self.initialize_event()
+    i_file,entry = self._locate(position)
+    self.event.seek(i_file,entry)
+    return self.event
+  
+  def goto(self, run, subrun, event):
+    '''Move self.event directly to the event with this ID, and return it.
+    
+    Uses the EventIndex (built on first use), so nothing is read on the way.
+    '''
+    if self.index==None: self.build_index()
+    position = self.index.find(run,subrun,event)
+    if position==None:
+      raise KeyError('Run%d SubRun%d Event%d is not in these files'%(
+        run,subrun,event))
+    return self.seek(position)
+  
+  def sample_positions(self, n, seed=0, strata=None, 
+      allocation='proportional'
+    ):
+    '''Returns sorted positions of a random sample of n events.
+    
+    The same seed (and files) always gives the same sample.  Only entry 
+      counts are used (plus the EventIndex for strata by ID), so no event 
+      data is read.
+    
+    strata: None (uniform over all events), 'file', 'run', 'subrun', or a 
+      function of (run,subrun,event) giving the stratum of an event
+    allocation: 'proportional' (to the size of each stratum) or 'equal' 
+      (n/number of strata each); strata smaller than their share are taken
+      completely
+    '''
+    if n<0: raise ValueError('Cannot sample %d events'%(n,))
+    rng = numpy.random.RandomState(seed)
+    offsets = self._entry_offsets()
+    if strata==None: 
+      return numpy.sort(_sample_range(rng, offsets[-1], n)).astype('int64')
+    if strata=='file':
+      groups = [ numpy.arange(offsets[i],offsets[i+1]) 
+        for i in xrange(len(offsets)-1) ]
+    else:
+      if self.index==None: self.build_index()
+      ids = self.index.ids
+      if strata=='run': keys = ids[:,0]
+      elif strata=='subrun': keys = ids[:,0]*(2**32)+ids[:,1]
+      elif callable(strata):
+        stratum_keys = [ strata(event_id) for event_id in map(tuple,ids.tolist()) ]
+        unique_keys = sorted(set(stratum_keys))
+        number = dict( (key,i) for i,key in enumerate(unique_keys) )
+        keys = numpy.array([ number[key] for key in stratum_keys ],dtype='int64')
+      else: raise ValueError(
+        'strata should be None, "file", "run", "subrun" or a function')
+      order = numpy.argsort(keys, kind='mergesort')
+      boundaries = numpy.flatnonzero(numpy.diff(keys[order]))+1
+      groups = numpy.split(order, boundaries) if len(order)>0 else []
+    sizes = [ len(group) for group in groups ]
+    positions = [ group[numpy.sort(_sample_range(rng,len(group),count))]
+      for group,count in zip(groups,_allocate(n,sizes,allocation)) ]
+    return numpy.sort(numpy.concatenate(
+      positions+[numpy.zeros(0,dtype='int64')])).astype('int64')
+  
+  def sample(self, n, seed=0, strata=None, allocation='proportional', 
+      **loop_kwargs
+    ):
+    '''Loop over a random sample of n events (see sample_positions()).
+    
+    The events are visited in file/entry order, seeking straight to each 
+      one, so the time taken depends on n rather than on the size of the 
+      dataset.  An empty sample (n=0, or no events in the strata) visits no
+      events.  Other arguments go to event_loop() (e.g. require).
+    
+    Example:
+      for event in reader.sample(10000, seed=1, strata='run'): ...
+    '''
+    positions = self.sample_positions(n, seed, strata, allocation)
+    return self.event_loop(event_list=positions, **loop_kwargs)
+  
+  def select_IDs(self, start=(), stop=None, **loop_kwargs):
+    '''Loop over events with start <= (run,subrun,event) < stop.
+    
+    start and stop may be shortened, e.g. select_IDs((5,),(6,)) gives all of
+      run 5.  This is event_loop(event_list=self.index.select(start,stop)),
+      so the loop seeks directly to the matching events.
+    '''
+    if self.index==None: self.build_index()
+    return self.event_loop(event_list=self.index.select(start,stop), **loop_kwargs)
+  
+  def declare_types(self, persist=None):
+    '''Declare getValidHandle<T> for every product type in the files.
+    
+    Uses the ProductCatalog, and declares them all at once (see 
+      declare_handle_types()), so no type is JIT-compiled inside the loop.
+    '''
+    self._require_gallery('declare_types')
+    return declare_handle_types(self.catalog().product_types(), persist=persist)
+  
+  def aggregate(self, input_tag, aggregates, chunk_size=1000, **loop_kwargs):
+    '''Fill aggregates (Hist1D, FieldStats) from members of input_tag.
+    
+    aggregates is {name: aggregate}, e.g.
+      {'energy': heist.Hist1D('energy', 100, (0,3000), group_by='caloNum'),
+       'time': heist.FieldStats('time', weight='energy')}
+    The members they need are read with iter_columns(), chunk_size events
+      at a time, and each chunk is binned in one numpy call, so memory use
+      does not grow with the number of events.  Returns aggregates (filled).
+    
+    The results can be merged with those of other readers (a+b, or 
+      merge_aggregates()); see aggregate_files() for many processes.
+    '''
+    members = []
+    for aggregate in aggregates.values():
+      members += [ m for m in aggregate.members() if m not in members ]
+    for columns in self.iter_columns(
+        input_tag, members, chunk_size, **loop_kwargs):
+      for aggregate in aggregates.values(): aggregate.fill(columns)
+    return aggregates
+  
+  def map_reduce(self, mapper, reducer, **kwargs):
+    '''Run map_reduce_files() over self.filename_list (see that function).'''
+    return map_reduce_files(self.filename_list, mapper, reducer, **kwargs)
+  
+  def catalog(self, rebuild=False):
+    '''Returns the ProductCatalog of all files (built once, see ProductCatalog).'''
+    if self._catalog==None or rebuild:
+      self._catalog = ProductCatalog(
+        self.filename_list, rebuild=rebuild, backend=self.backend)
+    return self._catalog
+  
+  def list_records(self, pattern=None, regex=None):
+    '''Return a list of type_modlabel_instname_procID for TTrees in file.
+    
+    Specify pattern to return only things with pattern as substring (case-
+      insensitive).
+    
+    Specify regex to match by regular expression (re.search).
+    
+    This only looks at the ProductCatalog, so it works at any point in the
+      loop (even at the end), and reads no event data.
+    '''
+    return [ 
+      record['name'] for record in self.catalog().records(pattern,regex) 
+    ]
+  
+  def ls(self, pattern=None, regex=None, sizes=False):
+    '''Prints records from list_records, but more like ls.
+    
+    With sizes=True, also prints entries and compressed bytes per entry.
+    '''
+    for record in self.catalog().records(pattern,regex):
+      if sizes: print '  '+_format_catalog_record(record)
+      else: print '  '+record['name']
+  
+  def largest_records(self, n=10, key='zip_bytes'):
+    '''Returns catalog records of the n largest products (by key).
+    
+    key is any numeric field of a catalog record, e.g. 'zip_bytes' 
+      (compressed) or 'tot_bytes' (uncompressed).
+    '''
+    records = sorted(self.catalog().records(), key=lambda r: -r[key])
+    return records[:n]
+  
+  def ls_largest(self, n=10, key='zip_bytes'):
+    '''Prints largest_records(n,key).'''
+    for record in self.largest_records(n,key):
+      print '  '+_format_catalog_record(record)
 
 
 class Event(object):
@@ -458,28 +2516,242 @@ class Event(object):
   def __init__(self, artfilereader, filenames):
     self.artfilereader = artfilereader
     self.filenames = filenames
+    artfilereader._stage(0) # gallery opens the first file right away
     self.gallery_event = ROOT.gallery.Event(filenames)
     self.product_getters = {}
+    
+    # which branches get read, and how much (see ArtFileReader.io_report())
+    self.used_branches = set()
+    self.io_stats = {'events':0, 'all_branches_bytes':0., 'branches':{}}
+    self._read_this_event = set()
+    self._tree_file = None        # file index the TTree was configured for
+    self._branch_bytes = {}       # compressed bytes/entry of each branch
+    self._all_bytes_per_entry = 0.
+    self._presence = None         # {branch: bool per entry} for this file
+    self._tag_branches = {}       # {tag branch_name: branches} for this file
+    
+    # a prefetch worker's own {'active_branches','profiler'}, so it does not
+    #   change the reader's while the loop uses them (see prefetch_loop())
+    self.worker_state = None
+    
+    # numpy views of products of this event (see as_array())
+    self.strict_views = False
+    self._views = []              # [(weakref to memory of views, vector)]
   
   def at_end(self): return self.gallery_event.atEnd()
-  def next(self): return self.gallery_event.next()
-  def previous(self): return self.gallery_event.previous()
   
-  def get_record(self, input_tag):
+  def _at(self, i_file, entry):
+    '''True if the event is at entry of file number i_file.'''
+    gallery_event = self.gallery_event
+    return not gallery_event.atEnd() and gallery_event.fileEntry()==i_file \
+      and gallery_event.eventEntry()==entry
+  
+  def to_begin(self): 
+    if not self._at(0,0):
+      self._before_move()
+      self.artfilereader._stage(0)
+      self.gallery_event.toBegin()
+    self._moved()
+  
+  def next(self): 
+    self._before_move()
+    if self.artfilereader.staging!=None:
+      # stage the next file before gallery opens it
+      gallery_event = self.gallery_event
+      if gallery_event.eventEntry()+1>=gallery_event.numberOfEventsInFile():
+        self.artfilereader._stage(gallery_event.fileEntry()+1)
+    self.gallery_event.next()
+    self._moved()
+
+  def previous(self): 
+    self._before_move()
+    self.gallery_event.previous()
+    self._moved()
+  
+  def seek(self, i_file, entry):
+    '''Go to entry (from 0) of file number i_file (from 0) in filenames.
+    
+    Skips over whole files with goToEntry() and next(), so no event data is
+      read on the way.
+    '''
+    if self._at(i_file,entry): return self._moved()
+    self._before_move()
+    gallery_event = self.gallery_event
+    try:
+      if gallery_event.atEnd() or gallery_event.fileEntry()>i_file:
+        self.artfilereader._stage(0)
+        gallery_event.toBegin()
+      if self.artfilereader.staging!=None: # (files on the way get opened too)
+        for i in xrange(gallery_event.fileEntry()+1,i_file+1): 
+          self.artfilereader._stage(i)
+      while not gallery_event.atEnd() and gallery_event.fileEntry()<i_file:
+        gallery_event.goToEntry(gallery_event.numberOfEventsInFile()-1)
+        gallery_event.next()
+      if gallery_event.atEnd() or gallery_event.fileEntry()!=i_file:
+        raise IndexError('No events in file %d of %d'%(i_file,len(self.filenames)))
+      if gallery_event.eventEntry()!=entry: gallery_event.goToEntry(entry)
+    finally: self._moved()
+  
+  def _moved(self):
+    '''Bookkeeping after the event moved (every move ends with this).'''
+    self._read_this_event = set()
+    if self.gallery_event.atEnd(): return
+    self.io_stats['events'] += 1
+    self.io_stats['all_branches_bytes'] += self._all_bytes_per_entry
+    if self.gallery_event.fileEntry()!=self._tree_file: self._new_file()
+  
+  def _register_view(self, array, vec):
+    '''Keep track of a numpy view of the std::vector vec of this event.'''
+    if array.base is None: return # (empty: not a view)
+    self._views += [ (weakref.ref(array.base),vec) ]
+  
+  def _before_move(self):
+    '''Keep the memory of views of this event's products (see as_array()).
+    
+    Every std::vector still seen by a view (or a slice of one) is swapped
+      into a new vector which lives as long as the views do, so they stay 
+      valid and gallery reads the next event into the emptied product.
+      With strict_views, raises RuntimeError instead (before moving).
+    '''
+    if len(self._views)==0: return
+    alive = [ (memory,vec) for memory,vec in 
+      ((view(),vec) for view,vec in self._views) if memory is not None ]
+    if len(alive)>0 and self.strict_views: raise RuntimeError(
+      '%d numpy views of products of this event are still in use!'
+      ' (use copy=True to keep data, or del them before moving)'%(len(alive),))
+    self._views = []
+    owners = {}
+    for memory,vec in alive:
+      address = _data_address(vec)
+      if address not in owners:
+        owners[address] = type(vec)()
+        owners[address].swap(vec)
+      _keep_vector(memory, owners[address])
+  
+  def _new_file(self):
+    '''Get branch sizes of (and configure) the TTree of a new file.'''
+    self._tree_file = self.gallery_event.fileEntry()
+    if self.artfilereader.staging!=None:
+      self.artfilereader.staging.advance(
+        self.artfilereader.filename_list, self._tree_file)
+    self._presence = self.artfilereader._presence.get(
+      self.artfilereader.filename_list[self._tree_file])
+    self._branch_bytes = {}
+    self._tag_branches = {}
+    tree = self.gallery_event.getTTree()
+    if not tree: return
+    for branch in tree.GetListOfBranches():
+      n_entries = branch.GetEntries()
+      self._branch_bytes[branch.GetName()] = \
+        float(branch.GetZipBytes('*'))/n_entries if n_entries>0 else 0.
+    self._all_bytes_per_entry = sum(self._branch_bytes.values())
+    self.configure_tree()
+  
+  def configure_tree(self):
+    '''Disable unused product branches and set up the TTreeCache.
+    
+    Uses artfilereader.active_branches and artfilereader.cache_size (see
+      ArtFileReader.use_tags()).  This is redone for every new file.
+    '''
+    active = self._state('active_branches')
+    tree = self.gallery_event.getTTree()
+    if active==None or not tree: return
+    for branch in tree.GetListOfBranches():
+      name = branch.GetName()
+      if not _is_product_branch(name): continue # gallery needs these
+      tree.SetBranchStatus(name+'*', name in active)
+    cache_size = self.artfilereader.cache_size
+    if cache_size:
+      tree.SetCacheSize(cache_size)
+      for name in active: tree.AddBranchToCache(name,True)
+      tree.AddBranchToCache('EventAuxiliary',True)
+      tree.StopCacheLearningPhase()
+  
+  def _branches_of(self, input_tag):
+    '''The branches of this file which input_tag reads (see _tag_branches()).'''
+    if self._tree_file==None: self._new_file()
+    try: return self._tag_branches[input_tag.branch_name]
+    except KeyError:
+      names = self._tag_branches[input_tag.branch_name] = \
+        _tag_branches(input_tag, self._branch_bytes)
+      return names
+  
+  def _state(self, name):
+    '''The reader's active_branches or profiler (or this worker's own).'''
+    if self.worker_state!=None: return self.worker_state[name]
+    return getattr(self.artfilereader, name)
+  
+  def _use_branch(self, name):
+    '''Note that a branch was read (and re-enable it if it was disabled).'''
+    if name not in self.used_branches:
+      self.used_branches.add(name)
+      active = self._state('active_branches')
+      if active!=None and name not in active:
+        active.add(name)
+        tree = self.gallery_event.getTTree()
+        if tree:
+          tree.SetBranchStatus(name+'*',1)
+          if self.artfilereader.cache_size: tree.AddBranchToCache(name,True)
+    self._read_this_event.add(name)
+    reads,nbytes = self.io_stats['branches'].get(name,(0,0.))
+    self.io_stats['branches'][name] = (
+      reads+1, nbytes+self._branch_bytes.get(name,0.) )
+  
+  def get_record(self, input_tag, array=False, member=None, copy=False):
     '''Call getValidHandle<C++Type>(InputTag) and return data products.
     
     Checks for an existing product getter by looking for the string
-      input_tag.dtype_string in product_getters.keys().  If not found, then it
+      input_tag.dtype_string in product_getters.  If not found, then it
       will instantiate it with gallery.Event.getValidHandle(input_tag.dtype)
       and add it to product_getters with input_tag.dtype_string as the key.
+    
+    With array=True, returns a numpy array using the product's memory
+      (see as_array(); member picks a data member of a vector of records), 
+      valid until the event moves on (or a copy, with copy=True).
+    '''
+    
+    if not isinstance(input_tag,InputTag): input_tag = intern_tag(input_tag)
+    if not array and self.artfilereader._memos:
+      memo = self.artfilereader._memos.get(input_tag.branch_name)
+      if memo!=None: return memo.get(self, input_tag)
+    
+    retval = self.get_product(input_tag)
+    
+    if array:
+      if retval==None: return None
+      return as_array(retval, member=member, copy=copy, event=self)
+    
+    # handle emtpy vectors as well as ProductNotFound by simply doing
+    #   if records==None: continue
+    if retval!=None and hasattr(retval,'__len__') and len(retval)==0: 
+      retval = 0
+    
+    return retval
+  
+  def get_product(self, input_tag):
+    '''Like get_record(), but returns empty collections as they are.
+    
+    Returns None for ProductNotFound.
     '''
     
     # check for InputTag, else assume we got a quicktag
-    if type(input_tag)==str:
-      input_tag = InputTag(quicktag=input_tag)
+    if not isinstance(input_tag,InputTag): input_tag = intern_tag(input_tag)
+    
+    # known to be absent (see ArtFileReader.presence())? then don't ask
+    names = self._branches_of(input_tag)
+    if self._presence!=None:
+      entry = self.gallery_event.eventEntry()
+      presents = [ self._presence.get(name) for name in names ]
+      if names and None not in presents and \
+          not any( present[entry] for present in presents ):
+        return None
+    
+    # keep track of which branches are read
+    for name in names:
+      if name not in self._read_this_event: self._use_branch(name)
     
     # check for product getter, and make one if not found
-    if input_tag.dtype_string not in self.product_getters.keys():
+    if input_tag.dtype_string not in self.product_getters:
       try: 
         self.product_getters[input_tag.dtype_string] \
           = self.gallery_event.getValidHandle(input_tag.dtype)
@@ -495,6 +2767,8 @@ class Event(object):
         )
     
     # try to get the data product
+    profiler = self._state('profiler')
+    if profiler!=None: start = time.time()
     retval = None
     try: 
       retval = self.product_getters[input_tag.dtype_string](input_tag.input_tag).product()
@@ -504,14 +2778,25 @@ class Event(object):
         print 'Got exception with\n  type: %s\n  value: %s\n  traceback: %s\n'%(
           exc_info
         )
-    
-    # handle emtpy vectors as well as ProductNotFound by simply doing
-    #   if records==None: continue
-    if retval!=None and hasattr(retval,'__len__') and len(retval)==0: 
-      retval = 0
+    if profiler!=None: 
+      profiler.record_tag(input_tag.branch_name, time.time()-start, retval)
     
     return retval
   
+  def evaluate(self, input_tag, expression, dtype='float64'):
+    '''Evaluate expression (C++) for each record of a product (see Expression).
+    
+    Returns a numpy array (empty if the product is not there).
+    '''
+    if not isinstance(input_tag,InputTag): input_tag = intern_tag(input_tag)
+    return compile_expression(input_tag.dtype.__cppname__, expression, dtype)(
+      self.get_product(input_tag))
+  
+  def mask(self, input_tag, expression):
+    '''Boolean mask of the records of a product which pass a cut, e.g. 
+      event.mask(hit_tag, 'energy > 100 and chi2 < 5').'''
+    return self.evaluate(input_tag, expression, 'bool')
+  
   def get_ID(self):
     '''Returns (Run,SubRun,EventNumber).'''
     event_id = self.gallery_event.eventAuxiliary().id() # art event ID object
@@ -534,7 +2819,15 @@ class Event(object):
     format_str = 'Run%d SubRun%d Event%d' if not short else 'r%ds%de%d'
     return format_str%self.get_ID()
   
-  def ls(self, pattern=None, regex=None, showfail=False):
+  def ls(self, pattern=None, regex=None, showfail=False, lengths=False):
+    '''Prints the products in the files (from the ProductCatalog).
+    
+    With lengths=True, gets every product of THIS event and prints its
+      length instead (which reads all of them; showfail=True also lists 
+      products which could not be read).
+    '''
+    if not lengths:
+      return self.artfilereader.ls(pattern=pattern,regex=regex,sizes=True)
     for bname in self.artfilereader.list_records(pattern=pattern,regex=regex):
       rec,length = None,None
       try: rec = self.get_record(bname)
@@ -550,6 +2843,368 @@ class Event(object):
 
 
 
+class Profiler(object):
+  '''Counters and timers for get_record() and event loops.
+  
+  Per tag (branch name): calls, time in getValidHandle(...)(tag).product(),
+    misses (ProductNotFound etc.) and number of elements.
+  Per loop: events, time spent moving to the next event ('next'), time 
+    spent in the code using the events ('consumer'), time spent writing 
+    checkpoints (see ArtFileReader.checkpoint()), and wall time.
+  '''
+  def __init__(self, progress=None):
+    self.progress = progress
+    self.tags = {} # branch name -> [calls,seconds,misses,elements]
+    self.events = 0
+    self.next_time = 0.
+    self.consumer_time = 0.
+    self.checkpoints = 0
+    self.checkpoint_time = 0.
+    self.wall_time = 0.
+    self._loop_start = self._mark = None
+  
+  def merge_tags(self, other):
+    '''Add the per-tag counters of other (e.g. a prefetch worker's) to these.'''
+    for branch_name,counters in other.tags.items():
+      mine = self.tags.setdefault(branch_name,[0,0.,0,0])
+      for i_counter,value in enumerate(counters): mine[i_counter] += value
+  
+  def record_tag(self, branch_name, seconds, product):
+    '''Count one get_record() call.'''
+    counters = self.tags.get(branch_name)
+    if counters==None: counters = self.tags[branch_name] = [0,0.,0,0]
+    counters[0] += 1
+    counters[1] += seconds
+    if product==None: counters[2] += 1
+    elif hasattr(product,'__len__'): counters[3] += len(product)
+    else: counters[3] += 1
+  
+  def start_loop(self):
+    self._loop_start = self._mark = time.time()
+  
+  def moved(self):
+    '''Called when the loop reached an event.'''
+    now = time.time()
+    self.next_time += now-self._mark
+    self._mark = now
+  
+  def consumed(self):
+    '''Called when the code using the event asks for the next one.'''
+    now = time.time()
+    self.consumer_time += now-self._mark
+    self._mark = now
+    self.events += 1
+    if self.progress and self.events%self.progress==0:
+      elapsed = self.wall_time+now-self._loop_start
+      print '%d events, %.1f events/s (next %.1f s, consumer %.1f s)'%(
+        self.events,self.events/elapsed if elapsed>0 else 0.,
+        self.next_time,self.consumer_time)
+  
+  def checkpointed(self):
+    '''Called after writing a checkpoint (right after consumed()).'''
+    now = time.time()
+    self.checkpoints += 1
+    self.checkpoint_time += now-self._mark
+    self._mark = now
+  
+  def stop_loop(self):
+    if self._loop_start==None: return
+    self.wall_time += time.time()-self._loop_start
+    self._loop_start = None
+  
+  def as_dict(self):
+    '''Returns {'loop':{...}, 'tags':{branch name:{...}}}.'''
+    wall_time = self.wall_time
+    if self._loop_start!=None: wall_time += time.time()-self._loop_start
+    tags = {}
+    for name,(calls,seconds,misses,elements) in self.tags.items():
+      tags[name] = {
+        'calls': calls, 'time': seconds, 'misses': misses,
+        'elements': elements,
+        'mean_size': float(elements)/(calls-misses) if calls>misses else 0.,
+      }
+    return {
+      'loop': {
+        'events': self.events, 'wall_time': wall_time,
+        'events_per_second': self.events/wall_time if wall_time>0 else 0.,
+        'next_time': self.next_time, 'consumer_time': self.consumer_time,
+        'checkpoints': self.checkpoints, 
+        'checkpoint_time': self.checkpoint_time,
+      },
+      'tags': tags,
+    }
+  
+  def print_table(self):
+    stats = self.as_dict()
+    loop = stats['loop']
+    print '%d events in %.2f s (%.1f events/s): next %.2f s, consumer %.2f s'%(
+      loop['events'],loop['wall_time'],loop['events_per_second'],
+      loop['next_time'],loop['consumer_time'])
+    if loop['checkpoints']>0: 
+      print '%d checkpoints in %.2f s'%(
+        loop['checkpoints'],loop['checkpoint_time'])
+    print '  %8s %10s %8s %10s  %s'%('calls','time [s]','misses','mean size','tag')
+    for name,tag in sorted(stats['tags'].items()):
+      print '  %8d %10.3f %8d %10.1f  %s'%(
+        tag['calls'],tag['time'],tag['misses'],tag['mean_size'],name)
+
+
+class UprootEvent(object):
+  '''Stands in for heist.Event with ArtFileReader(..., backend='uproot').
+  
+  Reads the Events tree with uproot (pure Python: no ROOT, gallery or 
+    cling), one chunk of entries at a time.  get_record() returns a numpy 
+    record array with one row per element of the collection and one field
+    per (split) data member, e.g. hits.energy or hits[0].energy.  Products
+    must have been written split (art's default); members which are 
+    objects themselves appear as e.g. hits['island.key_'].
+  
+  Tags are quicktags (trailing fields may be left out) or InputTags.
+  '''
+  chunk_size = 1000
+  
+  def __init__(self, artfilereader, filenames):
+    self.artfilereader = artfilereader
+    self.filenames = list(filenames)
+    self.gallery_event = None
+    self.i_file = self.entry = 0
+    self._tree_file = None
+    self._chunks = {} # branch name -> (start,stop,offsets,flat)
+    self._skip_empty_files()
+  
+  def _n_entries(self): 
+    return self.artfilereader.entries_per_file()[self.i_file]
+  
+  def _skip_empty_files(self):
+    while not self.at_end() and self._n_entries()==0: self.i_file += 1
+  
+  def _open(self):
+    '''Open the current file (if not open yet).'''
+    if self._tree_file==self.i_file: return
+    staging = self.artfilereader.staging
+    if staging!=None:
+      filename = staging.stage(self.filenames[self.i_file])
+      staging.advance(self.filenames, self.i_file)
+    else: filename = self.filenames[self.i_file]
+    self._tree = _uproot_tree(filename)
+    self._branches = _uproot_branches(self._tree)
+    self._tree_file = self.i_file
+    self._chunks = {}
+  
+  def _chunk(self, name):
+    '''Returns (offsets,flat) of a branch, for the chunk holding this entry.'''
+    self._open()
+    chunk = self._chunks.get(name)
+    if chunk==None or not (chunk[0]<=self.entry<chunk[1]):
+      start = self.entry-self.entry%self.chunk_size
+      stop = min(start+self.chunk_size,self._n_entries())
+      counts,flat = _uproot_jagged(self._branches[name],start,stop)
+      offsets = numpy.concatenate([[0],numpy.cumsum(counts)])
+      chunk = self._chunks[name] = (start,stop,offsets,flat)
+    start,stop,offsets,flat = chunk
+    return offsets[self.entry-start:self.entry-start+2],flat
+  
+  def at_end(self): return self.i_file>=len(self.filenames)
+  
+  def to_begin(self):
+    self.i_file = self.entry = 0
+    self._skip_empty_files()
+  
+  def next(self):
+    self.entry += 1
+    if self.entry>=self._n_entries():
+      self.i_file,self.entry = self.i_file+1,0
+      self._skip_empty_files()
+  
+  def seek(self, i_file, entry):
+    '''Go to entry (from 0) of file number i_file (from 0) in filenames.'''
+    self.i_file,self.entry = i_file,entry
+  
+  def get_product(self, input_tag):
+    '''Returns the product as a numpy record array (None if not found).'''
+    self._open()
+    try: branch_name = _match_product_branch(input_tag,self._branches)
+    except KeyError: return None
+    present = branch_name+'present'
+    if present in self._branches:
+      (start,stop),flat = self._chunk(present)
+      if stop>start and not flat[start]: return None
+    members = _uproot_leaf_members(self._branches,branch_name)
+    arrays = []
+    for member in members:
+      (start,stop),flat = self._chunk(branch_name+'obj.'+member)
+      arrays += [ flat[start:stop] ]
+    if len(members)==0: return None
+    return numpy.rec.fromarrays(arrays, names=members)
+  
+  def get_record(self, input_tag):
+    '''Returns the product: None if not found, an empty record array if empty.
+    
+    (The truth value of a record array is ambiguous, so test with
+      "if hits is not None and len(hits)>0".)
+    '''
+    if self.artfilereader._memos:
+      memo = self.artfilereader._memos.get(_tag_key(input_tag))
+      if memo!=None: return memo.get(self, input_tag)
+    return self.get_product(input_tag)
+  
+  def get_ID(self):
+    '''Returns (Run,SubRun,EventNumber).'''
+    self._open()
+    chunk = self._chunks.get('EventAuxiliary')
+    if chunk==None or not (chunk[0]<=self.entry<chunk[1]):
+      start = self.entry-self.entry%self.chunk_size
+      stop = min(start+self.chunk_size,self._n_entries())
+      chunk = self._chunks['EventAuxiliary'] = (
+        start,stop,None,_uproot_event_ids(self._tree,start,stop) )
+    return tuple( int(i) for i in chunk[3][self.entry-chunk[0]] )
+  
+  def get_run_ID(self): return self.get_ID()[0]
+  def get_subrun_ID(self): return self.get_ID()[1]
+  def get_event_ID(self): return self.get_ID()[2]
+  
+  def get_label(self, short=False):
+    '''Returns RunNN SubRunNN EventNN.'''
+    format_str = 'Run%d SubRun%d Event%d' if not short else 'r%ds%de%d'
+    return format_str%self.get_ID()
+  
+  def ls(self, pattern=None, regex=None):
+    return self.artfilereader.ls(pattern=pattern,regex=regex,sizes=True)
+  
+  get_records = get_record
+
+
+_serialize_md5_code = '''
+#include "TBufferFile.h"
+#include "TMD5.h"
+namespace heist_jit {
+std::string serialize_md5(void const* object, TClass* klass) {
+  TBufferFile buffer(TBuffer::kWrite);
+  buffer.WriteObjectAny(object, klass);
+  TMD5 md5;
+  md5.Update((UChar_t const*)buffer.Buffer(), buffer.Length());
+  md5.Final();
+  return md5.AsString();
+}
+}
+'''
+
+def _product_hash(product):
+  '''MD5 of a product's contents (serialized by ROOT, or numpy bytes).'''
+  if isinstance(product, numpy.ndarray):
+    return hashlib.md5(product.tostring()).hexdigest()
+  _jit_declare(_serialize_md5_code)
+  return str(ROOT.heist_jit.serialize_md5(
+    product, ROOT.TClass.GetClass(_cppname(product))))
+
+def _copy_product(product):
+  '''A copy of a product which stays valid when the event moves on.'''
+  if product is None or isinstance(product, numpy.ndarray): return product
+  return type(product)(product) # C++ copy constructor
+
+_memo_keys = {
+  'run': lambda event: event.get_run_ID(),
+  'subrun': lambda event: event.get_ID()[:2],
+}
+
+class ProductMemo(object):
+  '''LRU cache of one tag's (converted) product, see ArtFileReader.memoize().'''
+  def __init__(self, key='subrun', convert=None, max_entries=16):
+    if key!='content' and not callable(key) and key not in _memo_keys:
+      raise ValueError('key should be "subrun", "run", "content" or a function')
+    self.key = key
+    self.key_function = _memo_keys.get(key,key)
+    self.convert = convert
+    self.max_entries = max_entries
+    self.values = collections.OrderedDict()
+    self.hits = self.misses = self.evictions = 0
+  
+  def get(self, event, input_tag):
+    '''Returns the (converted) product, from the cache if the key matches.'''
+    product = None
+    if self.key=='content':
+      product = event.get_product(input_tag)
+      key = _product_hash(product) if product is not None else None
+    else: key = self.key_function(event)
+    value = self.values.pop(key,self) # (self: not found)
+    if value is not self:
+      self.hits += 1
+      self.values[key] = value # (most recently used goes last)
+      return value
+    self.misses += 1
+    if self.key!='content': product = event.get_product(input_tag)
+    if self.convert!=None: value = self.convert(product)
+    else:
+      value = _copy_product(product)
+      if not isinstance(value,numpy.ndarray) and value is not None and \
+          hasattr(value,'__len__') and len(value)==0: 
+        value = 0 # (like Event.get_record(); record arrays stay arrays)
+    self.values[key] = value
+    while len(self.values)>self.max_entries:
+      self.values.popitem(last=False)
+      self.evictions += 1
+    return value
+  
+  def stats(self):
+    lookups = self.hits+self.misses
+    return {'hits': self.hits, 'misses': self.misses, 
+      'evictions': self.evictions, 'entries': len(self.values),
+      'hit_rate': float(self.hits)/lookups if lookups else 0.}
+
+
+class PrefetchedEvent(object):
+  '''Copies of some products of one event (see ArtFileReader.prefetch_loop()).'''
+  def __init__(self, position, event, tags):
+    self.position = position
+    self.ID = event.get_ID()
+    self.products = {}
+    for tag in tags:
+      product = event.get_product(tag)
+      if product!=None: product = type(product)(product) # C++ copy
+      self.products[tag.branch_name] = product
+  
+  def get_product(self, input_tag):
+    '''Like Event.get_product(), for the prefetched tags only.'''
+    branch_name = intern_tag(input_tag).branch_name
+    if branch_name not in self.products: raise KeyError(
+      '%s was not prefetched (add it to the tags of prefetch_loop())'%(
+        branch_name,))
+    return self.products[branch_name]
+  
+  def get_record(self, input_tag):
+    '''Like Event.get_record(), for the prefetched tags only.'''
+    retval = self.get_product(input_tag)
+    if retval!=None and hasattr(retval,'__len__') and len(retval)==0: 
+      retval = 0
+    return retval
+  
+  def get_ID(self): return self.ID
+  def get_run_ID(self): return self.ID[0]
+  def get_subrun_ID(self): return self.ID[1]
+  def get_event_ID(self): return self.ID[2]
+  
+  def get_label(self, short=False):
+    '''Returns RunNN SubRunNN EventNN.'''
+    format_str = 'Run%d SubRun%d Event%d' if not short else 'r%ds%de%d'
+    return format_str%self.ID
+  
+  get_records = get_record
+
+class _PrefetchError(object):
+  '''Carries an exception from the prefetch thread to the loop.'''
+  def __init__(self, exc_info): self.exc_info = exc_info
+  def reraise(self): raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+def _release_gil(*methods):
+  '''Let these PyROOT methods release the GIL while in C++, if possible.
+  
+  (Supported by cppyy-based PyROOT, ROOT>=6.22; silently ignored otherwise.)
+  '''
+  for method in methods:
+    try: method.__release_gil__ = True
+    except (AttributeError,TypeError): pass
+
+
 class InputTag(object):
   '''Like art InputTag, but remembers type as well...
   
@@ -577,36 +3232,114 @@ class InputTag(object):
     else:
       raise ValueError('Please specify dtype and label (or at least quicktag).')
     
-    # save dtype string, then try to turn it into a type
+    # save dtype string; the type (and the art input tag) are only made 
+    #   when first needed, so tags can be parsed without ROOT
     self.dtype_string = dtype
-    try: 
-      self.dtype = eval(self.dtype_string)
-    except: 
-      raise ValueError('Could not resolve '+self.dtype_string+' to a valid type!')
+    self.cppname = _dtype_cppname(dtype)
+    self._label,self._instance,self._process = label,instance,process
+    self._dtype = self._input_tag = None
     
-    # Does this step have to occur before creating gallery::Event?
-    _do_declare_Ttype(self.dtype.__cppname__)
+    # name of the branch in the Events tree (without process, a tag matches
+    #   the branches of all processes, see _tag_branches())
+    self.branch_prefix = '%s_%s_%s_'%(
+      _friendly_type(self.cppname),label,instance)
+    self.branch_name = self.branch_prefix+process+'.'
+    self.any_process = process==''
     
-    # make an art input tag
-    self.input_tag = ROOT.art.InputTag(label,instance,process)
+    # Does this step have to occur before creating gallery::Event?
+    if ROOT._module is not None: self.dtype
+  
+  @property
+  def dtype(self):
+    '''The PyROOT type (declared to gallery on first use).'''
+    if self._dtype is None:
+      try: 
+        dtype = eval(self.dtype_string)
+      except: 
+        raise ValueError('Could not resolve '+self.dtype_string+' to a valid type!')
+      _do_declare_Ttype(dtype.__cppname__)
+      self._dtype = dtype
+    return self._dtype
+  
+  @property
+  def input_tag(self):
+    '''The art::InputTag (made on first use).'''
+    if self._input_tag is None:
+      self._input_tag = ROOT.art.InputTag(
+        self._label,self._instance,self._process)
+    return self._input_tag
       
   def label(self):
-    '''Passthrough to InputTag.label()'''
-    return self.input_tag.label()
+    '''Same as InputTag.label()'''
+    return self._label
   
   def instance(self):
-    '''Passthrough to InputTag.instance()'''
-    return self.input_tag.instance()
+    '''Same as InputTag.instance()'''
+    return self._instance
   
   def process(self):
-    '''Passthrough to InputTag.process()'''
-    return self.input_tag.process()
+    '''Same as InputTag.process()'''
+    return self._process
   
   def __str__(self):
-    return self.dtype.__cppname__+'_'+self.label()+'_'+self.instance()+'_'+self.process()
+    return self.cppname+'_'+self.label()+'_'+self.instance()+'_'+self.process()
+
 
 
 
+_interned_tags = {}
+def intern_tag(tag):
+  '''Returns the InputTag for a quicktag string (made only once per string).
+  
+  InputTags are returned as they are.  Event.get_record() uses this, so 
+    after the first event a quicktag costs one dict lookup instead of 
+    convert_quicktag(), eval() of the type and a new art::InputTag.
+  '''
+  if isinstance(tag,InputTag): return tag
+  try: return _interned_tags[tag]
+  except KeyError:
+    input_tag = _interned_tags[tag] = InputTag(quicktag=tag)
+    return input_tag
+
+def _tag_branches(tag, names):
+  '''Returns the product branches among names which tag reads.
+  
+  A tag without process (e.g. a 2 or 3 field quicktag) matches the branches
+    of all processes, like gallery does; others match their branch only.
+  '''
+  tag = intern_tag(tag)
+  if not tag.any_process:
+    return [ tag.branch_name ] if tag.branch_name in names else []
+  prefix = tag.branch_prefix
+  return sorted( 
+    name for name in names 
+    if name.startswith(prefix) and name.count('.')==1
+    and '_' not in name[len(prefix):]
+  )
+
+def _dtype_cppname(dtype_string):
+  '''C++ name of a type string of InputTag (no ROOT needed).
+  
+  For example 'ROOT.vector(ROOT.gm2calo.CrystalHitArtRecord)' gives
+    'vector<gm2calo::CrystalHitArtRecord>'.
+  '''
+  name = re.sub(r'\bROOT\.', '', dtype_string)
+  for quote in '\'"': name = name.replace(quote,'')
+  name = name.replace(' ','').replace('.','::').replace('(','<').replace(')','>')
+  while '>>' in name: name = name.replace('>>','> >')
+  return name
+
+def _friendly_type(cppname):
+  '''Returns art's 'friendly' name of a C++ type (as in branch names).
+  
+  For example 'vector<gm2calo::CrystalHitArtRecord>' gives
+    'gm2calo::CrystalHitArtRecords'.
+  '''
+  value_type = _vector_value_type(cppname)
+  if value_type!=None: return _friendly_type(value_type)+'s'
+  name = cppname.replace(' ','')
+  if name.startswith('std::'): name = name[5:]
+  return name
 
 def convert_quicktag(spec_str):
   '''Convert a string to an InputTag.
@@ -660,5 +3393,1101 @@ def convert_quicktag(spec_str):
 
 
 
+################################################################
+# parallel map/reduce over files
+
+import multiprocessing
+import traceback
+import copy
+
+class MapReduceResult(object):
+  '''What map_reduce_files() returns.
+  
+  value: partial results of all files merged (in filename order)
+  partials: {filename: partial result} for files that succeeded
+  failures: {filename: traceback string} for files that failed
+  n_events: {filename: number of events processed}
+  '''
+  def __init__(self, value, partials, failures, n_events):
+    self.value = value
+    self.partials = partials
+    self.failures = failures
+    self.n_events = n_events
+  
+  def ok(self): return len(self.failures)==0
+
+def _map_reduce_file(task):
+  '''Worker: reduce mapper(event) over all events of one file.'''
+  i_file,filename,mapper,reducer,initial,loop_kwargs = task
+  try:
+    reader = ArtFileReader(filename, quiet=True)
+    partial,n_events = copy.deepcopy(initial),0 # (initial may be mutable)
+    for event in reader.event_loop(**loop_kwargs):
+      n_events += 1
+      value = mapper(event)
+      if value is None: continue
+      partial = value if partial is None else reducer(partial,value)
+    return i_file,partial,n_events,None
+  except Exception:
+    return i_file,None,0,traceback.format_exc()
+
+def _file_weights(filenames, balance, backend='gallery', quiet=False, 
+    manifest=None
+  ):
+  '''Estimated cost of processing each file, for scheduling.
+  
+  For 'events', the counts come from manifest (a Manifest of the files) or
+    from sidecars; only files which are new or changed have the entry count
+    in the header of their Events tree read.  Files which can't be read get
+    weight 0 (and are reported, unless quiet; their task will fail and say 
+    why).
+  '''
+  if balance=='events':
+    records = manifest.records if manifest!=None else {}
+    def weight(filename):
+      if filename in records: return records[filename]['events']
+      return _load_entry_count(filename, backend)
+  elif balance=='size': weight = os.path.getsize
+  else: raise ValueError('balance should be "size" or "events"')
+  weights = []
+  for filename in filenames:
+    try: weights += [ weight(filename) ]
+    except Exception as error:
+      if not quiet: print 'Could not get the %s of %s: %s'%(
+        balance,filename,error)
+      weights += [ 0 ]
+  return weights
+
+def map_reduce_files(filenames, mapper, reducer, initial=None, nproc=None,
+    balance='size', quiet=False, manifest=None, **loop_kwargs
+  ):
+  '''Run mapper(event) over many files in worker processes and reduce.
+  
+  Each worker opens one file at a time with its own ArtFileReader, calls
+    mapper(event) in its event_loop(**loop_kwargs), and combines the return
+    values (ignoring None) with reducer(a,b).  The partial results of the 
+    files are then combined with reducer, in the order of filenames, so the 
+    result does not depend on which worker finished first.  (So reducer 
+    should be associative, e.g. operator.add.)
+  
+  initial: starting value for each file (default: first value from mapper)
+  nproc: number of worker processes (default: number of CPUs; 1 runs 
+    everything in this process, which is handy for debugging)
+  balance: 'size' or 'events'; files are handed out largest first, so the
+    workers finish at about the same time
+  manifest: a Manifest of the files, which has the event counts for 
+    balance='events' (otherwise they are cached in sidecars)
+  
+  mapper and reducer are sent to the workers by pickling, so they must be 
+    module-level functions (not lambdas).
+  
+  Failures are reported per file (see MapReduceResult.failures) instead of
+    stopping the whole job.
+  '''
+  if type(filenames)==str: filenames = [ filenames ]
+  filenames = list(filenames)
+  tasks = [ 
+    (i_file,filename,mapper,reducer,initial,loop_kwargs)
+    for i_file,filename in enumerate(filenames)
+  ]
+  return _run_file_tasks('map_reduce_files', _map_reduce_file, tasks, 
+    filenames, reducer, nproc, balance, quiet, manifest=manifest)
+
+def _run_file_tasks(what, worker, tasks, filenames, reducer, nproc, balance,
+    quiet, backend='gallery', manifest=None
+  ):
+  '''Run worker(task) for each file (task[0] is the file number), in a 
+    process pool, and reduce the partial results in filename order.'''
+  weights = _file_weights(filenames, balance, backend, quiet, manifest)
+  tasks = sorted(tasks, key=lambda task: -weights[task[0]])
+  
+  if nproc==None: nproc = multiprocessing.cpu_count()
+  nproc = max(1,min(nproc,len(tasks)))
+  results = {}
+  if nproc==1:
+    for task in tasks:
+      i_file,partial,n_events,error = worker(task)
+      results[i_file] = (partial,n_events,error)
+  else:
+    pool = multiprocessing.Pool(processes=nproc)
+    try:
+      for i_file,partial,n_events,error in pool.imap_unordered(
+          worker, tasks, chunksize=1):
+        results[i_file] = (partial,n_events,error)
+        if not quiet:
+          print '%s: %d/%d files done'%(what,len(results),len(tasks))
+    finally:
+      pool.close()
+      pool.join()
+  
+  value,partials,failures,n_events = None,{},{},{}
+  for i_file,filename in enumerate(filenames):
+    partial,n_events[filename],error = results[i_file]
+    if error!=None:
+      failures[filename] = error
+      if not quiet: print '%s: FAILED on %s:\n%s'%(what,filename,error)
+      continue
+    partials[filename] = partial
+    if partial is None: continue
+    # (copy, so a reducer which works in place leaves partials alone)
+    value = copy.deepcopy(partial) if value is None else reducer(value,partial)
+  return MapReduceResult(value, partials, failures, n_events)
+
+
+
+################################################################
+# uproot (pure Python) backend helpers; see UprootEvent
+
+uproot = _LazyModule('uproot')
+awkward = _LazyModule('awkward')
+
+def _uproot_tree(filename, treename='Events'):
+  return uproot.open(filename)[treename]
+
+def _uproot_num_entries(tree):
+  if hasattr(tree,'num_entries'): return tree.num_entries # uproot>=4
+  return tree.numentries
+
+def _uproot_branches(tree):
+  '''Returns {name: branch} of all branches (recursively) of a tree.'''
+  if hasattr(tree,'allitems'): # uproot3
+    return dict( 
+      (name.decode() if isinstance(name,bytes) else name,branch)
+      for name,branch in tree.allitems() )
+  return dict( (branch.name,branch) for branch in tree.values(recursive=True) )
+
+def _uproot_array(branch, start, stop, library='ak'):
+  if hasattr(branch,'num_entries'): # uproot>=4
+    return branch.array(library=library, entry_start=start, entry_stop=stop)
+  return branch.array(entrystart=start, entrystop=stop)
+
+def _uproot_jagged(branch, start, stop):
+  '''Returns (counts,flat numpy array) of a branch for entries [start,stop).'''
+  array = _uproot_array(branch,start,stop)
+  if hasattr(array,'counts'): # uproot3 JaggedArray
+    return numpy.asarray(array.counts),numpy.asarray(array.content)
+  if hasattr(array,'ndim') and hasattr(array,'layout'): # awkward>=1
+    if array.ndim==1: flat = awkward.to_numpy(array)
+    else:
+      return (awkward.to_numpy(awkward.num(array)),
+        awkward.to_numpy(awkward.flatten(array)))
+  else: flat = numpy.asarray(array)
+  return numpy.ones(len(flat),dtype='int64'),flat
+
+def _uproot_member(obj, name):
+  '''Data member of an object deserialized by uproot (any version).'''
+  if hasattr(obj,'member'): return obj.member(name)
+  for attribute in (name,'_'+name):
+    if hasattr(obj,attribute): return getattr(obj,attribute)
+  raise AttributeError('uproot object has no member %s'%(name,))
+
+def _uproot_event_ids(tree, start, stop):
+  '''Returns (n,3) array of (run,subrun,event) for entries [start,stop).'''
+  branches = _uproot_branches(tree)
+  split = [ 
+    [ n for n in branches if n.startswith('EventAuxiliary') and n.endswith(s) ]
+    for s in ('id_.subRun_.run_.run_','id_.subRun_.subRun_','id_.event_') 
+  ]
+  if all(split):
+    return numpy.column_stack([ 
+      _uproot_jagged(branches[names[0]],start,stop)[1] for names in split 
+    ]).astype('int64')
+  # EventAuxiliary not split: deserialize it (slower, but only 3 numbers)
+  ids = []
+  for auxiliary in _uproot_array(branches['EventAuxiliary'],start,stop,'np'):
+    event_id = _uproot_member(auxiliary,'id_')
+    subrun_id = _uproot_member(event_id,'subRun_')
+    ids += [ (
+      _uproot_member(_uproot_member(subrun_id,'run_'),'run_'),
+      _uproot_member(subrun_id,'subRun_'),
+      _uproot_member(event_id,'event_'),
+    ) ]
+  return numpy.array(ids,dtype='int64').reshape(-1,3)
+
+def _match_product_branch(tag, branches):
+  '''Returns the product branch name for a quicktag (or InputTag).
+  
+  Trailing fields of the quicktag may be left out, as long as only one 
+    product branch matches.
+  '''
+  if isinstance(tag,InputTag): 
+    matches = _tag_branches(tag, branches)
+    if len(matches)!=1: raise KeyError(
+      '%s matches %d products'%(tag.branch_name,len(matches)))
+    return matches[0]
+  fields = tag.rstrip('.').split('_')
+  matches = [ 
+    name for name in branches 
+    if _is_product_branch(name) and name.count('.')==1
+    and name.rstrip('.').split('_')[:len(fields)]==fields
+  ]
+  if len(matches)!=1: raise KeyError(
+    '%s matches %d products'%(tag,len(matches)))
+  return matches[0]
+
+def _uproot_leaf_members(branches, branch_name):
+  '''Names (after 'obj.') of the leaf sub-branches of a product branch.'''
+  prefix = branch_name+'obj.'
+  names = [ name for name in branches if name.startswith(prefix) ]
+  return sorted( 
+    name[len(prefix):] for name in names 
+    if not any(other.startswith(name+'.') for other in names)
+  )
+
+def _uproot_columns(tree, branches, branch_name, members, start, stop):
+  '''JaggedColumns of members of a product for entries [start,stop).'''
+  columns,offsets = {},None
+  for member in members:
+    counts,columns[member] = _uproot_jagged(
+      branches[branch_name+'obj.'+member],start,stop)
+    if offsets is None: offsets = numpy.concatenate([[0],numpy.cumsum(counts)])
+  if offsets is None: offsets = numpy.zeros(stop-start+1,dtype='int64')
+  return JaggedColumns(columns, offsets.astype('int64'),
+    _uproot_event_ids(tree,start,stop))
+
+def _read_catalog_uproot(filename):
+  '''Like _read_catalog(), with uproot.'''
+  records = []
+  for name,branch in sorted(_uproot_branches(_uproot_tree(filename)).items()):
+    if not _is_product_branch(name) or name.count('.')!=1: continue
+    try: class_name = _uproot_member(branch,'fClassName')
+    except (AttributeError,KeyError): class_name = '' # (not a TBranchElement)
+    if hasattr(branch,'num_entries'): # uproot>=4
+      entries = branch.num_entries
+      tot_bytes,zip_bytes = branch.uncompressed_bytes,branch.compressed_bytes
+    else:
+      entries = branch.numentries
+      tot_bytes = branch.uncompressedbytes()
+      zip_bytes = branch.compressedbytes()
+    records += [ {
+      'name': name.rstrip('.'),
+      'class_name': str(class_name),
+      'product_type': _unwrap_class_name(str(class_name)),
+      'entries': int(entries),
+      'total_size': int(tot_bytes),
+      'tot_bytes': int(tot_bytes),
+      'zip_bytes': int(zip_bytes),
+    } ]
+  return records
+
+
+
+################################################################
+# skims: selected members of selected events, in one npz file
+
+def _tag_key(tag):
+  '''Name of a tag in a skim (the quicktag, without the trailing '.').'''
+  if isinstance(tag,InputTag): return tag.branch_name.rstrip('.')
+  return tag.rstrip('.')
+
+class _RecordFiller(object):
+  '''Like ColumnFiller, for products which are numpy record arrays.'''
+  def __init__(self, members):
+    self.members = list(members)
+    self.reset()
+  
+  def reset(self):
+    self.arrays = dict( (m,[]) for m in self.members )
+    self.offsets = [ 0 ]
+    self.ids = []
+  
+  def __len__(self): return len(self.offsets)-1
+  
+  def fill(self, product, event_id=(0,0,0)):
+    n = 0
+    if product is not None:
+      for member in self.members: 
+        self.arrays[member] += [ numpy.atleast_1d(product[member]) ]
+      n = len(self.arrays[self.members[0]][-1])
+    self.offsets += [ self.offsets[-1]+n ]
+    self.ids += [ event_id ]
+  
+  def flush(self):
+    columns = dict( 
+      (m,numpy.concatenate(a) if len(a)>0 else numpy.zeros(0)) 
+      for m,a in self.arrays.items() )
+    retval = JaggedColumns(columns, self.offsets, self.ids)
+    self.reset()
+    return retval
+
+def _write_skim(filename, ids, tag_columns, sources=(), presence=None):
+  '''Save event ids and [(tag key,JaggedColumns)] to an npz skim file.
+  
+  presence has, for each tag, whether each event had the product (default:
+    all did); a skim tells an absent product (None) from an empty one (0).
+  '''
+  arrays = { 'ids': numpy.array(ids,dtype='int64').reshape(-1,3) }
+  header = { 'version': 2, 'sources': list(sources), 'tags': [] }
+  for i_tag,(key,columns) in enumerate(tag_columns):
+    members = sorted(columns.keys())
+    header['tags'] += [ {'key': key, 'members': members} ]
+    arrays['t%d_offsets'%i_tag] = columns.offsets
+    arrays['t%d_present'%i_tag] = numpy.ones(len(columns),dtype=bool) \
+      if presence==None else numpy.asarray(presence[i_tag],dtype=bool)
+    for i_member,member in enumerate(members):
+      arrays['t%d_m%d'%(i_tag,i_member)] = columns[member]
+  arrays['header'] = numpy.array(json.dumps(header))
+  _atomic_write(filename, lambda fileobj: numpy.savez(fileobj, **arrays))
+
+
+class SkimEvent(object):
+  '''One event of a SkimReader (what SkimReader.event_loop() yields).'''
+  def __init__(self, skim):
+    self.skim = skim
+    self.position = 0
+  
+  def get_record(self, tag):
+    '''Returns the skimmed members as a numpy record array.
+    
+    Like UprootEvent.get_record(): None if the event had no such product,
+      an empty record array if it was empty (so test with 
+      "if hits is not None and len(hits)>0").
+    '''
+    key = self.skim.find_tag(tag)
+    present = self.skim.presence.get(key)
+    if present is not None and not present[self.position]: return None
+    columns = self.skim.columns[key]
+    start,stop = columns.offsets[self.position:self.position+2]
+    members = sorted(columns.keys())
+    return numpy.rec.fromarrays(
+      [ columns[m][start:stop] for m in members ], names=members)
+  
+  get_records = get_product = get_record
+  
+  def get_ID(self): 
+    return tuple( int(i) for i in self.skim.ids[self.position] )
+  def get_run_ID(self): return self.get_ID()[0]
+  def get_subrun_ID(self): return self.get_ID()[1]
+  def get_event_ID(self): return self.get_ID()[2]
+  
+  def get_label(self, short=False):
+    '''Returns RunNN SubRunNN EventNN.'''
+    format_str = 'Run%d SubRun%d Event%d' if not short else 'r%ds%de%d'
+    return format_str%self.get_ID()
+
+
+class SkimReader(object):
+  '''Reads a skim written by ArtFileReader.skim().
+  
+  Works like a (much faster) ArtFileReader over the skimmed events:
+    event_loop() yields SkimEvents, whose get_record(tag) returns the 
+    skimmed members of the product as a numpy record array, and 
+    get_columns(tag) returns JaggedColumns for all events at once.  Tags
+    may be shortened (trailing fields left out) if that is unambiguous.
+  '''
+  def __init__(self, filename, quiet=False):
+    self.filename = filename
+    self.quiet = quiet
+    with numpy.load(filename) as npz:
+      header = json.loads(str(npz['header']))
+      self.sources = [ str(source) for source in header['sources'] ]
+      self.ids = npz['ids']
+      self.columns = {}
+      self.presence = {} # (not in version 1 skims)
+      for i_tag,tag in enumerate(header['tags']):
+        members = [ str(member) for member in tag['members'] ]
+        self.columns[str(tag['key'])] = JaggedColumns(
+          dict( (m,npz['t%d_m%d'%(i_tag,i_member)]) 
+            for i_member,m in enumerate(members) ),
+          npz['t%d_offsets'%i_tag], self.ids
+        )
+        if 't%d_present'%i_tag in npz.files:
+          self.presence[str(tag['key'])] = npz['t%d_present'%i_tag]
+    self.event = SkimEvent(self)
+    self.i_event = self.i_loop = 0
+  
+  def __len__(self): return len(self.ids)
+  def n_entries(self): return len(self.ids)
+  def list_records(self): return sorted(self.columns)
+  
+  def find_tag(self, tag):
+    '''Returns the key of a tag in this skim (KeyError if not unique).'''
+    key = _tag_key(tag)
+    if key in self.columns: return key
+    fields = key.split('_')
+    matches = [ 
+      k for k in self.columns if k.split('_')[:len(fields)]==fields ]
+    if len(matches)!=1: raise KeyError(
+      '%s matches %d tags in %s'%(tag,len(matches),self.filename))
+    return matches[0]
+  
+  def event_loop(self, evt_list=None, event_list=None, nmax=None, select=None):
+    '''Yield a SkimEvent for every (selected) event, like ArtFileReader.'''
+    if _no_selection(event_list): event_list = evt_list
+    positions = xrange(len(self))
+    if not _no_selection(event_list):
+      if isinstance(event_list,slice): 
+        positions = xrange(*event_list.indices(len(self)))
+      else: positions = sorted(set(event_list))
+    self.i_event = 0
+    for self.i_loop in positions:
+      if nmax!=None and self.i_event>=nmax: break
+      if self.i_loop<0 or self.i_loop>=len(self): continue
+      if select!=None and not select(tuple(self.ids[self.i_loop])): continue
+      self.event.position = self.i_loop
+      yield self.event
+      self.i_event += 1
+  
+  def get_columns(self, tag, members=None):
+    '''Returns JaggedColumns of (some of the) skimmed members of tag.'''
+    columns = self.columns[self.find_tag(tag)]
+    if members==None: return columns
+    return JaggedColumns(dict( (m,columns[m]) for m in members ),
+      columns.offsets, columns.ids)
+  
+  def iter_columns(self, tag, members=None, chunk_size=1000):
+    '''Yield get_columns(tag, members) in chunks of chunk_size events.'''
+    columns = self.get_columns(tag, members)
+    for start in xrange(0, len(columns), chunk_size):
+      yield columns.take(numpy.arange(start,min(start+chunk_size,len(columns))))
+  
+  def goto(self, run, subrun, event):
+    '''Returns the SkimEvent for (run,subrun,event) (KeyError if absent).'''
+    matches = numpy.nonzero( 
+      (self.ids==numpy.array([run,subrun,event])).all(axis=1) )[0]
+    if len(matches)==0: 
+      raise KeyError('%s not in %s'%((run,subrun,event),self.filename))
+    self.event.position = int(matches[0])
+    return self.event
+
+
+
+################################################################
+# streaming aggregation: histograms and statistics filled chunk by chunk
+
+class _Aggregate(object):
+  '''Base of Hist1D and FieldStats: per-group numpy arrays, mergeable.
+  
+  field, weight and group_by are members (or expressions, see ColumnFiller)
+    of the records.  Without group_by everything goes into group None.
+  '''
+  def __init__(self, field, weight=None, group_by=None):
+    self.field = field
+    self.weight = weight
+    self.group_by = group_by
+    self.data = {} # group -> numpy array(s) (see _empty())
+  
+  def members(self):
+    return [ m for m in (self.field,self.weight,self.group_by) if m!=None ]
+  
+  def groups(self): return sorted(self.data)
+  
+  def _group_index(self, columns):
+    '''Returns (group keys, group number of each element).'''
+    if self.group_by==None: 
+      return [None],numpy.zeros(len(columns[self.field]),dtype='int64')
+    keys,inverse = numpy.unique(columns[self.group_by], return_inverse=True)
+    return [ key.item() for key in keys ],inverse
+  
+  def _group(self, key):
+    if key not in self.data: self.data[key] = self._empty()
+    return self.data[key]
+  
+  def _result(self, key):
+    return self.data[key] if key in self.data else self._empty()
+  
+  def _check_compatible(self, other):
+    if type(other)!=type(self) or other.members()!=self.members():
+      raise ValueError('Cannot merge %r with %r'%(self,other))
+  
+  def __add__(self, other):
+    return copy.deepcopy(self).merge(other)
+  
+  def __repr__(self):
+    return '<heist.%s of %s (%d groups)>'%(
+      type(self).__name__,self.field,len(self.data))
+
+
+class Hist1D(_Aggregate):
+  '''Histogram of one member of records, weighted and/or grouped.
+  
+  Binning: bins uniform bins over range=(low,high), or bin edges.  
+    Values below the first edge go to the underflow, values at or above 
+    the last edge to the overflow.
+  
+  counts(group) and errors(group) are per bin; underflow(group) and 
+    overflow(group) are what fell outside.
+  '''
+  def __init__(self, field, bins=100, range=None, edges=None, weight=None,
+      group_by=None
+    ):
+    _Aggregate.__init__(self, field, weight, group_by)
+    if edges is None:
+      if range is None: raise ValueError('Specify range (or edges)!')
+      edges = numpy.linspace(range[0], range[1], bins+1)
+    self.edges = numpy.asarray(edges, dtype='float64')
+  
+  def _empty(self): 
+    return numpy.zeros((2,len(self.edges)+1)) # sum of w, sum of w**2
+  
+  def fill(self, columns):
+    '''Add the elements of a chunk (JaggedColumns, or {member: array}).'''
+    keys,group = self._group_index(columns)
+    n_bins = len(self.edges)+1
+    index = group*n_bins + numpy.searchsorted(
+      self.edges, columns[self.field], side='right')
+    size = len(keys)*n_bins
+    if self.weight==None: 
+      sumw = sumw2 = numpy.bincount(index, minlength=size)
+    else:
+      weights = numpy.asarray(columns[self.weight], dtype='float64')
+      sumw = numpy.bincount(index, weights, minlength=size)
+      sumw2 = numpy.bincount(index, weights**2, minlength=size)
+    sumw,sumw2 = sumw.reshape(-1,n_bins),sumw2.reshape(-1,n_bins)
+    for i_key,key in enumerate(keys):
+      data = self._group(key)
+      data[0] += sumw[i_key]
+      data[1] += sumw2[i_key]
+    return self
+  
+  def merge(self, other):
+    '''Add other (a Hist1D with the same fields and binning) to this.'''
+    self._check_compatible(other)
+    if not numpy.array_equal(self.edges,other.edges):
+      raise ValueError('Cannot merge histograms with different binning!')
+    for key,data in other.data.items(): self._group(key)[...] += data
+    return self
+  
+  def counts(self, group=None): return self._result(group)[0][1:-1]
+  def errors(self, group=None): return numpy.sqrt(self._result(group)[1][1:-1])
+  def underflow(self, group=None): return self._result(group)[0][0]
+  def overflow(self, group=None): return self._result(group)[0][-1]
+  
+  def centers(self): return 0.5*(self.edges[1:]+self.edges[:-1])
+
+
+class FieldStats(_Aggregate):
+  '''Count, (weighted) sum, mean, standard deviation, min and max of a member.
+  '''
+  def _empty(self):
+    # n, sum of w, sum of w*x, sum of w*x**2, min, max
+    return numpy.array([0.,0.,0.,0.,numpy.inf,-numpy.inf])
+  
+  def fill(self, columns):
+    '''Add the elements of a chunk (JaggedColumns, or {member: array}).'''
+    keys,group = self._group_index(columns)
+    values = numpy.asarray(columns[self.field], dtype='float64')
+    weights = numpy.ones(len(values)) if self.weight==None \
+      else numpy.asarray(columns[self.weight], dtype='float64')
+    sums = [ numpy.bincount(group, w, minlength=len(keys)) 
+      for w in (None,weights,weights*values,weights*values**2) ]
+    minima = numpy.full(len(keys), numpy.inf)
+    maxima = numpy.full(len(keys), -numpy.inf)
+    numpy.minimum.at(minima, group, values)
+    numpy.maximum.at(maxima, group, values)
+    for i_key,key in enumerate(keys):
+      data = self._group(key)
+      data[:4] += [ s[i_key] for s in sums ]
+      data[4] = min(data[4],minima[i_key])
+      data[5] = max(data[5],maxima[i_key])
+    return self
+  
+  def merge(self, other):
+    '''Add other (FieldStats of the same fields) to this.'''
+    self._check_compatible(other)
+    for key,data in other.data.items():
+      mine = self._group(key)
+      mine[:4] += data[:4]
+      mine[4],mine[5] = min(mine[4],data[4]),max(mine[5],data[5])
+    return self
+  
+  def n(self, group=None): return int(self._result(group)[0])
+  def sum(self, group=None): return self._result(group)[2]
+  def min(self, group=None): return self._result(group)[4]
+  def max(self, group=None): return self._result(group)[5]
+  
+  def mean(self, group=None):
+    n,sumw,sumwx,sumwx2 = self._result(group)[:4]
+    return sumwx/sumw if sumw else float('nan')
+  
+  def std(self, group=None):
+    n,sumw,sumwx,sumwx2 = self._result(group)[:4]
+    if not sumw: return float('nan')
+    return numpy.sqrt(max(0.,sumwx2/sumw-(sumwx/sumw)**2))
+
+
+def merge_aggregates(a, b):
+  '''Merge two {name: aggregate} dicts (e.g. from two files) into a new one.'''
+  merged = copy.deepcopy(a)
+  for name,aggregate in b.items():
+    if name in merged: merged[name].merge(aggregate)
+    else: merged[name] = copy.deepcopy(aggregate)
+  return merged
+
+def _aggregate_file(task):
+  '''Worker: ArtFileReader.aggregate() over one file.'''
+  i_file,filename,input_tag,aggregates,backend,chunk_size,loop_kwargs = task
+  try:
+    aggregates = copy.deepcopy(aggregates) # (a fresh copy for each file)
+    reader = ArtFileReader(filename, quiet=True, backend=backend)
+    aggregates = reader.aggregate(
+      input_tag, aggregates, chunk_size, **loop_kwargs)
+    return i_file,aggregates,reader.i_event or 0,None
+  except Exception:
+    return i_file,None,0,traceback.format_exc()
+
+def aggregate_files(filenames, input_tag, aggregates, nproc=None,
+    balance='size', quiet=False, backend='gallery', chunk_size=1000, 
+    manifest=None, **loop_kwargs
+  ):
+  '''ArtFileReader.aggregate() over many files in worker processes.
+  
+  Each worker fills its own copy of aggregates for one file at a time; the
+    results are merged in the order of filenames.  input_tag should be a 
+    quicktag (string), since it is sent to the workers by pickling.  Other
+    arguments are as for map_reduce_files().
+  
+  Returns a MapReduceResult; its value is the merged {name: aggregate}.
+  '''
+  if type(filenames)==str: filenames = [ filenames ]
+  filenames = list(filenames)
+  tasks = [
+    (i_file,filename,input_tag,aggregates,backend,chunk_size,loop_kwargs)
+    for i_file,filename in enumerate(filenames)
+  ]
+  return _run_file_tasks('aggregate_files', _aggregate_file, tasks, 
+    filenames, merge_aggregates, nproc, balance, quiet, backend, manifest)
+
+
+
+################################################################
+# staging: local copies of files on slow or remote storage
+
+import shutil
+import fcntl
+
+class StagingCache(object):
+  '''Size-bounded pool of local copies of files, shared by jobs on a node.
+  
+  stage(filename) copies a file to directory (if it is not there yet) and 
+    returns the local path.  advance(filenames, i_file) copies the next 
+    ahead files in a background thread, so they are ready when the event
+    loop gets there.  ArtFileReader(..., staging=...) does both for you.
+  
+  Copies are named after the file's path, size and mtime, so a changed 
+    file is copied again.  When the pool would grow beyond max_bytes, the
+    least recently used copies are deleted, except those which some job 
+    (this one or another) is still using: jobs hold a shared flock on the
+    copies they use, and eviction skips files it can't lock exclusively.
+  
+  stats() has hits, misses, bytes copied and time spent copying/waiting.
+  '''
+  def __init__(self, directory=None, max_bytes=50*1024**3, ahead=2,
+      quiet=True
+    ):
+    self.directory = directory if directory!=None else os.environ.get(
+      'HEIST_STAGING_DIR', os.path.join(cache_dir,'staging'))
+    if not os.path.isdir(self.directory): os.makedirs(self.directory)
+    self.max_bytes = max_bytes
+    self.ahead = ahead
+    self.quiet = quiet
+    self._pins = {}            # local path -> open file (with LOCK_SH)
+    self._lock = threading.Lock()
+    self._queue = Queue.Queue()
+    self._queued = set()
+    self._window = set()       # local paths of the files advance() wants
+    self._worker = None
+    self._stats = {'hits':0, 'misses':0, 'bytes_copied':0, 'copy_time':0.,
+      'wait_time':0., 'evictions':0, 'background_copies':0}
+  
+  def local_path(self, filename):
+    '''Where the copy of filename is (or will be).'''
+    size,mtime = _file_stamp(filename)
+    key = hashlib.md5('%s|%d|%r'%(os.path.abspath(filename),size,mtime))
+    return os.path.join(self.directory,
+      '%s_%s'%(key.hexdigest()[:12],os.path.basename(filename)))
+  
+  def _count(self, name, value=1):
+    with self._lock: self._stats[name] += value
+  
+  def stage(self, filename, background=False):
+    '''Copy filename to the pool (unless it is there); returns local path.'''
+    path = self.local_path(filename)
+    start = time.time()
+    with self._lock_file(path+'.lock') as lock: # one copier per file (any job)
+      try:
+        if os.path.exists(path): 
+          if not background: self._count('hits')
+        else:
+          if not background: self._count('misses')
+          self._copy(filename, path)
+          if background: self._count('background_copies')
+        os.utime(path, None) # for LRU (before anyone can evict it)
+        # (a background copy the loop has moved past is not kept pinned)
+        self._pin(path, only_in_window=background)
+      finally: fcntl.flock(lock, fcntl.LOCK_UN)
+    if not background: self._count('wait_time',time.time()-start)
+    return path
+  
+  def _lock_file(self, lock_path):
+    '''Open lock_path with an exclusive flock (retrying if it was evicted).'''
+    while True:
+      lock = open(lock_path,'a')
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try: 
+        if os.stat(lock_path).st_ino==os.fstat(lock.fileno()).st_ino: 
+          return lock
+      except OSError: pass # removed by _evict() while we waited
+      lock.close()
+  
+  def _copy(self, filename, path):
+    size = os.path.getsize(filename)
+    self._evict(size)
+    start = time.time()
+    tmp_path = '%s.tmp%d'%(path,os.getpid())
+    try:
+      with open(filename,'rb') as source, open(tmp_path,'wb') as target:
+        shutil.copyfileobj(source, target, 16*1024**2)
+      os.rename(tmp_path,path)
+    except:
+      if os.path.exists(tmp_path): os.remove(tmp_path)
+      raise
+    self._count('bytes_copied',size)
+    self._count('copy_time',time.time()-start)
+    if not self.quiet: print 'Staged %s (%.1f MB)'%(filename,size/1024.**2)
+  
+  def _pin(self, path, only_in_window=False):
+    '''Keep path from being evicted (by any job) until _unpin(path).
+    
+    With only_in_window, only if advance() still wants path.
+    '''
+    with self._lock:
+      if path in self._pins: return
+      if only_in_window and path not in self._window: return
+      fileobj = open(path,'rb')
+      fcntl.flock(fileobj, fcntl.LOCK_SH)
+      self._pins[path] = fileobj
+  
+  def _unpin(self, path):
+    with self._lock: fileobj = self._pins.pop(path,None)
+    if fileobj!=None: fileobj.close() # (releases the flock)
+  
+  def _evict(self, needed):
+    '''Delete least recently used copies until needed bytes fit.'''
+    with open(os.path.join(self.directory,'.lock'),'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        copies = []
+        for name in os.listdir(self.directory):
+          path = os.path.join(self.directory,name)
+          if name.startswith('.') or name.endswith('.lock') \
+              or '.tmp' in name or not os.path.isfile(path): continue
+          stat = os.stat(path)
+          copies += [ (stat.st_mtime,stat.st_size,path) ]
+        total = sum( size for mtime,size,path in copies )
+        for mtime,size,path in sorted(copies):
+          if total+needed<=self.max_bytes: break
+          if path in self._pins: continue
+          try:
+            with open(path+'.lock','a') as file_lock, \
+                open(path,'rb') as fileobj:
+              fcntl.flock(file_lock, fcntl.LOCK_EX|fcntl.LOCK_NB)
+              fcntl.flock(fileobj, fcntl.LOCK_EX|fcntl.LOCK_NB)
+              os.remove(path)
+              os.remove(path+'.lock')
+          except (IOError,OSError): continue # in use by another job
+          total -= size
+          self._count('evictions')
+      finally: fcntl.flock(lock, fcntl.LOCK_UN)
+  
+  def advance(self, filenames, i_file):
+    '''The loop is now at filenames[i_file]: stage the next few files.
+    
+    Files before i_file are released (they may be evicted again).
+    '''
+    upcoming = filenames[i_file+1:i_file+self.ahead+1]
+    window = set( self.local_path(f) for f in [filenames[i_file]]+upcoming )
+    with self._lock: self._window = window
+    for path in list(self._pins):
+      if path not in window: self._unpin(path)
+    for filename in upcoming:
+      with self._lock:
+        if filename in self._queued: continue
+        self._queued.add(filename)
+      self._queue.put(filename)
+    if self._worker==None or not self._worker.is_alive():
+      self._worker = threading.Thread(target=self._work)
+      self._worker.daemon = True
+      self._worker.start()
+  
+  def _work(self):
+    while True:
+      filename = self._queue.get()
+      try: self.stage(filename, background=True)
+      except Exception as error:
+        if not self.quiet: print 'Staging %s failed: %s'%(filename,error)
+      finally:
+        with self._lock: self._queued.discard(filename)
+  
+  def release(self):
+    '''Release all pinned copies (e.g. at the end of a job).'''
+    with self._lock: self._window = set()
+    for path in list(self._pins): self._unpin(path)
+  
+  def stats(self):
+    with self._lock: stats = dict(self._stats)
+    lookups = stats['hits']+stats['misses']
+    stats['hit_rate'] = float(stats['hits'])/lookups if lookups else 0.
+    return stats
+  
+  def print_stats(self):
+    stats = self.stats()
+    print 'staging: %d hits, %d misses (%.0f%%), %.1f MB copied in %.2f s,' \
+      ' waited %.2f s, %d evictions'%(stats['hits'],stats['misses'],
+      100*stats['hit_rate'],stats['bytes_copied']/1024.**2,
+      stats['copy_time'],stats['wait_time'],stats['evictions'])
+
+
+
+################################################################
+# server: keep readers warm in one process, query them over a Unix socket
+
+import socket
+import struct
+import SocketServer
+
+default_socket = os.environ.get('HEIST_SOCKET',
+  os.path.join(cache_dir,'heist-%d.sock'%(os.getuid(),)))
+
+def _send_message(sock, header, arrays=None):
+  '''Send a JSON header plus numpy arrays (raw bytes, described in header).
+  
+  Format: 4-byte big-endian length, the JSON, then the arrays' bytes.
+  '''
+  arrays = arrays or {}
+  header = dict(header)
+  header['arrays'] = [ 
+    (name,array.dtype.str,array.shape,array.nbytes) 
+    for name,array in sorted(arrays.items()) ]
+  data = json.dumps(header)
+  sock.sendall(struct.pack('>I',len(data))+data)
+  for name,array in sorted(arrays.items()):
+    sock.sendall(numpy.ascontiguousarray(array).tostring())
+
+def _recv_exactly(sock, n):
+  chunks,remaining = [],n
+  while remaining>0:
+    chunk = sock.recv(min(remaining,4*1024**2))
+    if not chunk: raise EOFError('Connection closed')
+    chunks += [ chunk ]
+    remaining -= len(chunk)
+  return ''.join(chunks)
+
+def _recv_message(sock):
+  '''Returns (header,{name: numpy array}) sent by _send_message().'''
+  length, = struct.unpack('>I',_recv_exactly(sock,4))
+  header = json.loads(_recv_exactly(sock,length))
+  arrays = {}
+  for name,dtype,shape,nbytes in header.pop('arrays'):
+    if nbytes==0: arrays[str(name)] = numpy.zeros(shape,dtype=str(dtype))
+    else: arrays[str(name)] = numpy.frombuffer(
+      _recv_exactly(sock,nbytes),dtype=str(dtype)).reshape(shape)
+  return header,arrays
+
+def _columns_arrays(columns, prefix=''):
+  '''JaggedColumns as {name: array} for _send_message().'''
+  arrays = { prefix+'offsets': columns.offsets, prefix+'ids': columns.ids }
+  for member in columns.keys(): arrays[prefix+'column:'+member] = columns[member]
+  return arrays
+
+def _arrays_columns(arrays, prefix=''):
+  '''Inverse of _columns_arrays().'''
+  columns = dict( (name[len(prefix)+7:],array) 
+    for name,array in arrays.items() if name.startswith(prefix+'column:') )
+  return JaggedColumns(columns, arrays[prefix+'offsets'], arrays[prefix+'ids'])
+
+
+class _HeistRequestHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    while True:
+      try: header,arrays = _recv_message(self.connection)
+      except EOFError: return
+      try: 
+        reply,reply_arrays = self.server.handle_command(header)
+      except Exception:
+        reply,reply_arrays = {'error': traceback.format_exc()},{}
+      _send_message(self.connection, reply, reply_arrays)
+      if header.get('command')=='shutdown': return
+
+
+class HeistServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  '''Keeps ArtFileReaders (and everything ROOT has JIT-compiled) alive.
+  
+  Clients (HeistClient) send commands over a Unix socket.  Each connection
+    gets its own thread, so an idle client does not keep others waiting, 
+    but commands are run one at a time (under a lock), so ROOT and the 
+    readers are never used by two threads at once.  Readers are kept per 
+    list of files, so their handle types, catalogs, indexes and 
+    ColumnFillers are only set up by the first query.
+  
+  Start with heist.serve() or 'python heist.py serve [SOCKET]'.
+  '''
+  def __init__(self, path=default_socket, quiet=False):
+    if os.path.exists(path): 
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try: 
+        probe.connect(path)
+        raise IOError('A heist server is already listening on %s'%(path,))
+      except socket.error: os.remove(path) # left over from a dead server
+      finally: probe.close()
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+      os.makedirs(os.path.dirname(os.path.abspath(path)))
+    SocketServer.UnixStreamServer.__init__(self, path, _HeistRequestHandler)
+    self.daemon_threads = True
+    self._lock = threading.Lock() # one command at a time
+    self.path = path
+    self.quiet = quiet
+    self.readers = {}   # (filenames,backend) -> ArtFileReader
+    self.fillers = {}   # (tag,members,backend) -> ColumnFiller
+    self.started = time.time()
+    self.n_commands = 0
+  
+  def reader(self, header):
+    filenames = header['filenames']
+    if isinstance(filenames,basestring): filenames = [ filenames ]
+    filenames = tuple( str(f) for f in filenames )
+    backend = str(header.get('backend','gallery'))
+    key = (filenames,backend)
+    if key not in self.readers:
+      if not self.quiet: print 'heist server: opening %s'%(filenames,)
+      self.readers[key] = ArtFileReader(
+        list(filenames), quiet=True, backend=backend)
+    return self.readers[key]
+  
+  def handle_command(self, header):
+    '''Returns (reply header, reply arrays) for a command.'''
+    command = header.get('command')
+    function = getattr(self, 'command_'+str(command), None)
+    if function==None: raise ValueError('Unknown command %r'%(command,))
+    with self._lock:
+      self.n_commands += 1
+      return function(header)
+  
+  def command_ping(self, header):
+    return {'pid': os.getpid(), 'uptime': time.time()-self.started,
+      'readers': len(self.readers), 'commands': self.n_commands},{}
+  
+  def command_open(self, header):
+    reader = self.reader(header)
+    return {'n_entries': reader.n_entries(), 
+      'entries_per_file': reader.entries_per_file()},{}
+  
+  def command_list_records(self, header):
+    return {'records': self.reader(header).catalog().records(
+      header.get('pattern'), header.get('regex'))},{}
+  
+  def command_event(self, header):
+    '''Members of some products of the event with a given ID.'''
+    reader = self.reader(header)
+    event = reader.goto(*header['id'])
+    arrays = {}
+    for i_tag,(tag,members) in enumerate(header['tags']):
+      tag,members = str(tag),tuple( str(m) for m in members )
+      key = (tag,members,reader.backend)
+      if key not in self.fillers: 
+        self.fillers[key] = reader._skim_filler(tag, members)
+      filler = self.fillers[key]
+      filler.fill(event.get_product(
+        intern_tag(tag) if reader.backend=='gallery' else tag), event.get_ID())
+      arrays.update(_columns_arrays(filler.flush(), 't%d:'%i_tag))
+    return {'id': list(event.get_ID()), 'label': event.get_label()},arrays
+  
+  def command_columns(self, header):
+    reader = self.reader(header)
+    loop_kwargs = dict( (str(k),v) for k,v in header.get('loop',{}).items() )
+    columns = reader.get_columns(str(header['tag']), 
+      [ str(m) for m in header['members'] ], **loop_kwargs)
+    return {},_columns_arrays(columns)
+  
+  def command_close(self, header):
+    key = (tuple( str(f) for f in header['filenames'] ),
+      str(header.get('backend','gallery')))
+    return {'closed': self.readers.pop(key,None)!=None},{}
+  
+  def command_shutdown(self, header):
+    threading.Thread(target=self.shutdown).start()
+    return {'shutdown': True},{}
+  
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    if os.path.exists(self.path): os.remove(self.path)
+
+def serve(path=default_socket, handle_Ttypes=(), headers=(), quiet=False):
+  '''Run a HeistServer until it gets a 'shutdown' command (or Ctrl-C).'''
+  init_env(list(handle_Ttypes), list(headers))
+  server = HeistServer(path, quiet=quiet)
+  if not quiet: print 'heist server listening on %s'%(path,)
+  try: server.serve_forever()
+  except KeyboardInterrupt: pass
+  finally: server.server_close()
+
+
+class HeistClient(object):
+  '''Talks to a HeistServer; needs neither ROOT nor gallery.
+  
+  Example:
+    client = heist.HeistClient()
+    client.list_records('file.root', pattern='Cluster')
+    hits = client.get_columns('file.root', hit_tag, ('energy','time'), nmax=100)
+    event = client.get_event('file.root', (1,1,42), {hit_tag: ('energy',)})
+  
+  filenames may be one name or a list; answers for the same list of files
+    come from the same (warm) reader in the server.
+  '''
+  def __init__(self, path=default_socket, timeout=None):
+    self.path = path
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    self.sock.connect(path)
+  
+  def request(self, command, **header):
+    '''Send a command; returns (reply header, reply arrays).'''
+    header['command'] = command
+    _send_message(self.sock, header)
+    reply,arrays = _recv_message(self.sock)
+    if 'error' in reply: 
+      raise RuntimeError('heist server: %s'%(reply['error'],))
+    return reply,arrays
+  
+  def ping(self): return self.request('ping')[0]
+  
+  def open(self, filenames, backend='gallery'):
+    return self.request('open', filenames=filenames, backend=backend)[0]
+  
+  def list_records(self, filenames, pattern=None, regex=None, 
+      backend='gallery'
+    ):
+    reply,arrays = self.request('list_records', filenames=filenames, 
+      pattern=pattern, regex=regex, backend=backend)
+    return [ str(record['name']) for record in reply['records'] ]
+  
+  def get_event(self, filenames, event_id, tags, backend='gallery'):
+    '''Returns {tag: JaggedColumns (one event)} for {tag: members}.'''
+    tags = [ (str(tag),list(members)) for tag,members in tags.items() ]
+    reply,arrays = self.request('event', filenames=filenames, 
+      id=list(event_id), tags=tags, backend=backend)
+    return dict( (tag,_arrays_columns(arrays,'t%d:'%i_tag)) 
+      for i_tag,(tag,members) in enumerate(tags) )
+  
+  def get_columns(self, filenames, tag, members, backend='gallery', 
+      **loop_kwargs
+    ):
+    '''Like ArtFileReader.get_columns(), answered by the server.'''
+    reply,arrays = self.request('columns', filenames=filenames, tag=str(tag),
+      members=list(members), loop=loop_kwargs, backend=backend)
+    return _arrays_columns(arrays)
+  
+  def close(self, filenames, backend='gallery'):
+    '''Let the server forget its reader for these files.'''
+    if isinstance(filenames,basestring): filenames = [ filenames ]
+    return self.request('close', filenames=filenames, backend=backend)[0]
+  
+  def shutdown(self): return self.request('shutdown')[0]
 
 
+if __name__=='__main__':
+  if len(sys.argv)>=2 and sys.argv[1]=='serve':
+    serve(*sys.argv[2:3])
+  else:
+    print 'Usage: python heist.py serve [SOCKET]'
+    sys.exit(1)
@@ -0,0 +1,110 @@
+
+__doc__ = '''Benchmarks for heist.
+
+Usage:
+  python heist_bench.py import [FILENAME]
+  python heist_bench.py quicktag FILENAME QUICKTAG [N_CALLS]
+
+Each benchmark prints the timings of the things it compares.
+'''
+
+import os
+import sys
+import time
+import subprocess
+
+
+def _time_per_call(function, n_calls):
+  '''Returns seconds per call of function() (best of 3 runs).'''
+  best = None
+  for i_run in range(3):
+    start = time.time()
+    for i_call in xrange(n_calls): function()
+    elapsed = (time.time()-start)/n_calls
+    if best==None or elapsed<best: best = elapsed
+  return best
+
+
+_import_script = '''
+import sys,time
+start = time.time()
+import heist
+print 'import heist: %.3f s'%(time.time()-start,)
+heist.ROOT.gROOT
+print 'first use of ROOT (import, headers): %.3f s'%(time.time()-start,)
+if len(sys.argv)>1:
+  reader = heist.ArtFileReader(sys.argv[1], quiet=True)
+  reader.event.get_ID()
+  print 'first event: %.3f s'%(time.time()-start,)
+'''
+
+def bench_import(filename=None):
+  '''Time 'import heist', first use of ROOT and first event (if filename).
+  
+  Each is measured from the start of a fresh python process, so nothing is
+    already imported.
+  '''
+  here = os.path.dirname(os.path.abspath(__file__))
+  command = [ sys.executable, '-c', _import_script ]
+  if filename!=None: command += [ filename ]
+  environment = dict(os.environ)
+  environment['PYTHONPATH'] = os.pathsep.join(
+    [here]+[p for p in [environment.get('PYTHONPATH')] if p] )
+  output = subprocess.check_output(command, env=environment)
+  for line in output.splitlines(): print '  '+line
+  return output
+
+
+def _old_input_tag(heist, quicktag):
+  '''What InputTag(quicktag=...) used to do on every call.
+  
+  (InputTag now makes its type and art::InputTag lazily, so timing it
+    would understate the old cost.)
+  '''
+  dtype,label,instance,process = heist.convert_quicktag(quicktag.rstrip('.'))
+  dtype = eval(dtype, {'ROOT': heist.ROOT})
+  heist._do_declare_Ttype(dtype.__cppname__)
+  input_tag = heist.ROOT.art.InputTag(label,instance,process)
+  branch_name = '%s_%s_%s_%s.'%(
+    heist._friendly_type(dtype.__cppname__),label,instance,process)
+  return dtype,input_tag,branch_name
+
+def bench_quicktag(filename, quicktag, n_calls=10000):
+  '''Per-call cost of using a quicktag string instead of an InputTag.
+
+  'before' is what every Event.get_record(quicktag) used to do: parse the
+    string, eval() the type and build a new art::InputTag (see 
+    _old_input_tag()).  'after' is the interned lookup which get_record() 
+    does now.
+  '''
+  import heist
+  reader = heist.ArtFileReader(filename, quiet=True)
+  prebuilt = heist.InputTag(quicktag=quicktag)
+  event = reader.event
+  results = [
+    ('before: parse, eval, art::InputTag',
+      _time_per_call(lambda: _old_input_tag(heist, quicktag), n_calls)),
+    ('after: intern_tag(quicktag)',
+      _time_per_call(lambda: heist.intern_tag(quicktag), n_calls)),
+    ('get_record(quicktag)',
+      _time_per_call(lambda: event.get_record(quicktag), n_calls)),
+    ('get_record(prebuilt InputTag)',
+      _time_per_call(lambda: event.get_record(prebuilt), n_calls)),
+  ]
+  for name,seconds in results:
+    print '  %-32s %10.2f us/call'%(name,1e6*seconds)
+  return results
+
+
+if __name__=='__main__':
+  if len(sys.argv)<2:
+    print __doc__
+    sys.exit(1)
+  benchmark,args = sys.argv[1],sys.argv[2:]
+  if benchmark=='import':
+    bench_import(*args[:1])
+  elif benchmark=='quicktag':
+    bench_quicktag(args[0], args[1], *[int(a) for a in args[2:]])
+  else:
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,414 @@
+'''Tests of the parts of heist which work without ROOT (run with pytest).'''
+
+import copy
+import json
+import os
+import socket
+import time
+
+import numpy
+import pytest
+
+import heist
+
+
+def make_columns():
+  '''Three events with 2, 0 and 3 elements.'''
+  return heist.JaggedColumns(
+    {'energy': numpy.array([1.,2.,3.,4.,5.]),
+     'caloNum': numpy.array([1,2,1,1,2])},
+    [0,2,2,5], [(1,1,1),(1,1,2),(1,2,7)])
+
+
+################################################################
+# InputTag
+
+def test_input_tag_without_root():
+  tag = heist.InputTag(quicktag='gm2calo::CrystalHitArtRecords_fitter_inst_reco')
+  assert tag.cppname=='vector<gm2calo::CrystalHitArtRecord>'
+  assert tag.branch_name=='gm2calo::CrystalHitArtRecords_fitter_inst_reco.'
+  assert (tag.label(),tag.instance(),tag.process())==('fitter','inst','reco')
+  assert not tag.any_process
+  assert heist.ROOT._module is None
+
+def test_input_tag_trigger_results():
+  tag = heist.InputTag(quicktag='art::TriggerResults_TriggerResults__sim')
+  assert tag.cppname=='art::TriggerResults'
+  assert tag.branch_name=='art::TriggerResults_TriggerResults__sim.'
+
+def test_partial_tag_matches_every_process():
+  names = ['ns::Foos_mod__reco.', 'ns::Foos_mod__sim.', 'ns::Foos_mod_x_reco.',
+    'ns::Foos_mod__reco.obj.energy', 'ns::Foos_other__reco.']
+  assert heist._tag_branches('ns::Foos_mod', names)==[
+    'ns::Foos_mod__reco.', 'ns::Foos_mod__sim.']
+  assert heist._tag_branches('ns::Foos_mod_x', names)==['ns::Foos_mod_x_reco.']
+  assert heist._tag_branches('ns::Foos_mod__sim', names)==['ns::Foos_mod__sim.']
+  assert heist._tag_branches('ns::Foos_nothere', names)==[]
+
+def test_handle_code_stands_alone():
+  Ttype = heist._normalize_type('vector<pair<int,gm2calo::CrystalHitArtRecord>>')
+  assert Ttype=='std::vector<std::pair<int,gm2calo::CrystalHitArtRecord> >'
+  assert heist._normalize_type(Ttype)==Ttype
+  header = 'gm2dataproducts/calo/CrystalHitArtRecord.hh'
+  lines = heist._handle_code([header], [Ttype]).splitlines()
+  assert lines==[
+    '#include "gallery/Event.h"',
+    '#include "%s"'%(header,),
+    'template gallery::ValidHandle<%(T)s> gallery::Event::getValidHandle<%(T)s>'
+    '(art::InputTag const&) const;'%{'T':Ttype},
+  ]
+
+
+################################################################
+# sidecars
+
+def test_valid_sidecar_wins_over_stale_one(tmpdir, monkeypatch):
+  monkeypatch.setattr(heist, 'cache_dir', str(tmpdir.mkdir('cache')))
+  filename = str(tmpdir.join('a.root'))
+  with open(filename,'wb') as fileobj: fileobj.write('x'*10)
+  stamp = heist._file_stamp(filename)
+  ids = numpy.array([[1,1,1],[1,1,2]],dtype='int64')
+  next_to_file,in_cache = heist._sidecar_paths(filename, '.heistidx.npz')
+  heist._atomic_write(next_to_file, lambda fileobj: numpy.savez(fileobj,
+    ids=ids[:1], stamp=numpy.array((stamp[0]+1,stamp[1]))))
+  heist._atomic_write(in_cache, lambda fileobj: numpy.savez(fileobj,
+    ids=ids, stamp=numpy.array(stamp)))
+  assert heist._load_file_index(filename).tolist()==ids.tolist()
+
+
+################################################################
+# JaggedColumns
+
+def test_jagged_columns():
+  columns = make_columns()
+  assert len(columns)==3
+  assert list(columns.counts())==[2,0,3]
+  assert list(columns.event_index())==[0,0,2,2,2]
+  assert list(columns.event(2)['energy'])==[3.,4.,5.]
+
+def test_jagged_columns_take():
+  part = make_columns().take([2,0])
+  assert list(part.offsets)==[0,3,5]
+  assert list(part['energy'])==[3.,4.,5.,1.,2.]
+  assert part.ids.tolist()==[[1,2,7],[1,1,1]]
+
+def test_jagged_columns_concatenate():
+  columns = make_columns()
+  joined = heist.JaggedColumns.concatenate(
+    [columns.take([0]),columns.take([1,2])])
+  assert list(joined.offsets)==list(columns.offsets)
+  assert list(joined['energy'])==list(columns['energy'])
+  assert joined.ids.tolist()==columns.ids.tolist()
+  empty = heist.JaggedColumns.concatenate([], members=('energy',))
+  assert len(empty)==0 and len(empty['energy'])==0
+
+
+################################################################
+# aggregation
+
+def test_hist1d():
+  hist = heist.Hist1D('energy', 2, (1.,5.)).fill(make_columns())
+  assert list(hist.counts())==[2,2]
+  assert (hist.underflow(),hist.overflow())==(0,1)
+
+def test_hist1d_groups_and_weights():
+  hist = heist.Hist1D('energy', 2, (1.,5.), weight='energy',
+    group_by='caloNum').fill(make_columns())
+  assert hist.groups()==[1,2]
+  assert list(hist.counts(1))==[1.,7.]
+  assert list(hist.counts(2))==[2.,0.]
+  assert hist.overflow(2)==5.
+  assert numpy.allclose(hist.errors(1),[1.,5.])
+
+def test_field_stats():
+  stats = heist.FieldStats('energy').fill(make_columns())
+  assert stats.n()==5
+  assert stats.mean()==3.
+  assert numpy.isclose(stats.std(),numpy.sqrt(2.))
+  assert (stats.min(),stats.max())==(1.,5.)
+
+def test_merge_aggregates():
+  columns = make_columns()
+  a = {'hist': heist.Hist1D('energy', 2, (1.,5.)).fill(columns),
+    'stats': heist.FieldStats('energy').fill(columns)}
+  b = copy.deepcopy(a)
+  merged = heist.merge_aggregates(a, b)
+  assert list(merged['hist'].counts())==[4,4]
+  assert merged['stats'].n()==10
+  assert list(a['hist'].counts())==[2,2] # inputs are not changed
+  assert a['stats'].n()==5
+
+def test_merge_incompatible():
+  with pytest.raises(ValueError):
+    heist.Hist1D('energy', 2, (1.,5.)).merge(heist.Hist1D('energy', 3, (1.,5.)))
+  with pytest.raises(ValueError):
+    heist.FieldStats('energy').merge(heist.FieldStats('time'))
+
+
+def test_file_weights(tmpdir, capsys):
+  filename = str(tmpdir.join('a.root'))
+  with open(filename,'wb') as fileobj: fileobj.write('x'*10)
+  missing = str(tmpdir.join('missing.root'))
+  assert heist._file_weights([filename,missing], 'size')==[10,0]
+  assert missing in capsys.readouterr()[0]
+  with pytest.raises(ValueError): heist._file_weights([filename], 'other')
+
+def test_file_weights_events_without_opening_files(tmpdir):
+  filenames = [ str(tmpdir.join('%s.root'%(name,))) for name in 'abc' ]
+  for filename in filenames:
+    with open(filename,'wb') as fileobj: fileobj.write('x')
+  # a: in the manifest; b: has an event index; c: has a counted entry number
+  manifest = heist.Manifest.__new__(heist.Manifest)
+  manifest.records = { filenames[0]: {'events': 7} }
+  stamp = numpy.array(heist._file_stamp(filenames[1]))
+  heist._save_sidecar(filenames[1], heist.EventIndex.sidecar_suffix,
+    lambda fileobj: numpy.savez(fileobj, ids=numpy.zeros((3,3)), stamp=stamp))
+  with open(filenames[2]+heist._entries_suffix,'w') as fileobj:
+    json.dump({'stamp':list(heist._file_stamp(filenames[2])), 'entries':5},
+      fileobj)
+  assert heist._file_weights(filenames, 'events', manifest=manifest)==[7,3,5]
+
+
+################################################################
+# sampling
+
+def test_allocate_proportional():
+  assert list(heist._allocate(10, [10,30,60]))==[1,3,6]
+  assert list(heist._allocate(3, [1,1,1,1]))==[1,1,1,0]
+
+def test_allocate_equal_and_capped():
+  assert list(heist._allocate(9, [2,100,100], 'equal'))==[2,4,3]
+  assert list(heist._allocate(100, [2,3]))==[2,3]
+  assert list(heist._allocate(0, [2,3]))==[0,0]
+  with pytest.raises(ValueError): heist._allocate(1, [2], 'other')
+
+def test_sample_range():
+  drawn = heist._sample_range(numpy.random.RandomState(1), 1000, 50)
+  assert len(drawn)==50 and len(set(drawn))==50
+  assert drawn.min()>=0 and drawn.max()<1000
+  again = heist._sample_range(numpy.random.RandomState(1), 1000, 50)
+  assert list(drawn)==list(again)
+  assert list(heist._sample_range(numpy.random.RandomState(1), 5, 10))==range(5)
+  assert len(heist._sample_range(numpy.random.RandomState(1), 5, 0))==0
+
+
+################################################################
+# uproot backend
+
+uproot_hits = 'ns::Hits_mod__reco.'
+
+def write_uproot_file(path):
+  '''A tiny art-like file with split branches: 3 events, with 2 hits, no
+    hits, and no Hits product at all.'''
+  uproot = pytest.importorskip('uproot', minversion='4.1')
+  awkward = pytest.importorskip('awkward')
+  branches = {
+    'EventAuxiliary.id_.subRun_.run_.run_': numpy.array([1,1,1],'int32'),
+    'EventAuxiliary.id_.subRun_.subRun_': numpy.array([2,2,2],'int32'),
+    'EventAuxiliary.id_.event_': numpy.array([10,11,12],'int32'),
+    uproot_hits: numpy.array([1,1,0],'int32'),
+    uproot_hits+'present': numpy.array([True,True,False]),
+    uproot_hits+'obj.energy': awkward.Array([[1.,2.],[],[]]),
+    uproot_hits+'obj.time': awkward.Array([[5.,6.],[],[]]),
+  }
+  with uproot.recreate(path) as fileobj: # (a TTree, as art writes)
+    fileobj.mktree('Events', dict( (name,
+      array.dtype if isinstance(array,numpy.ndarray) else array.type)
+      for name,array in branches.items() )).extend(branches)
+  return path
+
+def test_uproot_records(tmpdir):
+  filename = write_uproot_file(str(tmpdir.join('a.root')))
+  reader = heist.ArtFileReader(filename, backend='uproot')
+  ids,records = [],[]
+  for event in reader.event_loop():
+    ids += [ event.get_ID() ]
+    records += [ event.get_record('ns::Hits_mod') ]
+  assert ids==[(1,2,10),(1,2,11),(1,2,12)]
+  assert list(records[0].energy)==[1.,2.] and list(records[0].time)==[5.,6.]
+  assert records[1] is not None and len(records[1])==0
+  assert records[2] is None
+
+def test_uproot_columns_and_catalog(tmpdir):
+  filename = write_uproot_file(str(tmpdir.join('a.root')))
+  reader = heist.ArtFileReader(filename, backend='uproot')
+  columns = reader.get_columns('ns::Hits_mod', ['energy','time'])
+  assert list(columns.offsets)==[0,2,2,2]
+  assert list(columns['energy'])==[1.,2.]
+  assert columns.ids.tolist()==[[1,2,10],[1,2,11],[1,2,12]]
+  records = reader.catalog().records()
+  assert [ record['name'] for record in records ]==[uproot_hits.rstrip('.')]
+  assert records[0]['entries']==3
+
+def test_uproot_skim_keep_and_select(tmpdir):
+  filename = write_uproot_file(str(tmpdir.join('a.root')))
+  reader = heist.ArtFileReader(filename, backend='uproot')
+  skim_filename = str(tmpdir.join('skim.npz'))
+  assert reader.skim(skim_filename, {'ns::Hits_mod': ('energy',)},
+    keep=lambda event: event.get_record('ns::Hits_mod') is not None,
+    select=lambda ID: ID[2]>10)==1
+  skim = heist.SkimReader(skim_filename)
+  assert [ event.get_ID() for event in skim.event_loop() ]==[(1,2,11)]
+  assert len(skim.goto(1,2,11).get_record('ns::Hits_mod'))==0
+
+
+################################################################
+# skims
+
+def test_skim_round_trip(tmpdir):
+  filename = str(tmpdir.join('skim.npz'))
+  columns = make_columns()
+  heist._write_skim(filename, columns.ids,
+    [('ns::Foos_mod_inst_reco',columns)], sources=['a.root'], 
+    presence=[[True,True,True]])
+  skim = heist.SkimReader(filename)
+  assert len(skim)==3
+  assert skim.sources==['a.root']
+  assert skim.list_records()==['ns::Foos_mod_inst_reco']
+  read = skim.get_columns('ns::Foos_mod')
+  assert list(read.offsets)==list(columns.offsets)
+  assert list(read['energy'])==list(columns['energy'])
+  assert read.ids.tolist()==columns.ids.tolist()
+  ids = [ event.get_ID() for event in skim.event_loop() ]
+  assert ids==[(1,1,1),(1,1,2),(1,2,7)]
+  assert list(skim.goto(1,2,7).get_record('ns::Foos_mod')['energy'])==[3.,4.,5.]
+  assert list(skim.event_loop(event_list=[]))==[]
+
+def test_skim_absent_and_empty(tmpdir):
+  filename = str(tmpdir.join('skim.npz'))
+  columns = make_columns()
+  heist._write_skim(filename, columns.ids, [('ns::Foos_mod_inst_reco',columns)],
+    presence=[[True,False,True]])
+  skim = heist.SkimReader(filename)
+  assert skim.goto(1,1,2).get_record('ns::Foos_mod') is None
+  heist._write_skim(filename, columns.ids, [('ns::Foos_mod_inst_reco',columns)])
+  skim = heist.SkimReader(filename)
+  empty = skim.goto(1,1,2).get_record('ns::Foos_mod')
+  assert empty is not None and len(empty)==0
+  assert sorted(empty.dtype.names)==sorted(columns.keys())
+
+
+################################################################
+# staging
+
+def test_staging_from_slow_directory(tmpdir, monkeypatch):
+  source = tmpdir.mkdir('slow')
+  filenames = []
+  for i_file in range(4):
+    filenames += [ str(source.join('f%d.root'%i_file)) ]
+    with open(filenames[-1],'wb') as fileobj: fileobj.write(str(i_file)*1000)
+  copyfileobj = heist.shutil.copyfileobj
+  def slow_copy(source, target, length):
+    time.sleep(0.2)
+    copyfileobj(source, target, length)
+  monkeypatch.setattr(heist.shutil, 'copyfileobj', slow_copy)
+  cache = heist.StagingCache(str(tmpdir.mkdir('staging')), max_bytes=2500)
+  
+  # the next file is copied in the background, and only once
+  paths = [ cache.stage(filenames[0]) ]
+  cache.advance(filenames[:2], 0)
+  paths += [ cache.stage(filenames[1]) ]
+  deadline = time.time()+10
+  while cache._queued and time.time()<deadline: time.sleep(0.01)
+  assert open(paths[1],'rb').read()=='1'*1000
+  assert cache.stats()['bytes_copied']==2000
+  
+  # least recently used copies are evicted, with their lock files
+  cache.release()
+  paths += [ cache.stage(filenames[2]), cache.stage(filenames[3]) ]
+  assert cache.stats()['evictions']==2
+  for path in paths[:2]: 
+    assert not os.path.exists(path) and not os.path.exists(path+'.lock')
+  assert sorted(os.listdir(cache.directory))==sorted(
+    [ os.path.basename(path) for path in paths[2:] ]
+    +[ os.path.basename(path)+'.lock' for path in paths[2:] ]+['.lock'])
+  cache.release()
+
+
+def test_staging_does_not_pin_files_passed_by(tmpdir, monkeypatch):
+  source = tmpdir.mkdir('slow')
+  filenames = []
+  for i_file in range(4):
+    filenames += [ str(source.join('f%d.root'%i_file)) ]
+    with open(filenames[-1],'wb') as fileobj: fileobj.write(str(i_file)*100)
+  copyfileobj = heist.shutil.copyfileobj
+  def slow_copy(source, target, length):
+    if source.name.endswith('f1.root'): time.sleep(0.5)
+    copyfileobj(source, target, length)
+  monkeypatch.setattr(heist.shutil, 'copyfileobj', slow_copy)
+  cache = heist.StagingCache(str(tmpdir.mkdir('staging')), ahead=1)
+  cache.stage(filenames[0])
+  cache.advance(filenames, 0) # starts copying f1 ...
+  cache.stage(filenames[2])
+  cache.advance(filenames, 2) # ... but the loop is past it before it is done
+  deadline = time.time()+10
+  while cache._queued and time.time()<deadline: time.sleep(0.01)
+  assert os.path.exists(cache.local_path(filenames[1]))
+  assert sorted(cache._pins)==sorted(
+    cache.local_path(f) for f in filenames[2:])
+  cache.release()
+
+
+################################################################
+# server messages
+
+def test_message_framing():
+  server,client = socket.socketpair()
+  try:
+    arrays = {'a': numpy.arange(6,dtype='int32').reshape(2,3),
+      'empty': numpy.zeros(0,dtype='float64')}
+    heist._send_message(client, {'command':'test', 'n':3}, arrays)
+    heist._send_message(client, {'command':'again'})
+    header,received = heist._recv_message(server)
+    assert header=={'command':'test', 'n':3}
+    assert received['a'].dtype==numpy.dtype('int32')
+    assert received['a'].tolist()==[[0,1,2],[3,4,5]]
+    assert len(received['empty'])==0
+    assert heist._recv_message(server)==({'command':'again'},{})
+    client.close()
+    with pytest.raises(EOFError): heist._recv_message(server)
+  finally: server.close()
+
+def test_columns_over_messages():
+  columns = make_columns()
+  arrays = heist._columns_arrays(columns, 'x:')
+  back = heist._arrays_columns(arrays, 'x:')
+  assert sorted(back.keys())==['caloNum','energy']
+  assert list(back.offsets)==list(columns.offsets)
+  assert list(back['caloNum'])==list(columns['caloNum'])
+
+def test_server_serves_clients_side_by_side(tmpdir):
+  path = str(tmpdir.join('heist.sock'))
+  server = heist.HeistServer(path, quiet=True)
+  thread = heist.threading.Thread(target=server.serve_forever)
+  thread.start()
+  try:
+    idle = heist.HeistClient(path, timeout=5) # keeps its connection open
+    other = heist.HeistClient(path, timeout=5)
+    with pytest.raises(IOError): heist.HeistServer(path, quiet=True)
+    assert other.ping()['commands']==1
+    assert idle.ping()['commands']==2
+    other.request('shutdown')
+  finally:
+    thread.join(5)
+    server.server_close()
+  assert not thread.is_alive()
+
+def test_server_replaces_stale_socket(tmpdir):
+  path = str(tmpdir.join('heist.sock'))
+  dead = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  dead.bind(path) # a socket file nobody listens on
+  dead.close()
+  server = heist.HeistServer(path, quiet=True)
+  server.server_close()
+
+
+################################################################
+# magicdump
+
+def test_magicdump_without_root():
+  import StringIO
+  out = StringIO.StringIO()
+  heist.magicdump([1.5,2.5], out=out)
+  assert '1.5' in out.getvalue()
+  assert heist.ROOT._module is None